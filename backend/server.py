@@ -1,26 +1,307 @@
-from fastapi import FastAPI, APIRouter, HTTPException, Depends, WebSocket, WebSocketDisconnect
+from fastapi import FastAPI, APIRouter, HTTPException, Depends, Query, Request, Response, WebSocket, WebSocketDisconnect
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
+from starlette.datastructures import Headers
+from starlette.routing import compile_path
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import UpdateOne, ReturnDocument
+from pymongo.errors import OperationFailure, BulkWriteError, PyMongoError, ExecutionTimeout, DuplicateKeyError
+from pymongo import monitoring
 import os
 import logging
 from pathlib import Path
-from pydantic import BaseModel, Field
-from typing import List, Optional, Dict, Any
+from pydantic import BaseModel, Field, TypeAdapter, ValidationError
+from typing import List, Optional, Dict, Any, Set, Union, Literal, Annotated
 import uuid
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 import jwt
 from passlib.context import CryptContext
 import json
+import base64
+import hashlib
+import heapq
+import math
+import re
+import time
+import asyncio
+import socket
+import tempfile
+import threading
+from abc import ABC, abstractmethod
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import orjson
+except ImportError:  # optional: stdlib json is used when orjson is not installed
+    orjson = None
 
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
 
+# Metrics
+# Minimal Prometheus-style registry rendered in the text exposition format on /metrics. Samples
+# are recorded under a per-metric lock because Mongo command events arrive on motor's worker threads.
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+def _format_labels(names, values) -> str:
+    pairs = []
+    for name, value in zip(names, values):
+        value = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        pairs.append(f'{name}="{value}"')
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+class Counter:
+    type = "counter"
+
+    def __init__(self, name: str, help: str, labels: tuple = ()):
+        self.name, self.help, self.labels = name, help, labels
+        self.values: Dict[tuple, float] = {}
+        self.lock = threading.Lock()
+
+    def inc(self, *label_values, amount: float = 1):
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def render(self) -> List[str]:
+        with self.lock:
+            return [f"{self.name}{_format_labels(self.labels, k)} {v}" for k, v in self.values.items()]
+
+class Gauge(Counter):
+    type = "gauge"
+
+    def set(self, *label_values, value: float):
+        with self.lock:
+            self.values[label_values] = value
+
+class Histogram:
+    type = "histogram"
+
+    def __init__(self, name: str, help: str, labels: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        self.name, self.help, self.labels, self.buckets = name, help, labels, buckets
+        self.series: Dict[tuple, list] = {}  # label values -> [bucket counts..., +Inf count, sum]
+        self.lock = threading.Lock()
+
+    def observe(self, seconds: float, *label_values):
+        i = bisect_left(self.buckets, seconds)
+        with self.lock:
+            series = self.series.get(label_values)
+            if series is None:
+                series = self.series[label_values] = [0] * (len(self.buckets) + 1) + [0.0]
+            series[i] += 1
+            series[-1] += seconds
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            count = sum(sum(series[:-1]) for series in self.series.values())
+            total = sum(series[-1] for series in self.series.values())
+        return {"count": count, "avg_seconds": total / count if count else 0.0}
+
+    def render(self) -> List[str]:
+        lines = []
+        with self.lock:
+            items = [(k, list(v)) for k, v in self.series.items()]
+        for label_values, series in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), series[:-1]):
+                cumulative += count
+                bucket_labels = _format_labels(self.labels + ("le",), label_values + (bound,))
+                lines.append(f"{self.name}_bucket{bucket_labels} {cumulative}")
+            labels = _format_labels(self.labels, label_values)
+            lines.append(f"{self.name}_sum{labels} {series[-1]}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics: list = []
+        self.collectors: list = []  # callables run at scrape time to refresh gauges
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name: str, help: str, labels: tuple = ()) -> Counter:
+        return self.register(Counter(name, help, labels))
+
+    def gauge(self, name: str, help: str, labels: tuple = ()) -> Gauge:
+        return self.register(Gauge(name, help, labels))
+
+    def histogram(self, name: str, help: str, labels: tuple = ()) -> Histogram:
+        return self.register(Histogram(name, help, labels))
+
+    def render(self) -> str:
+        for collect in self.collectors:
+            collect()
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+metrics = MetricsRegistry()
+HTTP_REQUEST_SECONDS = metrics.histogram("http_request_duration_seconds", "HTTP request latency by route", ("method", "route"))
+HTTP_REQUESTS = metrics.counter("http_requests_total", "HTTP responses by route and status", ("method", "route", "status"))
+HTTP_IN_FLIGHT = metrics.gauge("http_requests_in_flight", "HTTP requests currently being served")
+MONGO_COMMAND_SECONDS = metrics.histogram("mongo_command_duration_seconds", "MongoDB command latency", ("command",))
+MONGO_COMMAND_FAILURES = metrics.counter("mongo_command_failures_total", "Failed MongoDB commands", ("command",))
+PASSWORD_QUEUE_WAIT_SECONDS = metrics.histogram("password_hash_queue_wait_seconds", "Time bcrypt jobs wait for a pool worker")
+PASSWORD_HASH_SECONDS = metrics.histogram("password_hash_duration_seconds", "Time spent in bcrypt hash/verify")
+PASSWORD_HASH_REJECTED = metrics.counter("password_hash_rejected_total", "bcrypt jobs rejected with 503 because the pool was saturated")
+WS_SEND_SECONDS = metrics.histogram("websocket_send_duration_seconds", "Time to write one frame to a WebSocket")
+MONGO_POOL_WAIT_SECONDS = metrics.histogram("mongo_pool_checkout_wait_seconds", "Time spent waiting to check a connection out of the MongoDB pool")
+CHANGE_FEED_EVENTS = metrics.counter("change_feed_events_total", "Database changes dispatched to real-time subscribers", ("collection",))
+CHANGE_FEED_LAG_SECONDS = metrics.histogram("change_feed_lag_seconds", "Time from a write to its dispatch by the change feed", ("collection",))
+RATE_LIMITED = metrics.counter("rate_limited_total", "Requests rejected with 429", ("budget",))
+MONGO_POOL_TIMEOUTS = metrics.counter("mongo_pool_checkout_timeouts_total", "Checkouts that gave up after waitQueueTimeoutMS")
+
+class MongoCommandMetrics(monitoring.CommandListener):
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        MONGO_COMMAND_SECONDS.observe(event.duration_micros / 1e6, event.command_name)
+
+    def failed(self, event):
+        MONGO_COMMAND_SECONDS.observe(event.duration_micros / 1e6, event.command_name)
+        MONGO_COMMAND_FAILURES.inc(event.command_name)
+
+class MetricsMiddleware:
+    # Plain ASGI middleware (no BaseHTTPMiddleware task/queue overhead). Routes are labelled by
+    # their template, e.g. /api/chats/{chat_id}/messages, to keep label cardinality bounded.
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        status = [500]
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                status[0] = message["status"]
+            await send(message)
+
+        HTTP_IN_FLIGHT.inc(amount=1)
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            HTTP_IN_FLIGHT.inc(amount=-1)
+            route = scope.get("route")
+            route = route.path if route is not None else "unmatched"
+            HTTP_REQUEST_SECONDS.observe(time.perf_counter() - started, scope["method"], route)
+            HTTP_REQUESTS.inc(scope["method"], route, status[0])
+
+class MongoPoolMetrics(monitoring.ConnectionPoolListener):
+    # Pool occupancy per server address. pymongo emits checkout events on the thread doing the
+    # checkout, so the wait start time is kept thread-local.
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.connections: Dict[Any, int] = {}
+        self.checked_out: Dict[Any, int] = {}
+        self.waiting = 0
+
+    def _add(self, counts: Dict[Any, int], address, amount: int):
+        with self.lock:
+            counts[address] = counts.get(address, 0) + amount
+
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        pass
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_created(self, event):
+        self._add(self.connections, event.address, 1)
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        self._add(self.connections, event.address, -1)
+
+    def connection_check_out_started(self, event):
+        self.local.started = time.perf_counter()
+        with self.lock:
+            self.waiting += 1
+
+    def _check_out_finished(self):
+        with self.lock:
+            self.waiting -= 1
+        started = getattr(self.local, "started", None)
+        if started is not None:
+            MONGO_POOL_WAIT_SECONDS.observe(time.perf_counter() - started)
+
+    def connection_checked_out(self, event):
+        self._check_out_finished()
+        self._add(self.checked_out, event.address, 1)
+
+    def connection_check_out_failed(self, event):
+        self._check_out_finished()
+        if event.reason == monitoring.ConnectionCheckOutFailedReason.TIMEOUT:
+            MONGO_POOL_TIMEOUTS.inc()
+
+    def connection_checked_in(self, event):
+        self._add(self.checked_out, event.address, -1)
+
+    def stats(self) -> Dict[str, float]:
+        with self.lock:
+            busiest = max(self.checked_out.values(), default=0)
+            return {
+                "connections": sum(self.connections.values()),
+                "checked_out": sum(self.checked_out.values()),
+                "waiting": self.waiting,
+                "max_pool_size": MONGO_MAX_POOL_SIZE,
+                # Saturation of the busiest server's pool; 1.0 means new checkouts queue
+                "saturation": round(busiest / MONGO_MAX_POOL_SIZE, 3)
+            }
+
 # MongoDB connection
+# Pools are per process, so size them per worker: MONGO_MAX_POOL_SIZE x workers must stay under
+# the server's connection limit. The client is built in the app lifespan (open_database), inside
+# the worker's event loop, and warmed to MONGO_MIN_POOL_SIZE connections before serving traffic.
 mongo_url = os.environ['MONGO_URL']
-client = AsyncIOMotorClient(mongo_url)
-db = client[os.environ['DB_NAME']]
+MONGO_MAX_POOL_SIZE = int(os.environ.get("MONGO_MAX_POOL_SIZE", "100"))
+MONGO_MIN_POOL_SIZE = int(os.environ.get("MONGO_MIN_POOL_SIZE", "10"))
+MONGO_WAIT_QUEUE_TIMEOUT_MS = int(os.environ.get("MONGO_WAIT_QUEUE_TIMEOUT_MS", "5000"))
+MONGO_READY_MAX_SATURATION = float(os.environ.get("MONGO_READY_MAX_SATURATION", "0.9"))
+mongo_pool = MongoPoolMetrics()
+
+def create_mongo_client() -> AsyncIOMotorClient:
+    return AsyncIOMotorClient(
+        mongo_url,
+        maxPoolSize=MONGO_MAX_POOL_SIZE,
+        minPoolSize=MONGO_MIN_POOL_SIZE,
+        waitQueueTimeoutMS=MONGO_WAIT_QUEUE_TIMEOUT_MS,
+        event_listeners=[MongoCommandMetrics(), mongo_pool]
+    )
+
+client: Optional[AsyncIOMotorClient] = None
+db = None
+
+async def open_database():
+    global client, db
+    client = create_mongo_client()
+    db = client[os.environ['DB_NAME']]
+    # Concurrent pings hold that many connections at once, so the pool opens them all now
+    # instead of on the first requests after a deploy
+    await asyncio.gather(*(db.command("ping") for _ in range(max(1, MONGO_MIN_POOL_SIZE))))
+    logger.info(f"MongoDB pool warmed: {mongo_pool.stats()}")
 
 # Security
 JWT_SECRET = "telemedicine_secret_key_2025"
@@ -28,37 +309,440 @@ ALGORITHM = "HS256"
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 security = HTTPBearer()
 
+# JSON serialization
+# One encoder for HTTP responses and WebSocket payloads. datetimes are written as ISO 8601, the
+# same as FastAPI's own encoder, so switching paths never changes what clients see.
+def _json_default(obj):
+    if isinstance(obj, datetime):
+        return obj.isoformat()
+    if isinstance(obj, BaseModel):
+        return obj.model_dump()
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+def encode_json(obj) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(obj, default=_json_default)
+    return json.dumps(obj, default=_json_default, ensure_ascii=False, separators=(",", ":")).encode()
+
+class FastJSONResponse(JSONResponse):
+    def render(self, content: Any) -> bytes:
+        return encode_json(content)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # startup()/shutdown() are defined at the end of the module
+    await startup()
+    try:
+        yield
+    finally:
+        await shutdown()
+
+# Rate limiting
+# Token buckets per (budget, caller). The caller is the user id from a valid bearer token, otherwise
+# the client IP. Behind a reverse proxy that address comes from uvicorn --proxy-headers trusting only
+# the proxy's own address (entrypoint.sh), or from the last X-Forwarded-For hop when
+# RATE_LIMIT_TRUST_PROXY is set (Railway, whose edge address is not fixed: never --forwarded-allow-ips=*,
+# which takes the first hop, and the client writes that one). A budget
+# (limit, window) allows bursts of `limit` requests and refills at limit/window per second; routes
+# without their own budget share RATE_LIMIT_DEFAULT. RATE_LIMIT_BACKEND=memory keeps the buckets
+# per worker, mongo shares them across workers (one atomic round trip per request), off disables it.
+RATE_LIMIT_BACKEND = os.environ.get("RATE_LIMIT_BACKEND", "memory")
+RATE_LIMIT_TRUST_PROXY = os.environ.get("RATE_LIMIT_TRUST_PROXY", "false").lower() == "true"
+RATE_LIMIT_SWEEP_SECONDS = 60
+
+def parse_budget(spec: str) -> tuple:
+    limit, window = spec.split("/")
+    return int(limit), float(window)
+
+RATE_LIMIT_DEFAULT = parse_budget(os.environ.get("RATE_LIMIT_DEFAULT", "300/60"))
+RATE_LIMIT_ROUTES = {
+    # bcrypt on every attempt; keyed by IP since there is no token yet
+    ("POST", "/api/auth/login"): (10, 60),
+    ("POST", "/api/auth/register"): (5, 300),
+    ("POST", "/api/auth/refresh"): (30, 60),
+    ("POST", "/api/chats/{chat_id}/messages"): (60, 60),
+    ("POST", "/api/chats/{chat_id}/messages:batch"): (20, 60),
+    ("POST", "/api/prescriptions"): (30, 60),
+    ("GET", "/api/search"): (30, 60),
+    ("GET", "/api/patients/{patient_id}/export"): (5, 300),
+}
+
+class MemoryBucketStore:
+    def __init__(self):
+        self.buckets: Dict[str, tuple] = {}  # key -> (tokens, updated_at, window)
+        self.next_sweep = time.monotonic() + RATE_LIMIT_SWEEP_SECONDS
+
+    async def take(self, key: str, limit: int, window: float) -> tuple:
+        now = time.monotonic()
+        tokens, updated_at, _ = self.buckets.get(key, (limit, now, window))
+        tokens = min(limit, tokens + (now - updated_at) * limit / window)
+        allowed = tokens >= 1
+        if allowed:
+            tokens -= 1
+        self.buckets[key] = (tokens, now, window)
+        if now >= self.next_sweep:
+            self.sweep(now)
+        return allowed, tokens
+
+    def sweep(self, now: float):
+        # A bucket untouched for a whole window has refilled completely, same as a missing one
+        self.buckets = {key: bucket for key, bucket in self.buckets.items() if now - bucket[1] < bucket[2]}
+        self.next_sweep = now + RATE_LIMIT_SWEEP_SECONDS
+
+class MongoBucketStore:
+    # Refill and take happen in one pipeline update, so concurrent workers never double-spend a
+    # token. Idle buckets are removed by the TTL index on expires_at. Fails open if MongoDB errors.
+    async def take(self, key: str, limit: int, window: float) -> tuple:
+        now = datetime.utcnow()
+        refilled = {"$min": [limit, {"$add": [
+            {"$ifNull": ["$tokens", limit]},
+            {"$multiply": [limit / window / 1000, {"$subtract": [now, {"$ifNull": ["$updated_at", now]}]}]}
+        ]}]}
+        update = [
+            {"$set": {"tokens": refilled, "updated_at": now, "expires_at": now + timedelta(seconds=window)}},
+            {"$set": {
+                "allowed": {"$gte": ["$tokens", 1]},
+                "tokens": {"$cond": [{"$gte": ["$tokens", 1]}, {"$subtract": ["$tokens", 1]}, "$tokens"]}
+            }}
+        ]
+        for attempt in range(2):
+            try:
+                bucket = await db.rate_limits.find_one_and_update(
+                    {"_id": key}, update, projection={"tokens": 1, "allowed": 1},
+                    upsert=True, return_document=ReturnDocument.AFTER
+                )
+                return bucket["allowed"], bucket["tokens"]
+            except DuplicateKeyError:
+                continue  # two workers created the same bucket at once; the retry updates it
+            except PyMongoError as e:
+                logger.warning(f"Rate limit store unavailable, allowing request: {e}")
+                break
+        return True, float(limit)
+
+RATE_LIMIT_STORES = {"memory": MemoryBucketStore, "mongo": MongoBucketStore, "off": lambda: None}
+if RATE_LIMIT_BACKEND not in RATE_LIMIT_STORES:
+    raise RuntimeError(f"Unknown rate limit backend: {RATE_LIMIT_BACKEND}")
+rate_limiter = RATE_LIMIT_STORES[RATE_LIMIT_BACKEND]()
+
+def caller_identity(scope) -> str:
+    headers = Headers(scope=scope)
+    authorization = headers.get("authorization", "")
+    if authorization[:7].lower() == "bearer ":
+        try:
+            return "user:" + jwt.decode(authorization[7:], JWT_SECRET, algorithms=[ALGORITHM])["sub"]
+        except (jwt.PyJWTError, KeyError):
+            pass
+    forwarded = headers.get("x-forwarded-for")
+    if RATE_LIMIT_TRUST_PROXY and forwarded:
+        # The hop our proxy appended; anything before it was sent by the client and can be forged
+        return "ip:" + forwarded.split(",")[-1].strip()
+    client = scope.get("client")
+    return "ip:" + (client[0] if client else "unknown")
+
+def route_budget(method: str, route: str) -> tuple:
+    budget = RATE_LIMIT_ROUTES.get((method, route))
+    return (f"{method} {route}", *budget) if budget else ("default", *RATE_LIMIT_DEFAULT)
+
+class RateLimitMiddleware:
+    # Runs before routing, so budgets are matched against the path templates directly
+    def __init__(self, app):
+        self.app = app
+        self.routes = [
+            (method, compile_path(path)[0], f"{method} {path}", budget)
+            for (method, path), budget in RATE_LIMIT_ROUTES.items()
+        ]
+
+    def budget(self, method: str, path: str) -> tuple:
+        for route_method, pattern, name, (limit, window) in self.routes:
+            if route_method == method and pattern.match(path):
+                return name, limit, window
+        return ("default", *RATE_LIMIT_DEFAULT)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or rate_limiter is None or not scope["path"].startswith("/api/"):
+            await self.app(scope, receive, send)
+            return
+
+        name, limit, window = self.budget(scope["method"], scope["path"])
+        allowed, tokens = await rate_limiter.take(f"{name}|{caller_identity(scope)}", limit, window)
+        rate = limit / window
+        headers = {
+            "RateLimit-Limit": str(limit),
+            "RateLimit-Remaining": str(int(tokens)),
+            "RateLimit-Reset": str(math.ceil((limit - tokens) / rate)),
+            "RateLimit-Policy": f"{limit};w={int(window)}"
+        }
+        if not allowed:
+            RATE_LIMITED.inc(name)
+            headers["Retry-After"] = str(math.ceil((1 - tokens) / rate))
+            response = FastJSONResponse({"detail": "Too many requests"}, status_code=429, headers=headers)
+            await response(scope, receive, send)
+            return
+
+        extra = [(k.lower().encode(), v.encode()) for k, v in headers.items()]
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                message["headers"] = list(message.get("headers", [])) + extra
+            await send(message)
+
+        await self.app(scope, receive, send_wrapper)
+
 # Create the main app
-app = FastAPI()
+app = FastAPI(default_response_class=FastJSONResponse, lifespan=lifespan)
 api_router = APIRouter(prefix="/api")
 
+# WebSocket pub/sub brokers
+# A broker carries (user_id, message) pairs to every worker process; each worker then delivers
+# to the sockets it holds locally. start() registers the delivery callback.
+class PubSubBroker(ABC):
+    @abstractmethod
+    async def start(self, deliver):
+        ...
+
+    @abstractmethod
+    async def publish(self, user_id: str, message: dict):
+        ...
+
+    async def stop(self):
+        pass
+
+class InMemoryBroker(PubSubBroker):
+    # Single-process deployments: publishing is a direct call into the local manager
+    async def start(self, deliver):
+        self.deliver = deliver
+
+    async def publish(self, user_id: str, message: dict):
+        await self.deliver(user_id, message)
+
+class UnixSocketBroker(PubSubBroker):
+    # Multi-worker deployments on one host, no external services: every worker binds a Unix
+    # datagram socket in a shared directory and publishing sends one datagram to each of them.
+    # Sockets left behind by dead workers are unlinked the first time a send to them is refused.
+    # A datagram can be at most the sender's SO_SNDBUF; larger messages reach this worker's sockets only.
+    def __init__(self, directory: str):
+        self.directory = Path(directory)
+        self.path = self.directory / f"{os.getpid()}-{uuid.uuid4().hex[:8]}.sock"
+        self.sock = None
+        self.max_datagram = 0
+
+    async def start(self, deliver):
+        self.deliver = deliver
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.sock.bind(str(self.path))
+        self.sock.setblocking(False)
+        # Every worker runs with the same socket defaults, so this also bounds what peers can send us
+        self.max_datagram = self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF)
+        asyncio.get_running_loop().add_reader(self.sock.fileno(), self._on_readable)
+
+    def _on_readable(self):
+        while True:
+            try:
+                data, _, flags, _ = self.sock.recvmsg(self.max_datagram)
+            except (BlockingIOError, InterruptedError):
+                return
+            if flags & socket.MSG_TRUNC:
+                logger.warning(f"WebSocket broker datagram exceeds {self.max_datagram} bytes, dropping message")
+                continue
+            try:
+                envelope = json.loads(data)
+                user_id, message = envelope["user_id"], envelope["message"]
+            except (ValueError, KeyError, TypeError) as e:
+                logger.warning(f"Malformed WebSocket broker datagram, dropping message: {e}")
+                continue
+            asyncio.ensure_future(self.deliver(user_id, message))
+
+    async def publish(self, user_id: str, message: dict):
+        data = encode_json({"user_id": user_id, "message": message})
+        if len(data) > self.max_datagram:
+            logger.warning(f"WebSocket broker message of {len(data)} bytes exceeds {self.max_datagram}, "
+                           f"delivering on this worker only")
+            await self.deliver(user_id, message)
+            return
+        for peer in self.directory.glob("*.sock"):
+            try:
+                self.sock.sendto(data, str(peer))
+            except (ConnectionRefusedError, FileNotFoundError):
+                peer.unlink(missing_ok=True)
+            except BlockingIOError:
+                logger.warning(f"WebSocket broker peer {peer.name} is backed up, dropping message")
+            except OSError as e:
+                # The write is already stored; a lost real-time frame must not fail the request
+                logger.warning(f"WebSocket broker send to {peer.name} failed, dropping message: {e}")
+
+    async def stop(self):
+        if self.sock is not None:
+            asyncio.get_running_loop().remove_reader(self.sock.fileno())
+            self.sock.close()
+            self.path.unlink(missing_ok=True)
+            self.sock = None
+
+def create_broker() -> PubSubBroker:
+    backend = os.environ.get("WS_BROKER", "memory").lower()
+    if backend == "unix":
+        return UnixSocketBroker(os.environ.get("WS_BROKER_DIR", os.path.join(tempfile.gettempdir(), "medassist-ws")))
+    if backend == "memory":
+        return InMemoryBroker()
+    raise RuntimeError(f"Unknown WS_BROKER backend: {backend}")
+
 # WebSocket connection manager
+# Each socket gets a bounded outbound queue drained by its own writer task, so publishing is a
+# non-blocking enqueue and a slow or dead client never adds latency to the request that sent the
+# message. When a queue is full the slow-consumer policy decides what gives:
+#   drop_oldest - discard the oldest queued frame (the client ends up with the latest state)
+#   drop_newest - discard the frame being enqueued
+#   disconnect  - close the socket; the client reconnects and refetches
+SLOW_CONSUMER_POLICIES = ("drop_oldest", "drop_newest", "disconnect")
+
+class ClientConnection:
+    def __init__(self, websocket: WebSocket, user_id: str, max_queue: int):
+        self.websocket = websocket
+        self.user_id = user_id
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=max_queue)
+        self.dropped = 0
+        self.writer: Optional[asyncio.Task] = None
+
+    async def write_loop(self, on_failure):
+        while True:
+            text = await self.queue.get()
+            started = time.perf_counter()
+            try:
+                await self.websocket.send_text(text)
+            except Exception as e:
+                logger.info(f"WebSocket send failed, dropping connection: {e}")
+                on_failure()
+                return
+            WS_SEND_SECONDS.observe(time.perf_counter() - started)
+
 class ConnectionManager:
-    def __init__(self):
-        self.active_connections: Dict[str, WebSocket] = {}
-        self.user_connections: Dict[str, str] = {}  # user_id -> connection_id
+    def __init__(self, broker: PubSubBroker, max_queue: int = 100, slow_consumer_policy: str = "drop_oldest"):
+        if slow_consumer_policy not in SLOW_CONSUMER_POLICIES:
+            raise RuntimeError(f"Unknown slow consumer policy: {slow_consumer_policy}")
+        self.broker = broker
+        self.max_queue = max_queue
+        self.slow_consumer_policy = slow_consumer_policy
+        self.active_connections: Dict[str, ClientConnection] = {}
+        self.user_connections: Dict[str, Set[str]] = {}  # user_id -> connection_ids (one per tab/device)
+        self.topics: Dict[str, Set[str]] = {}  # topic -> subscribed connection_ids on this worker
+        self.dropped_messages = 0
+        self.slow_consumers_disconnected = 0
+
+    async def start(self):
+        await self.broker.start(self.deliver_local)
+
+    async def stop(self):
+        await self.broker.stop()
+        for connection in self.active_connections.values():
+            if connection.writer is not None:
+                connection.writer.cancel()
 
     async def connect(self, websocket: WebSocket, user_id: str):
         await websocket.accept()
         connection_id = str(uuid.uuid4())
-        self.active_connections[connection_id] = websocket
-        self.user_connections[user_id] = connection_id
+        connection = ClientConnection(websocket, user_id, self.max_queue)
+        connection.writer = asyncio.create_task(
+            connection.write_loop(lambda: self.disconnect(connection_id, user_id))
+        )
+        self.active_connections[connection_id] = connection
+        self.user_connections.setdefault(user_id, set()).add(connection_id)
         return connection_id
 
     def disconnect(self, connection_id: str, user_id: str):
+        connection = self.active_connections.pop(connection_id, None)
+        if connection is not None and connection.writer is not None and \
+                connection.writer is not asyncio.current_task():
+            connection.writer.cancel()
+        connection_ids = self.user_connections.get(user_id)
+        if connection_ids is not None:
+            connection_ids.discard(connection_id)
+            if not connection_ids:
+                del self.user_connections[user_id]
+        for topic in list(self.topics):
+            self.unsubscribe(connection_id, topic)
+
+    def subscribe(self, connection_id: str, topic: str):
         if connection_id in self.active_connections:
-            del self.active_connections[connection_id]
-        if user_id in self.user_connections:
-            del self.user_connections[user_id]
+            self.topics.setdefault(topic, set()).add(connection_id)
+
+    def unsubscribe(self, connection_id: str, topic: str):
+        subscribers = self.topics.get(topic)
+        if subscribers is not None:
+            subscribers.discard(connection_id)
+            if not subscribers:
+                del self.topics[topic]
 
     async def send_personal_message(self, message: dict, user_id: str):
-        if user_id in self.user_connections:
-            connection_id = self.user_connections[user_id]
-            if connection_id in self.active_connections:
-                websocket = self.active_connections[connection_id]
-                await websocket.send_text(json.dumps(message))
+        await self.broker.publish(user_id, message)
 
-manager = ConnectionManager()
+    async def deliver_local(self, user_id: str, message: dict):
+        connection_ids = list(self.user_connections.get(user_id, ()))
+        if not connection_ids:
+            return
+        message = undelivered_frame(message)
+        if message is None:
+            return
+        text = encode_json(message).decode()
+        for connection_id in connection_ids:
+            connection = self.active_connections.get(connection_id)
+            if connection is not None:
+                self._enqueue(connection_id, connection, text)
+
+    def deliver_topic(self, topic: str, message: dict):
+        # Local subscribers only: every worker runs the change feed that produces topic events
+        connection_ids = list(self.topics.get(topic, ()))
+        if not connection_ids:
+            return
+        text = encode_json(message).decode()
+        for connection_id in connection_ids:
+            connection = self.active_connections.get(connection_id)
+            if connection is not None:
+                self._enqueue(connection_id, connection, text)
+
+    def send_to_connection(self, connection_id: str, message: dict):
+        # Direct reply to one socket (e.g. an ack for a frame it sent); never crosses workers
+        connection = self.active_connections.get(connection_id)
+        if connection is not None:
+            self._enqueue(connection_id, connection, encode_json(message).decode())
+
+    def _enqueue(self, connection_id: str, connection: ClientConnection, text: str):
+        if not connection.queue.full():
+            connection.queue.put_nowait(text)
+            return
+
+        connection.dropped += 1
+        self.dropped_messages += 1
+        if self.slow_consumer_policy == "drop_oldest":
+            connection.queue.get_nowait()
+            connection.queue.put_nowait(text)
+        elif self.slow_consumer_policy == "disconnect":
+            self.slow_consumers_disconnected += 1
+            self.disconnect(connection_id, connection.user_id)
+            asyncio.ensure_future(self._close_quietly(connection.websocket))
+
+    async def _close_quietly(self, websocket: WebSocket):
+        try:
+            await websocket.close(code=1013)
+        except Exception:
+            pass
+
+    def stats(self) -> dict:
+        depths = [c.queue.qsize() for c in self.active_connections.values()]
+        return {
+            "connections": len(self.active_connections),
+            "users": len(self.user_connections),
+            "topic_subscriptions": sum(len(ids) for ids in self.topics.values()),
+            "queued_messages": sum(depths),
+            "max_queue_depth": max(depths, default=0),
+            "dropped_messages": self.dropped_messages,
+            "slow_consumers_disconnected": self.slow_consumers_disconnected
+        }
+
+manager = ConnectionManager(
+    create_broker(),
+    max_queue=int(os.environ.get("WS_SEND_QUEUE_SIZE", "100")),
+    slow_consumer_policy=os.environ.get("WS_SLOW_CONSUMER_POLICY", "drop_oldest")
+)
 
 # Models
 class UserRole:
@@ -66,10 +750,10 @@ class UserRole:
     DOCTOR = "doctor"
     PHARMACY = "pharmacy"
 
-class User(BaseModel):
+class UserProfile(BaseModel):
+    # Everything about a user except credentials; what request handlers and the user cache hold
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
     email: str
-    password_hash: str
     full_name: str
     role: str  # patient, doctor, pharmacy
     phone: Optional[str] = None
@@ -77,6 +761,16 @@ class User(BaseModel):
     license_number: Optional[str] = None  # for doctors/pharmacy
     created_at: datetime = Field(default_factory=datetime.utcnow)
     is_active: bool = True
+    token_version: int = 0  # bumped to revoke every token issued so far
+
+class User(UserProfile):
+    password_hash: str
+
+class DoctorCard(BaseModel):
+    id: str
+    full_name: str
+    specialization: Optional[str] = None
+    license_number: Optional[str] = None
 
 class UserRegister(BaseModel):
     email: str
@@ -101,6 +795,16 @@ class Message(BaseModel):
     timestamp: datetime = Field(default_factory=datetime.utcnow)
     message_type: str = "text"  # text, prescription, appointment
 
+MESSAGE_BATCH_MAX = 100
+
+class MessageBatchItem(BaseModel):
+    idempotency_key: str = Field(..., min_length=1, max_length=128)  # generated by the client
+    content: str
+    message_type: str = "text"
+
+class MessageBatch(BaseModel):
+    messages: List[MessageBatchItem] = Field(..., min_length=1, max_length=MESSAGE_BATCH_MAX)
+
 class Chat(BaseModel):
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
     patient_id: str
@@ -111,6 +815,18 @@ class Chat(BaseModel):
     created_at: datetime = Field(default_factory=datetime.utcnow)
     last_message: Optional[str] = None
     last_message_time: Optional[datetime] = None
+    updated_at: Optional[datetime] = None  # set on every write; drives /sync
+
+class InboxEntry(BaseModel):
+    # Per-participant projection of a chat, maintained incrementally on every message
+    user_id: str
+    chat_id: str
+    other_user_id: str
+    other_user_name: str
+    status: str = "active"
+    unread_count: int = 0
+    last_message: Optional[str] = None  # snippet, see INBOX_SNIPPET_LENGTH
+    last_activity: datetime
 
 class Prescription(BaseModel):
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
@@ -122,9 +838,12 @@ class Prescription(BaseModel):
     medications: List[Dict[str, Any]]
     diagnosis: str
     instructions: str
-    status: str = "pending"  # pending, dispensed, collected
+    status: str = "pending"  # pending, claimed, dispensed, collected
     created_at: datetime = Field(default_factory=datetime.utcnow)
+    claimed_at: Optional[datetime] = None
+    lease_expires_at: Optional[datetime] = None  # while claimed, only pharmacy_id may dispense
     dispensed_at: Optional[datetime] = None
+    updated_at: Optional[datetime] = None  # set on every write; the change feed polls on it
 
 class Appointment(BaseModel):
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
@@ -138,6 +857,348 @@ class Appointment(BaseModel):
     notes: Optional[str] = None
     created_at: datetime = Field(default_factory=datetime.utcnow)
 
+class AppointmentCreate(BaseModel):
+    doctor_id: str
+    appointment_date: datetime
+    duration_minutes: int = 30
+    notes: Optional[str] = None
+
+# Field projections
+# Every read names the fields it needs, derived from the model it will be turned into, so Mongo
+# only ships (and we only decode) those. Documents read this way are returned as-is without
+# re-validation: they were written by this service through the same models.
+def projection(model, *extra: str) -> Dict[str, int]:
+    fields = {name: 1 for name in model.model_fields}
+    fields.update({name: 1 for name in extra})
+    fields["_id"] = 0
+    return fields
+
+USER_PROFILE_FIELDS = projection(UserProfile)
+USER_LOGIN_FIELDS = projection(UserProfile, "password_hash")  # the only read that loads a hash
+DOCTOR_CARD_FIELDS = projection(DoctorCard)
+NAME_FIELDS = {"_id": 0, "full_name": 1}
+EXISTS_FIELDS = {"_id": 1}
+CHAT_FIELDS = projection(Chat)
+MESSAGE_FIELDS = projection(Message)
+INBOX_FIELDS = projection(InboxEntry)
+PRESCRIPTION_FIELDS = projection(Prescription)
+APPOINTMENT_FIELDS = projection(Appointment)
+
+# Index management
+# Every index the API relies on is declared here, keyed by collection. Names are explicit
+# so drift (same name, different definition) can be detected on startup.
+REQUIRED_INDEXES: Dict[str, List[Dict[str, Any]]] = {
+    "users": [
+        {"name": "users_id_unique", "keys": [("id", 1)], "unique": True},
+        {"name": "users_email_unique", "keys": [("email", 1)], "unique": True},
+        {"name": "users_role_active", "keys": [("role", 1), ("is_active", 1)]},
+    ],
+    "chats": [
+        {"name": "chats_id_unique", "keys": [("id", 1)], "unique": True},
+        {"name": "chats_patient_doctor_status", "keys": [("patient_id", 1), ("doctor_id", 1), ("status", 1)]},
+        # At most one active chat per patient/doctor pair; create_chat upserts against it
+        {
+            "name": "chats_active_pair_unique",
+            "keys": [("patient_id", 1), ("doctor_id", 1)],
+            "unique": True,
+            "partialFilterExpression": {"status": "active"}
+        },
+        {"name": "chats_doctor_status", "keys": [("doctor_id", 1), ("status", 1)]},
+        {"name": "chats_patient_created", "keys": [("patient_id", 1), ("created_at", 1), ("id", 1)]},
+        {"name": "chats_patient_updated", "keys": [("patient_id", 1), ("updated_at", 1), ("id", 1)]},
+        {"name": "chats_doctor_updated", "keys": [("doctor_id", 1), ("updated_at", 1), ("id", 1)]},
+    ],
+    "messages": [
+        {"name": "messages_chat_timestamp_id", "keys": [("chat_id", 1), ("timestamp", 1), ("id", 1)]},
+        {"name": "messages_content_text", "keys": [("content", "text")], "weights": {"content": 1}},
+        {"name": "messages_timestamp_id", "keys": [("timestamp", 1), ("id", 1)]},
+        {
+            "name": "messages_idempotency_key_unique",
+            "keys": [("chat_id", 1), ("sender_id", 1), ("idempotency_key", 1)],
+            "unique": True,
+            "partialFilterExpression": {"idempotency_key": {"$type": "string"}}
+        },
+    ],
+    "inbox": [
+        {"name": "inbox_user_chat_unique", "keys": [("user_id", 1), ("chat_id", 1)], "unique": True},
+        {"name": "inbox_user_activity", "keys": [("user_id", 1), ("last_activity", -1), ("chat_id", -1)]},
+    ],
+    "appointments": [
+        {"name": "appointments_id_unique", "keys": [("id", 1)], "unique": True},
+        {"name": "appointments_doctor_date", "keys": [("doctor_id", 1), ("appointment_date", 1)]},
+        {"name": "appointments_patient_date", "keys": [("patient_id", 1), ("appointment_date", 1)]},
+    ],
+    "appointment_slots": [
+        {"name": "appointment_slots_doctor_slot_unique", "keys": [("doctor_id", 1), ("slot_start", 1)], "unique": True},
+        {"name": "appointment_slots_appointment", "keys": [("appointment_id", 1)]},
+    ],
+    "prescriptions": [
+        {"name": "prescriptions_id_unique", "keys": [("id", 1)], "unique": True},
+        {"name": "prescriptions_patient", "keys": [("patient_id", 1)]},
+        {"name": "prescriptions_patient_created", "keys": [("patient_id", 1), ("created_at", 1), ("id", 1)]},
+        {"name": "prescriptions_doctor", "keys": [("doctor_id", 1)]},
+        {"name": "prescriptions_status_fifo", "keys": [("status", 1), ("created_at", 1), ("id", 1)]},
+        {"name": "prescriptions_pharmacy_status", "keys": [("pharmacy_id", 1), ("status", 1), ("created_at", 1), ("id", 1)]},
+        {"name": "prescriptions_status_lease", "keys": [("status", 1), ("lease_expires_at", 1)]},
+        {"name": "prescriptions_updated_id", "keys": [("updated_at", 1), ("id", 1)]},
+        {"name": "prescriptions_patient_updated", "keys": [("patient_id", 1), ("updated_at", 1), ("id", 1)]},
+        {"name": "prescriptions_doctor_updated", "keys": [("doctor_id", 1), ("updated_at", 1), ("id", 1)]},
+        # Text keys are listed alphabetically, the order _index_keys reads them back from mongod
+        {"name": "prescriptions_text", "keys": [("diagnosis", "text"), ("instructions", "text"), ("medications.name", "text")],
+         "weights": {"diagnosis": 2, "instructions": 1, "medications.name": 3}},
+    ],
+    "rate_limits": [
+        {"name": "rate_limits_expiry", "keys": [("expires_at", 1)], "expireAfterSeconds": 0},
+    ],
+    "idempotency_keys": [
+        {"name": "idempotency_keys_expiry", "keys": [("expires_at", 1)], "expireAfterSeconds": 0},
+    ],
+}
+
+# Query shapes issued by the endpoints; check_query_plans() asserts none of them is a COLLSCAN
+QUERY_SHAPES: List[Dict[str, Any]] = [
+    {"collection": "users", "filter": {"id": "x"}},
+    {"collection": "users", "filter": {"email": "x"}},
+    {"collection": "users", "filter": {"id": "x", "role": "doctor"}},
+    {"collection": "users", "filter": {"role": "doctor", "is_active": True}},
+    {"collection": "chats", "filter": {"id": "x"}},
+    {"collection": "chats", "filter": {"patient_id": "x", "doctor_id": "x", "status": "active"}},
+    {"collection": "chats", "filter": {"patient_id": "x"}},
+    {"collection": "chats", "filter": {"doctor_id": "x"}},
+    {"collection": "chats", "filter": {"patient_id": "x"}, "sort": [("created_at", 1), ("id", 1)]},
+    {"collection": "messages", "filter": {"chat_id": "x"}, "sort": [("timestamp", -1), ("id", -1)]},
+    {"collection": "messages", "filter": {"chat_id": "x", "sender_id": "x", "idempotency_key": {"$in": ["x"]}}},
+    {"collection": "inbox", "filter": {"user_id": "x"}, "sort": [("last_activity", -1), ("chat_id", -1)]},
+    {"collection": "inbox", "filter": {"user_id": "x", "chat_id": "x"}},
+    {"collection": "appointments", "filter": {"id": "x"}},
+    {"collection": "appointments", "filter": {"doctor_id": "x", "status": "scheduled", "appointment_date": {"$gte": datetime(2000, 1, 1)}}},
+    {"collection": "appointments", "filter": {"patient_id": "x", "appointment_date": {"$gte": datetime(2000, 1, 1)}}, "sort": [("appointment_date", 1)]},
+    {"collection": "appointment_slots", "filter": {"appointment_id": "x"}},
+    {"collection": "prescriptions", "filter": {"id": "x"}},
+    {"collection": "prescriptions", "filter": {"patient_id": "x"}},
+    {"collection": "prescriptions", "filter": {"doctor_id": "x"}},
+    {"collection": "prescriptions", "filter": {"patient_id": "x", "doctor_id": "x"}},
+    {"collection": "prescriptions", "filter": {"patient_id": "x"}, "sort": [("created_at", 1), ("id", 1)]},
+    {"collection": "prescriptions", "filter": {"$or": [{"status": "pending"}, {"pharmacy_id": "x"}]}, "sort": [("created_at", 1)]},
+    {"collection": "prescriptions", "filter": {"status": "pending"}, "sort": [("created_at", 1), ("id", 1)]},
+    {"collection": "prescriptions", "filter": {"pharmacy_id": "x", "status": "claimed"}, "sort": [("created_at", 1), ("id", 1)]},
+    {"collection": "prescriptions", "filter": {"status": "claimed", "lease_expires_at": {"$lt": datetime(2000, 1, 1)}}},
+    {"collection": "prescriptions", "filter": {"$or": [{"status": "pending"}, {"status": "claimed", "lease_expires_at": {"$lt": datetime(2000, 1, 1)}}]}, "sort": [("created_at", 1), ("id", 1)]},
+    {"collection": "messages", "filter": {"$text": {"$search": "x"}, "chat_id": {"$in": ["x"]}}},
+    {"collection": "messages", "filter": {"chat_id": {"$in": ["x"]}, "timestamp": {"$lte": datetime(2000, 1, 1)}}, "sort": [("timestamp", 1), ("id", 1)]},
+    {"collection": "chats", "filter": {"patient_id": "x", "updated_at": {"$lte": datetime(2000, 1, 1)}}, "sort": [("updated_at", 1), ("id", 1)]},
+    {"collection": "chats", "filter": {"doctor_id": "x", "updated_at": {"$lte": datetime(2000, 1, 1)}}, "sort": [("updated_at", 1), ("id", 1)]},
+    {"collection": "prescriptions", "filter": {"patient_id": "x", "updated_at": {"$lte": datetime(2000, 1, 1)}}, "sort": [("updated_at", 1), ("id", 1)]},
+    {"collection": "prescriptions", "filter": {"doctor_id": "x", "updated_at": {"$lte": datetime(2000, 1, 1)}}, "sort": [("updated_at", 1), ("id", 1)]},
+    {"collection": "messages", "filter": {"timestamp": {"$lte": datetime(2000, 1, 1), "$gt": datetime(2000, 1, 1)}}, "sort": [("timestamp", 1), ("id", 1)]},
+    {"collection": "prescriptions", "filter": {"updated_at": {"$lte": datetime(2000, 1, 1), "$gt": datetime(2000, 1, 1)}}, "sort": [("updated_at", 1), ("id", 1)]},
+    {"collection": "prescriptions", "filter": {"$text": {"$search": "x"}, "patient_id": "x"}},
+]
+
+# Options compared for drift; anything else mongod adds (v, ns, ...) is ignored
+INDEX_OPTIONS = ("unique", "partialFilterExpression", "expireAfterSeconds", "weights")
+
+def _index_options(definition: dict) -> dict:
+    options = {k: definition[k] for k in INDEX_OPTIONS if k in definition}
+    if not options.get("unique"):
+        options.pop("unique", None)
+    if "partialFilterExpression" in options:
+        options["partialFilterExpression"] = dict(options["partialFilterExpression"])
+    if "weights" in options:
+        options["weights"] = dict(options["weights"])
+    return options
+
+def _index_keys(definition: dict) -> list:
+    # mongod reports text indexes as _fts/_ftsx with the indexed fields in the weights document
+    keys = []
+    for field, kind in definition["key"]:
+        if field == "_fts":
+            keys.extend((name, "text") for name in sorted(definition.get("weights", {})))
+        elif field != "_ftsx":
+            keys.append((field, kind))
+    return keys
+
+async def ensure_indexes(database):
+    for collection_name, specs in REQUIRED_INDEXES.items():
+        collection = database[collection_name]
+        existing = await collection.index_information()
+        declared = {spec["name"] for spec in specs}
+
+        for spec in specs:
+            current = existing.get(spec["name"])
+            expected_options = _index_options(spec)
+            if current is None:
+                try:
+                    await collection.create_index(spec["keys"], name=spec["name"], **expected_options)
+                    logger.info(f"Created index {collection_name}.{spec['name']}")
+                except OperationFailure as e:
+                    if spec.get("unique"):
+                        # Writes depend on these for correctness (double bookings, duplicate chats), so
+                        # the worker must not start without them
+                        raise RuntimeError(f"Failed to create unique index {collection_name}.{spec['name']}: {e}") from e
+                    logger.error(f"Failed to create index {collection_name}.{spec['name']}: {e}")
+                continue
+
+            current_options = _index_options(current)
+            if "weights" not in current_options:
+                # Servers that do not report text weights (mongomock) are compared on keys only
+                expected_options.pop("weights", None)
+            if [tuple(k) for k in _index_keys(current)] != list(spec["keys"]) or \
+                    current_options != expected_options:
+                logger.warning(
+                    f"Index drift on {collection_name}.{spec['name']}: "
+                    f"found {current}, expected keys={spec['keys']} options={expected_options}"
+                )
+
+        for name in existing:
+            if name != "_id_" and name not in declared:
+                logger.warning(f"Undeclared index {collection_name}.{name}")
+
+def _plan_stages(plan: dict):
+    yield plan.get("stage")
+    for child in plan.get("inputStages", []):
+        yield from _plan_stages(child)
+    if "inputStage" in plan:
+        yield from _plan_stages(plan["inputStage"])
+    # Find plans on 5.0+ may be wrapped in a slot-based execution tree
+    if "queryPlan" in plan:
+        yield from _plan_stages(plan["queryPlan"])
+
+def _has_usable_index(query: dict, indexes: List[list]) -> bool:
+    # Planner stand-in for servers without explain() (mongomock): an index is usable when the filter
+    # constrains its leading key, and an $or needs one for every branch unless the rest of the filter has one
+    if "$or" in query:
+        rest = {k: v for k, v in query.items() if k != "$or"}
+        if rest and _has_usable_index(rest, indexes):
+            return True
+        return all(_has_usable_index(branch, indexes) for branch in query["$or"])
+    for keys in indexes:
+        field, kind = keys[0]
+        if (kind == "text" and "$text" in query) or (kind != "text" and field in query):
+            return True
+    return False
+
+async def check_query_plans(database) -> List[str]:
+    # Uses the server's own plans where cursors implement explain() (mongod); otherwise (mongomock)
+    # checks each filter against the declared indexes
+    failures = []
+    indexes: Dict[str, List[list]] = {}
+    for shape in QUERY_SHAPES:
+        collection = database[shape["collection"]]
+        cursor = collection.find(shape["filter"])
+        if shape.get("sort"):
+            cursor = cursor.sort(shape["sort"])
+        if hasattr(cursor, "explain"):
+            plan = await cursor.explain()
+            winning_plan = plan.get("queryPlanner", {}).get("winningPlan", {})
+            collscan = "COLLSCAN" in _plan_stages(winning_plan)
+        else:
+            if shape["collection"] not in indexes:
+                info = await collection.index_information()
+                indexes[shape["collection"]] = [_index_keys(definition) for name, definition in info.items() if name != "_id_"]
+            collscan = not _has_usable_index(shape["filter"], indexes[shape["collection"]])
+        if collscan:
+            failures.append(f"{shape['collection']} {shape['filter']}")
+    return failures
+
+# Keyset paging
+# Cursors are opaque base64 of "<iso timestamp>|<id>"; paging compares the (timestamp, id) tuple
+# so rows sharing a timestamp are never skipped or repeated.
+MESSAGE_PAGE_DEFAULT = 50
+MESSAGE_PAGE_MAX = 200
+INBOX_PAGE_DEFAULT = 50
+INBOX_PAGE_MAX = 200
+DOCTOR_PAGE_DEFAULT = 50
+DOCTOR_PAGE_MAX = 200
+QUEUE_PAGE_DEFAULT = 50
+QUEUE_PAGE_MAX = 200
+APPOINTMENT_PAGE_DEFAULT = 100
+APPOINTMENT_PAGE_MAX = 500
+
+def encode_cursor(timestamp: datetime, key: str) -> str:
+    raw = f"{timestamp.isoformat()}|{key}"
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+def decode_cursor(cursor: str):
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        timestamp, key = base64.urlsafe_b64decode(padded.encode()).decode().split("|", 1)
+        return datetime.fromisoformat(timestamp), key
+    except (ValueError, UnicodeDecodeError, TypeError):  # TypeError: a non-string position from a decoded token
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+def keyset_filter(base: dict, cursor: str, op: str, time_field: str, key_field: str) -> dict:
+    timestamp, key = decode_cursor(cursor)
+    return {
+        **base,
+        "$or": [
+            {time_field: {op: timestamp}},
+            {time_field: timestamp, key_field: {op: key}}
+        ]
+    }
+
+def encode_message_cursor(msg: dict) -> str:
+    return encode_cursor(msg["timestamp"], msg["id"])
+
+def message_keyset_filter(chat_id: str, cursor: str, op: str) -> dict:
+    return keyset_filter({"chat_id": chat_id}, cursor, op, "timestamp", "id")
+
+# Caches
+class TTLCache:
+    # Bounded LRU whose entries also expire after ttl_seconds; each instance keeps its own counters
+    def __init__(self, max_size: int, ttl_seconds: float):
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self.entries: "OrderedDict[str, tuple]" = OrderedDict()  # key -> (expires_at, value)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: str):
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        expires_at, value = entry
+        if expires_at <= time.monotonic():
+            del self.entries[key]
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key: str, value):
+        if self.max_size <= 0:
+            return
+        self.entries[key] = (time.monotonic() + self.ttl_seconds, value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, key: str):
+        self.entries.pop(key, None)
+
+    def clear(self):
+        self.entries.clear()
+
+    def stats(self) -> dict:
+        return {
+            "size": len(self.entries),
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions
+        }
+
+# Users resolved by get_current_user. Anything that writes to a user document must go through
+# user_changed() so stale roles/profile data are never served.
+user_cache = TTLCache(
+    max_size=int(os.environ.get("USER_CACHE_SIZE", "1024")),
+    ttl_seconds=float(os.environ.get("USER_CACHE_TTL_SECONDS", "60"))
+)
+
 # Utility functions
 def hash_password(password: str) -> str:
     return pwd_context.hash(password)
@@ -145,40 +1206,271 @@ def hash_password(password: str) -> str:
 def verify_password(plain_password: str, hashed_password: str) -> bool:
     return pwd_context.verify(plain_password, hashed_password)
 
-def create_access_token(data: dict):
+# Password hashing pool
+# bcrypt is CPU-bound (tens to hundreds of ms per call) and releases the GIL, so it runs in a
+# dedicated thread pool instead of on the event loop. Once max_pending jobs are queued or running,
+# new requests are rejected with 503 + Retry-After rather than piling up behind the pool.
+class PasswordHasher:
+    def __init__(self, workers: int, max_pending: int, retry_after_seconds: int):
+        self.workers = workers
+        self.max_pending = max_pending
+        self.retry_after_seconds = retry_after_seconds
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="password-hash")
+        self.pending = 0
+        self.rejected = 0
+
+    async def run(self, func, *args):
+        if self.pending >= self.max_pending:
+            self.rejected += 1
+            PASSWORD_HASH_REJECTED.inc()
+            raise HTTPException(
+                status_code=503,
+                detail="Authentication is busy, please retry shortly",
+                headers={"Retry-After": str(self.retry_after_seconds)}
+            )
+
+        def job(enqueued_at: float):
+            started_at = time.perf_counter()
+            result = func(*args)
+            return result, started_at - enqueued_at, time.perf_counter() - started_at
+
+        self.pending += 1
+        try:
+            loop = asyncio.get_running_loop()
+            result, waited, took = await loop.run_in_executor(self.executor, job, time.perf_counter())
+        finally:
+            self.pending -= 1
+        PASSWORD_QUEUE_WAIT_SECONDS.observe(waited)
+        PASSWORD_HASH_SECONDS.observe(took)
+        return result
+
+    async def hash(self, password: str) -> str:
+        return await self.run(hash_password, password)
+
+    async def verify(self, plain_password: str, hashed_password: str) -> bool:
+        return await self.run(verify_password, plain_password, hashed_password)
+
+    def stats(self) -> dict:
+        return {
+            "workers": self.workers,
+            "max_pending": self.max_pending,
+            "pending": self.pending,
+            "rejected": self.rejected,
+            "queue_wait": PASSWORD_QUEUE_WAIT_SECONDS.snapshot(),
+            "hash_time": PASSWORD_HASH_SECONDS.snapshot()
+        }
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+password_hasher = PasswordHasher(
+    workers=int(os.environ.get("PASSWORD_HASH_WORKERS", "4")),
+    max_pending=int(os.environ.get("PASSWORD_HASH_MAX_PENDING", "64")),
+    retry_after_seconds=int(os.environ.get("PASSWORD_HASH_RETRY_AFTER_SECONDS", "1"))
+)
+
+# Tokens
+# Access tokens are short-lived and carry everything role-gated endpoints need (sub, role,
+# full_name, ver), so get_token_user authorizes without touching the DB. Refresh tokens are
+# exchanged at /auth/refresh, which checks ver against users.token_version; /auth/revoke bumps that
+# counter. Revocation reaches access tokens through token_versions on this worker immediately, and
+# everywhere else once they expire (ACCESS_TOKEN_MINUTES).
+ACCESS_TOKEN_MINUTES = int(os.environ.get("ACCESS_TOKEN_MINUTES", "15"))
+REFRESH_TOKEN_DAYS = int(os.environ.get("REFRESH_TOKEN_DAYS", "7"))
+
+class AuthClaims(BaseModel):
+    id: str
+    role: str
+    full_name: str
+    token_version: int = 0
+
+token_versions = TTLCache(max_size=int(os.environ.get("USER_CACHE_SIZE", "1024")), ttl_seconds=ACCESS_TOKEN_MINUTES * 60)
+
+def create_access_token(data: dict, token_type: str = "access", lifetime: timedelta = None):
     to_encode = data.copy()
-    expire = datetime.utcnow() + timedelta(hours=24)
-    to_encode.update({"exp": expire})
+    expire = datetime.utcnow() + (lifetime or timedelta(minutes=ACCESS_TOKEN_MINUTES))
+    to_encode.update({"exp": expire, "typ": token_type})
     encoded_jwt = jwt.encode(to_encode, JWT_SECRET, algorithm=ALGORITHM)
     return encoded_jwt
 
-async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)):
+def issue_tokens(user) -> dict:
+    claims = {"sub": user.id, "role": user.role, "full_name": user.full_name, "ver": user.token_version}
+    return {
+        "access_token": create_access_token(claims),
+        "refresh_token": create_access_token(
+            {"sub": user.id, "ver": user.token_version}, "refresh", timedelta(days=REFRESH_TOKEN_DAYS)
+        ),
+        "token_type": "bearer",
+        "expires_in": ACCESS_TOKEN_MINUTES * 60
+    }
+
+def decode_token(token: str, token_type: str = "access") -> dict:
     try:
-        payload = jwt.decode(credentials.credentials, JWT_SECRET, algorithms=[ALGORITHM])
-        user_id: str = payload.get("sub")
-        if user_id is None:
-            raise HTTPException(status_code=401, detail="Invalid authentication credentials")
-        
-        user = await db.users.find_one({"id": user_id})
-        if user is None:
-            raise HTTPException(status_code=401, detail="User not found")
-        
-        return User(**user)
+        payload = jwt.decode(token, JWT_SECRET, algorithms=[ALGORITHM])
     except jwt.PyJWTError:
         raise HTTPException(status_code=401, detail="Invalid authentication credentials")
+    # Tokens issued before refresh tokens existed have no typ and are access tokens
+    if payload.get("sub") is None or payload.get("typ", "access") != token_type:
+        raise HTTPException(status_code=401, detail="Invalid authentication credentials")
+    return payload
+
+def check_token_version(user_id: str, version: int):
+    current = token_versions.get(user_id)
+    if current is not None and version < current:
+        raise HTTPException(status_code=401, detail="Token has been revoked")
+
+async def load_user(user_id: str) -> UserProfile:
+    cached_user = user_cache.get(user_id)
+    if cached_user is not None:
+        return cached_user
+    
+    user = await db.users.find_one({"id": user_id}, USER_PROFILE_FIELDS)
+    if user is None:
+        raise HTTPException(status_code=401, detail="User not found")
+    
+    user = UserProfile(**user)
+    user_cache.set(user_id, user)
+    return user
+
+async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)):
+    # Full profile, checked against the stored token_version; for endpoints that need more than claims
+    payload = decode_token(credentials.credentials)
+    user = await load_user(payload["sub"])
+    if payload.get("ver", 0) < user.token_version:
+        raise HTTPException(status_code=401, detail="Token has been revoked")
+    return user
+
+async def resolve_claims(token: str) -> AuthClaims:
+    payload = decode_token(token)
+    version = payload.get("ver", 0)
+    check_token_version(payload["sub"], version)
+    if "full_name" not in payload:
+        # Legacy token without profile claims: fall back to the DB-backed path once per request
+        user = await load_user(payload["sub"])
+        return AuthClaims(id=user.id, role=user.role, full_name=user.full_name, token_version=version)
+    return AuthClaims(id=payload["sub"], role=payload["role"], full_name=payload["full_name"], token_version=version)
+
+async def get_token_user(credentials: HTTPAuthorizationCredentials = Depends(security)) -> AuthClaims:
+    return await resolve_claims(credentials.credentials)
+
+async def get_participant_chat(chat_id: str, user: AuthClaims) -> dict:
+    chat = await db.chats.find_one({"id": chat_id}, CHAT_FIELDS)
+    if not chat:
+        raise HTTPException(status_code=404, detail="Chat not found")
+    
+    if user.id not in [chat["patient_id"], chat["doctor_id"]]:
+        raise HTTPException(status_code=403, detail="Not authorized")
+    return chat
+
+def other_participant(chat: dict, user_id: str) -> str:
+    return chat["doctor_id"] if user_id == chat["patient_id"] else chat["patient_id"]
+
+INBOX_SNIPPET_LENGTH = 120
+
+def inbox_entry(chat: dict, user_id: str) -> InboxEntry:
+    if user_id == chat["patient_id"]:
+        other_user_id, other_user_name = chat["doctor_id"], chat["doctor_name"]
+    else:
+        other_user_id, other_user_name = chat["patient_id"], chat["patient_name"]
+    return InboxEntry(
+        user_id=user_id,
+        chat_id=chat["id"],
+        other_user_id=other_user_id,
+        other_user_name=other_user_name,
+        status=chat.get("status", "active"),
+        last_message=(chat.get("last_message") or "")[:INBOX_SNIPPET_LENGTH] or None,
+        last_activity=chat.get("last_message_time") or chat["created_at"]
+    )
+
+async def create_inbox_entries(chats: List[dict]):
+    operations = [
+        UpdateOne(
+            {"user_id": user_id, "chat_id": chat["id"]},
+            {"$setOnInsert": inbox_entry(chat, user_id).dict()},
+            upsert=True
+        )
+        for chat in chats
+        for user_id in (chat["patient_id"], chat["doctor_id"])
+    ]
+    if operations:
+        await db.inbox.bulk_write(operations, ordered=False)
+
+async def record_inbox_activity(chat: dict, sender_id: str, last_message: str, timestamp: datetime, count: int = 1):
+    # One round-trip: the recipient's unread counter goes up, both sides get the new snippet/activity.
+    # Upserts also cover chats created before the inbox existed.
+    recipient_id = other_participant(chat, sender_id)
+    activity = {"last_message": last_message[:INBOX_SNIPPET_LENGTH], "last_activity": timestamp}
+
+    def on_insert(user_id: str) -> dict:
+        entry = inbox_entry(chat, user_id).dict()
+        return {k: v for k, v in entry.items() if k not in activity and k != "unread_count"}
+
+    await db.inbox.bulk_write([
+        UpdateOne(
+            {"user_id": recipient_id, "chat_id": chat["id"]},
+            {"$inc": {"unread_count": count}, "$set": activity, "$setOnInsert": on_insert(recipient_id)},
+            upsert=True
+        ),
+        UpdateOne(
+            {"user_id": sender_id, "chat_id": chat["id"]},
+            {"$set": activity, "$setOnInsert": {**on_insert(sender_id), "unread_count": 0}},
+            upsert=True
+        )
+    ], ordered=False)
+
+async def mark_chat_read(user_id: str, chat_id: str):
+    await db.inbox.update_one({"user_id": user_id, "chat_id": chat_id}, {"$set": {"unread_count": 0}})
+
+async def post_message(chat: dict, sender: AuthClaims, content: str, message_type: str = "text") -> Message:
+    # Shared by the REST and WebSocket send paths: persist, bump the chat, fan out
+    message = Message(
+        chat_id=chat["id"],
+        sender_id=sender.id,
+        sender_name=sender.full_name,
+        sender_role=sender.role,
+        content=content,
+        message_type=message_type
+    )
+    
+    await db.messages.insert_one(message.dict())
+    if search_index is not None:
+        search_index.add_message(chat, message.dict())
+    
+    # Update chat last message and both inbox entries
+    await asyncio.gather(
+        db.chats.update_one(
+            {"id": chat["id"]},
+            {
+                "$set": {
+                    "last_message": content,
+                    "last_message_time": message.timestamp,
+                    "updated_at": message.timestamp
+                }
+            }
+        ),
+        record_inbox_activity(chat, sender.id, content, message.timestamp)
+    )
+    
+    # Send to other user via WebSocket right away; the change feed's copy is dropped on arrival
+    await manager.send_personal_message({
+        "type": "new_message",
+        "message": message.dict()
+    }, other_participant(chat, sender.id))
+    
+    return message
 
 # Authentication endpoints
 @api_router.post("/auth/register")
 async def register(user_data: UserRegister):
     # Check if user exists
-    existing_user = await db.users.find_one({"email": user_data.email})
+    existing_user = await db.users.find_one({"email": user_data.email}, EXISTS_FIELDS)
     if existing_user:
         raise HTTPException(status_code=400, detail="Email already registered")
     
     # Create user
     user = User(
         email=user_data.email,
-        password_hash=hash_password(user_data.password),
+        password_hash=await password_hasher.hash(user_data.password),
         full_name=user_data.full_name,
         role=user_data.role,
         phone=user_data.phone,
@@ -186,14 +1478,15 @@ async def register(user_data: UserRegister):
         license_number=user_data.license_number
     )
     
-    await db.users.insert_one(user.dict())
-    
-    # Create token
-    access_token = create_access_token(data={"sub": user.id, "role": user.role})
+    try:
+        await db.users.insert_one(user.dict())
+    except DuplicateKeyError:
+        # A concurrent registration won the race to users_email_unique
+        raise HTTPException(status_code=400, detail="Email already registered")
+    user_changed(user.id, user.role)
     
     return {
-        "access_token": access_token,
-        "token_type": "bearer",
+        **issue_tokens(user),
         "user": {
             "id": user.id,
             "email": user.email,
@@ -206,28 +1499,147 @@ async def register(user_data: UserRegister):
 
 @api_router.post("/auth/login")
 async def login(login_data: UserLogin):
-    user = await db.users.find_one({"email": login_data.email})
-    if not user or not verify_password(login_data.password, user["password_hash"]):
+    user = await db.users.find_one({"email": login_data.email}, USER_LOGIN_FIELDS)
+    if not user or not await password_hasher.verify(login_data.password, user["password_hash"]):
         raise HTTPException(status_code=401, detail="Incorrect email or password")
     
-    access_token = create_access_token(data={"sub": user["id"], "role": user["role"]})
-    
+    user = UserProfile(**user)
     return {
-        "access_token": access_token,
-        "token_type": "bearer",
+        **issue_tokens(user),
         "user": {
-            "id": user["id"],
-            "email": user["email"],
-            "full_name": user["full_name"],
-            "role": user["role"],
-            "specialization": user.get("specialization"),
-            "license_number": user.get("license_number")
+            "id": user.id,
+            "email": user.email,
+            "full_name": user.full_name,
+            "role": user.role,
+            "specialization": user.specialization,
+            "license_number": user.license_number
         }
     }
 
+class RefreshRequest(BaseModel):
+    refresh_token: str
+
+@api_router.post("/auth/refresh")
+async def refresh_tokens(body: RefreshRequest):
+    # Always reads the stored token_version, so a revoked refresh token is rejected on every worker
+    payload = decode_token(body.refresh_token, "refresh")
+    user = await db.users.find_one({"id": payload["sub"], "is_active": True}, USER_PROFILE_FIELDS)
+    if user is None:
+        raise HTTPException(status_code=401, detail="User not found")
+    user = UserProfile(**user)
+    if payload.get("ver", 0) != user.token_version:
+        raise HTTPException(status_code=401, detail="Token has been revoked")
+    token_versions.set(user.id, user.token_version)
+    return issue_tokens(user)
+
+@api_router.post("/auth/revoke")
+async def revoke_tokens(current_user: UserProfile = Depends(get_current_user)):
+    # Signs out every session of this user; the caller gets a fresh token pair
+    user = await db.users.find_one_and_update(
+        {"id": current_user.id},
+        {"$inc": {"token_version": 1}},
+        projection=USER_PROFILE_FIELDS,
+        return_document=ReturnDocument.AFTER
+    )
+    if user is None:
+        raise HTTPException(status_code=401, detail="User not found")
+    user = UserProfile(**user)
+    token_versions.set(user.id, user.token_version)
+    user_changed(user.id, user.role)
+    return issue_tokens(user)
+
+# Doctor directory
+# Active doctors are served from an in-memory snapshot sorted by (lowercased name, id), with a
+# per-specialization index, so name-prefix search and paging are a bisect plus a slice. The snapshot
+# is rebuilt after a doctor registers or changes (invalidate()), and at least every
+# DOCTOR_DIRECTORY_TTL_SECONDS so changes made through other workers are picked up.
+DOCTOR_DIRECTORY_TTL_SECONDS = float(os.environ.get("DOCTOR_DIRECTORY_TTL_SECONDS", "60"))
+
+class DoctorSnapshot:
+    def __init__(self, doctors: List[dict]):
+        cards = [
+            {
+                "id": doc["id"],
+                "full_name": doc["full_name"],
+                "specialization": doc.get("specialization", "General Practice"),
+                "license_number": doc.get("license_number")
+            }
+            for doc in doctors
+        ]
+        cards.sort(key=lambda card: (card["full_name"].lower(), card["id"]))
+        self.loaded_at = time.monotonic()
+        self.version = hashlib.sha1(encode_json(cards)).hexdigest()[:12]
+        self.all = self._indexed(cards)
+        by_specialization: Dict[str, List[dict]] = {}
+        for card in cards:
+            by_specialization.setdefault((card["specialization"] or "").lower(), []).append(card)
+        self.by_specialization = {k: self._indexed(v) for k, v in by_specialization.items()}
+
+    @staticmethod
+    def _indexed(cards: List[dict]):
+        return [(card["full_name"].lower(), card["id"]) for card in cards], cards
+
+    def search(self, specialization: Optional[str], prefix: Optional[str], after: Optional[str], limit: int):
+        keys, cards = self.all if specialization is None else \
+            self.by_specialization.get(specialization.lower(), ([], []))
+        start = 0
+        if prefix:
+            prefix = prefix.lower()
+            start = bisect_left(keys, (prefix,))
+        if after:
+            start = max(start, bisect_right(keys, decode_directory_cursor(after)))
+
+        page = []
+        for i in range(start, min(start + limit + 1, len(cards))):
+            if prefix and not keys[i][0].startswith(prefix):
+                break
+            page.append(cards[i])
+        has_more = len(page) > limit
+        page = page[:limit]
+        next_cursor = encode_directory_cursor(keys[start + limit - 1]) if has_more else None
+        return page, next_cursor
+
+def encode_directory_cursor(key: tuple) -> str:
+    return base64.urlsafe_b64encode(encode_json(list(key))).decode().rstrip("=")
+
+def decode_directory_cursor(cursor: str) -> tuple:
+    try:
+        name, doctor_id = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+        return str(name), str(doctor_id)
+    except (ValueError, TypeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+class DoctorDirectory:
+    def __init__(self):
+        self.snapshot: Optional[DoctorSnapshot] = None
+        self.lock = asyncio.Lock()
+
+    def invalidate(self):
+        self.snapshot = None
+
+    async def get(self) -> DoctorSnapshot:
+        snapshot = self.snapshot
+        if snapshot is not None and time.monotonic() - snapshot.loaded_at < DOCTOR_DIRECTORY_TTL_SECONDS:
+            return snapshot
+        async with self.lock:
+            # Another request may have rebuilt it while we waited
+            if self.snapshot is not snapshot and self.snapshot is not None:
+                return self.snapshot
+            doctors = await db.users.find({"role": "doctor", "is_active": True}, DOCTOR_CARD_FIELDS).to_list(None)
+            self.snapshot = DoctorSnapshot(doctors)
+            return self.snapshot
+
+doctor_directory = DoctorDirectory()
+
+def user_changed(user_id: str, role: str):
+    # Call after any write to a user document
+    user_cache.invalidate(user_id)
+    if role == UserRole.DOCTOR:
+        doctor_directory.invalidate()
+
 # User endpoints
 @api_router.get("/users/me")
-async def get_current_user_info(current_user: User = Depends(get_current_user)):
+async def get_current_user_info(current_user: UserProfile = Depends(get_current_user)):
     return {
         "id": current_user.id,
         "email": current_user.email,
@@ -238,111 +1650,331 @@ async def get_current_user_info(current_user: User = Depends(get_current_user)):
     }
 
 @api_router.get("/users/doctors")
-async def get_doctors():
-    doctors = await db.users.find({"role": "doctor", "is_active": True}).to_list(100)
-    return [
-        {
-            "id": doc["id"],
-            "full_name": doc["full_name"],
-            "specialization": doc.get("specialization", "General Practice"),
-            "license_number": doc.get("license_number")
-        }
-        for doc in doctors
-    ]
+async def get_doctors(
+    request: Request,
+    specialization: Optional[str] = None,
+    q: Optional[str] = None,
+    after: Optional[str] = None,
+    limit: int = Query(DOCTOR_PAGE_DEFAULT, ge=1, le=DOCTOR_PAGE_MAX)
+):
+    snapshot = await doctor_directory.get()
+    # The snapshot version plus the query fully determine the page, so a matching
+    # If-None-Match is answered before any filtering or serialization
+    query_key = hashlib.sha1(f"{specialization}|{q}|{after}|{limit}".encode()).hexdigest()[:12]
+    etag = f'W/"{snapshot.version}-{query_key}"'
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if etag in request.headers.get("if-none-match", ""):
+        return Response(status_code=304, headers=headers)
 
-# Chat endpoints
-@api_router.post("/chats")
-async def create_chat(doctor_id: str, current_user: User = Depends(get_current_user)):
+    doctors, next_cursor = snapshot.search(specialization, q, after, limit)
+    return FastJSONResponse({"doctors": doctors, "next_cursor": next_cursor}, headers=headers)
+
+# Idempotency keys
+# Write endpoints accept an Idempotency-Key header. The first request with a key claims it in
+# idempotency_keys (insert on a unique _id scoped to caller and route), runs, and stores its
+# response; retries with the same key and request replay that response instead of writing again.
+# Completed responses are also kept in a per-worker LRU so most retries never reach MongoDB.
+# Records expire after IDEMPOTENCY_TTL_SECONDS through a TTL index. Failed requests release
+# their key so the client can retry them.
+IDEMPOTENCY_TTL_SECONDS = int(os.environ.get("IDEMPOTENCY_TTL_SECONDS", "86400"))
+IDEMPOTENCY_LOCK_SECONDS = 60  # an in-progress claim left by a crashed worker expires after this
+IDEMPOTENCY_KEY_MAX_LENGTH = 128
+
+idempotency_cache = TTLCache(
+    max_size=int(os.environ.get("IDEMPOTENCY_CACHE_SIZE", "4096")),
+    ttl_seconds=min(IDEMPOTENCY_TTL_SECONDS, 3600)
+)
+
+def replay_response(stored: dict) -> Response:
+    return Response(
+        content=stored["body"],
+        status_code=stored["status_code"],
+        media_type="application/json",
+        headers={"Idempotent-Replayed": "true"}
+    )
+
+def check_fingerprint(stored: dict, fingerprint: str):
+    if stored["fingerprint"] != fingerprint:
+        raise HTTPException(status_code=422, detail="Idempotency-Key was already used for a different request")
+
+async def run_idempotent(request: Request, user: AuthClaims, handler) -> Any:
+    key = request.headers.get("Idempotency-Key")
+    if key is None:
+        return await handler()
+    if not key or len(key) > IDEMPOTENCY_KEY_MAX_LENGTH:
+        raise HTTPException(status_code=400, detail=f"Idempotency-Key must be 1-{IDEMPOTENCY_KEY_MAX_LENGTH} characters")
+
+    # The key is scoped to the route template; the concrete path (chat_id etc.) is part of the
+    # fingerprint, so reusing a key against another resource is a 422 rather than a replay
+    record_id = f"{user.id}|{request.method} {request.scope['route'].path}|{key}"
+    digest = hashlib.sha256(request.url.path.encode())
+    digest.update(b"?" + request.url.query.encode() + b"\n")
+    digest.update(await request.body())
+    fingerprint = digest.hexdigest()
+
+    cached = idempotency_cache.get(record_id)
+    if cached is not None:
+        check_fingerprint(cached, fingerprint)
+        return replay_response(cached)
+
+    now = datetime.utcnow()
+    try:
+        await db.idempotency_keys.insert_one({
+            "_id": record_id,
+            "fingerprint": fingerprint,
+            "state": "in_progress",
+            "created_at": now,
+            "expires_at": now + timedelta(seconds=IDEMPOTENCY_LOCK_SECONDS)
+        })
+    except DuplicateKeyError:
+        stored = await db.idempotency_keys.find_one({"_id": record_id})
+        if stored is None:  # expired between the insert and the read
+            raise HTTPException(status_code=409, detail="Idempotency-Key conflict, retry", headers={"Retry-After": "1"})
+        check_fingerprint(stored, fingerprint)
+        if stored["state"] != "done":
+            raise HTTPException(status_code=409, detail="A request with this Idempotency-Key is still in progress",
+                                headers={"Retry-After": "1"})
+        idempotency_cache.set(record_id, stored)
+        return replay_response(stored)
+
+    try:
+        result = await handler()
+    except Exception:
+        await db.idempotency_keys.delete_one({"_id": record_id, "state": "in_progress"})
+        raise
+
+    stored = {"fingerprint": fingerprint, "status_code": 200, "body": encode_json(result)}
+    await db.idempotency_keys.update_one(
+        {"_id": record_id},
+        {"$set": {**stored, "state": "done", "expires_at": datetime.utcnow() + timedelta(seconds=IDEMPOTENCY_TTL_SECONDS)}}
+    )
+    idempotency_cache.set(record_id, stored)
+    return Response(content=stored["body"], media_type="application/json")
+
+# Chat endpoints
+@api_router.post("/chats")
+async def create_chat(doctor_id: str, request: Request, current_user: AuthClaims = Depends(get_token_user)):
+    return await run_idempotent(request, current_user, lambda: open_chat(doctor_id, current_user))
+
+async def open_chat(doctor_id: str, current_user: AuthClaims) -> Chat:
     if current_user.role != "patient":
         raise HTTPException(status_code=403, detail="Only patients can start chats")
     
-    doctor = await db.users.find_one({"id": doctor_id, "role": "doctor"})
+    doctor = await db.users.find_one({"id": doctor_id, "role": "doctor"}, NAME_FIELDS)
     if not doctor:
         raise HTTPException(status_code=404, detail="Doctor not found")
     
-    # Check if chat already exists
-    existing_chat = await db.chats.find_one({
-        "patient_id": current_user.id,
-        "doctor_id": doctor_id,
-        "status": "active"
-    })
-    
-    if existing_chat:
-        return Chat(**existing_chat)
-    
     chat = Chat(
         patient_id=current_user.id,
         doctor_id=doctor_id,
         patient_name=current_user.full_name,
         doctor_name=doctor["full_name"]
     )
+    chat.updated_at = chat.created_at
+    
+    # Upsert against the unique active-pair index: two concurrent calls can no longer both insert.
+    # The loser of a race gets DuplicateKeyError and reads the winner's chat.
+    active = {"patient_id": current_user.id, "doctor_id": doctor_id, "status": "active"}
+    try:
+        existing_chat = await db.chats.find_one_and_update(
+            active,
+            {"$setOnInsert": chat.dict()},
+            projection=CHAT_FIELDS,
+            upsert=True,
+            return_document=ReturnDocument.BEFORE
+        )
+    except DuplicateKeyError:
+        existing_chat = await db.chats.find_one(active, CHAT_FIELDS)
     
-    await db.chats.insert_one(chat.dict())
+    if existing_chat:
+        return Chat(**existing_chat)
+    
+    await create_inbox_entries([chat.dict()])
     return chat
 
 @api_router.get("/chats")
-async def get_user_chats(current_user: User = Depends(get_current_user)):
+async def get_user_chats(current_user: AuthClaims = Depends(get_token_user)):
     if current_user.role == "patient":
-        chats = await db.chats.find({"patient_id": current_user.id}).to_list(100)
+        chats = await db.chats.find({"patient_id": current_user.id}, CHAT_FIELDS).to_list(100)
     elif current_user.role == "doctor":
-        chats = await db.chats.find({"doctor_id": current_user.id}).to_list(100)
+        chats = await db.chats.find({"doctor_id": current_user.id}, CHAT_FIELDS).to_list(100)
     else:
         raise HTTPException(status_code=403, detail="Not authorized")
     
-    return [Chat(**chat) for chat in chats]
+    return FastJSONResponse(chats)
+
+@api_router.get("/inbox")
+async def get_inbox(
+    before: Optional[str] = None,
+    limit: int = Query(INBOX_PAGE_DEFAULT, ge=1, le=INBOX_PAGE_MAX),
+    current_user: AuthClaims = Depends(get_token_user)
+):
+    # Most recently active chats first; next_cursor is passed back as `before`
+    if current_user.role not in ("patient", "doctor"):
+        raise HTTPException(status_code=403, detail="Not authorized")
+
+    query = {"user_id": current_user.id}
+    if before:
+        query = keyset_filter(query, before, "$lt", "last_activity", "chat_id")
+
+    entries = await db.inbox.find(query, INBOX_FIELDS).sort(
+        [("last_activity", -1), ("chat_id", -1)]
+    ).limit(limit + 1).to_list(limit + 1)
+    has_more = len(entries) > limit
+    entries = entries[:limit]
+
+    return FastJSONResponse({
+        "entries": entries,
+        "next_cursor": encode_cursor(entries[-1]["last_activity"], entries[-1]["chat_id"]) if has_more else None
+    })
+
+@api_router.post("/chats/{chat_id}/read")
+async def mark_read(chat_id: str, current_user: AuthClaims = Depends(get_token_user)):
+    await get_participant_chat(chat_id, current_user)
+    await mark_chat_read(current_user.id, chat_id)
+    return {"message": "Chat marked as read"}
 
 @api_router.get("/chats/{chat_id}/messages")
-async def get_chat_messages(chat_id: str, current_user: User = Depends(get_current_user)):
+async def get_chat_messages(
+    chat_id: str,
+    before: Optional[str] = None,
+    after: Optional[str] = None,
+    limit: int = Query(MESSAGE_PAGE_DEFAULT, ge=1, le=MESSAGE_PAGE_MAX),
+    current_user: AuthClaims = Depends(get_token_user)
+):
+    if before and after:
+        raise HTTPException(status_code=400, detail="Use either before or after, not both")
+
     # Verify user is part of this chat
-    chat = await db.chats.find_one({"id": chat_id})
-    if not chat:
-        raise HTTPException(status_code=404, detail="Chat not found")
-    
-    if current_user.id not in [chat["patient_id"], chat["doctor_id"]]:
-        raise HTTPException(status_code=403, detail="Not authorized")
+    await get_participant_chat(chat_id, current_user)
     
-    messages = await db.messages.find({"chat_id": chat_id}).sort("timestamp", 1).to_list(1000)
-    return [Message(**msg) for msg in messages]
+    # Pages are always returned oldest first. Without a cursor we return the newest page
+    # and next_cursor walks backwards (pass it as `before`); with `after` it walks forwards.
+    if after:
+        query = message_keyset_filter(chat_id, after, "$gt")
+        direction = 1
+    elif before:
+        query = message_keyset_filter(chat_id, before, "$lt")
+        direction = -1
+    else:
+        query = {"chat_id": chat_id}
+        direction = -1
+
+    # Fetch one extra row to know whether another page exists
+    messages = await db.messages.find(query, MESSAGE_FIELDS).sort(
+        [("timestamp", direction), ("id", direction)]
+    ).limit(limit + 1).to_list(limit + 1)
+    has_more = len(messages) > limit
+    messages = messages[:limit]
+    next_cursor = encode_message_cursor(messages[-1]) if has_more else None
+    if direction == -1:
+        messages.reverse()
+
+    return FastJSONResponse({
+        "messages": messages,
+        "next_cursor": next_cursor
+    })
 
 @api_router.post("/chats/{chat_id}/messages")
-async def send_message(chat_id: str, content: str, current_user: User = Depends(get_current_user)):
-    # Verify user is part of this chat
-    chat = await db.chats.find_one({"id": chat_id})
-    if not chat:
-        raise HTTPException(status_code=404, detail="Chat not found")
-    
-    if current_user.id not in [chat["patient_id"], chat["doctor_id"]]:
-        raise HTTPException(status_code=403, detail="Not authorized")
-    
-    message = Message(
-        chat_id=chat_id,
-        sender_id=current_user.id,
-        sender_name=current_user.full_name,
-        sender_role=current_user.role,
-        content=content
-    )
-    
-    await db.messages.insert_one(message.dict())
-    
-    # Update chat last message
-    await db.chats.update_one(
-        {"id": chat_id},
-        {
-            "$set": {
-                "last_message": content,
-                "last_message_time": message.timestamp
-            }
-        }
-    )
-    
-    # Send to other user via WebSocket
-    other_user_id = chat["doctor_id"] if current_user.id == chat["patient_id"] else chat["patient_id"]
-    await manager.send_personal_message({
-        "type": "new_message",
-        "message": message.dict()
-    }, other_user_id)
+async def send_message(chat_id: str, content: str, request: Request, current_user: AuthClaims = Depends(get_token_user)):
+    async def send():
+        chat = await get_participant_chat(chat_id, current_user)
+        return await post_message(chat, current_user, content)
+    return await run_idempotent(request, current_user, send)
+
+@api_router.post("/chats/{chat_id}/messages:batch")
+async def send_message_batch(chat_id: str, batch: MessageBatch, current_user: AuthClaims = Depends(get_token_user)):
+    # Replay path for clients coming back online: one insert_many and one chat update for the whole
+    # batch. Items whose idempotency_key was already stored for this sender are reported as duplicates.
+    chat = await get_participant_chat(chat_id, current_user)
     
-    return message
+    keys = [item.idempotency_key for item in batch.messages]
+    stored = await db.messages.find(
+        {"chat_id": chat_id, "sender_id": current_user.id, "idempotency_key": {"$in": keys}},
+        {"_id": 0, "id": 1, "idempotency_key": 1}
+    ).to_list(len(keys))
+    seen = {doc["idempotency_key"]: doc["id"] for doc in stored}
+
+    # Space timestamps 1ms apart (Mongo's resolution) so batch order survives (timestamp, id) paging
+    now = datetime.utcnow()
+    base_time = now.replace(microsecond=now.microsecond // 1000 * 1000)
+    results = []
+    pending = {}  # idempotency_key -> Message
+    for item in batch.messages:
+        key = item.idempotency_key
+        if key in seen:
+            results.append({"idempotency_key": key, "status": "duplicate", "message_id": seen[key]})
+            continue
+        message = Message(
+            chat_id=chat_id,
+            sender_id=current_user.id,
+            sender_name=current_user.full_name,
+            sender_role=current_user.role,
+            content=item.content,
+            message_type=item.message_type,
+            timestamp=base_time + timedelta(milliseconds=len(pending))
+        )
+        seen[key] = message.id
+        pending[key] = message
+        results.append({"idempotency_key": key, "status": "created", "message_id": message.id})
+
+    failed = {}  # idempotency_key -> status
+    if pending:
+        docs = [{**message.dict(), "idempotency_key": key} for key, message in pending.items()]
+        try:
+            await db.messages.insert_many(docs, ordered=False)
+        except BulkWriteError as e:
+            # A concurrent retry of the same batch can win the race on the unique index
+            for error in e.details.get("writeErrors", []):
+                key = docs[error["index"]]["idempotency_key"]
+                failed[key] = "duplicate" if error.get("code") == 11000 else "error"
+
+    if any(status == "duplicate" for status in failed.values()):
+        raced = await db.messages.find(
+            {"chat_id": chat_id, "sender_id": current_user.id,
+             "idempotency_key": {"$in": [k for k, v in failed.items() if v == "duplicate"]}},
+            {"_id": 0, "id": 1, "idempotency_key": 1}
+        ).to_list(len(failed))
+        winners = {doc["idempotency_key"]: doc["id"] for doc in raced}
+    else:
+        winners = {}
+
+    created = []
+    for result in results:
+        key = result["idempotency_key"]
+        if result["status"] != "created":
+            continue
+        if key in failed:
+            result["status"] = failed[key]
+            result["message_id"] = winners.get(key)
+        else:
+            result["message"] = pending[key]
+            created.append(pending[key])
+
+    if created:
+        if search_index is not None:
+            for message in created:
+                search_index.add_message(chat, message.dict())
+        await asyncio.gather(
+            db.chats.update_one(
+                {"id": chat_id},
+                {
+                    "$set": {
+                        "last_message": created[-1].content,
+                        "last_message_time": created[-1].timestamp,
+                        "updated_at": created[-1].timestamp
+                    }
+                }
+            ),
+            record_inbox_activity(chat, current_user.id, created[-1].content, created[-1].timestamp, len(created))
+        )
+
+        await manager.send_personal_message({
+            "type": "new_messages",
+            "messages": [message.dict() for message in created]
+        }, other_participant(chat, current_user.id))
+
+    return {"results": results}
 
 # Prescription endpoints
 @api_router.post("/prescriptions")
@@ -351,12 +1983,25 @@ async def create_prescription(
     medications: List[Dict[str, Any]],
     diagnosis: str,
     instructions: str,
-    current_user: User = Depends(get_current_user)
+    request: Request,
+    current_user: AuthClaims = Depends(get_token_user)
 ):
+    return await run_idempotent(
+        request, current_user,
+        lambda: issue_prescription(patient_id, medications, diagnosis, instructions, current_user)
+    )
+
+async def issue_prescription(
+    patient_id: str,
+    medications: List[Dict[str, Any]],
+    diagnosis: str,
+    instructions: str,
+    current_user: AuthClaims
+) -> Prescription:
     if current_user.role != "doctor":
         raise HTTPException(status_code=403, detail="Only doctors can create prescriptions")
     
-    patient = await db.users.find_one({"id": patient_id, "role": "patient"})
+    patient = await db.users.find_one({"id": patient_id, "role": "patient"}, NAME_FIELDS)
     if not patient:
         raise HTTPException(status_code=404, detail="Patient not found")
     
@@ -369,58 +2014,1245 @@ async def create_prescription(
         diagnosis=diagnosis,
         instructions=instructions
     )
+    prescription.updated_at = prescription.created_at
     
     await db.prescriptions.insert_one(prescription.dict())
+    if search_index is not None:
+        search_index.add_prescription(prescription.dict())
     return prescription
 
 @api_router.get("/prescriptions")
-async def get_prescriptions(current_user: User = Depends(get_current_user)):
+async def get_prescriptions(current_user: AuthClaims = Depends(get_token_user)):
     if current_user.role == "patient":
-        prescriptions = await db.prescriptions.find({"patient_id": current_user.id}).to_list(100)
+        prescriptions = await db.prescriptions.find({"patient_id": current_user.id}, PRESCRIPTION_FIELDS).to_list(100)
     elif current_user.role == "doctor":
-        prescriptions = await db.prescriptions.find({"doctor_id": current_user.id}).to_list(100)
+        prescriptions = await db.prescriptions.find({"doctor_id": current_user.id}, PRESCRIPTION_FIELDS).to_list(100)
     elif current_user.role == "pharmacy":
-        prescriptions = await db.prescriptions.find({"status": {"$in": ["pending", "dispensed"]}}).to_list(100)
+        prescriptions = await db.prescriptions.find(
+            {"$or": [{"status": "pending"}, {"pharmacy_id": current_user.id}]}, PRESCRIPTION_FIELDS
+        ).sort("created_at", 1).to_list(100)
     else:
         raise HTTPException(status_code=403, detail="Not authorized")
     
-    return [Prescription(**presc) for presc in prescriptions]
+    return FastJSONResponse(prescriptions)
+
+# Search
+# GET /search ranks the caller's messages and prescriptions (diagnosis, instructions, medication
+# names) against a query. SEARCH_BACKEND=mongo (default) uses the text indexes; SEARCH_BACKEND=memory
+# keeps an inverted index in process, built from the DB at startup and extended on every write.
+# Writes from other workers reach the memory backend through the change feed (CHANGE_FEED).
+# Either way results are capped at SEARCH_MAX_RESULTS per query, which bounds the work per request.
+SEARCH_BACKEND = os.environ.get("SEARCH_BACKEND", "mongo")
+SEARCH_PAGE_DEFAULT = 20
+SEARCH_PAGE_MAX = 50
+SEARCH_MAX_RESULTS = 200
+SEARCH_TIMEOUT_MS = int(os.environ.get("SEARCH_TIMEOUT_MS", "2000"))
+SEARCH_SNIPPET_LENGTH = 160
+SEARCH_TOKEN_RE = re.compile(r"\w+")
+SEARCH_STOPWORDS = frozenset(
+    "a an and are as at be but by for from has have i in is it me my no not of on or so that the this to was we with you".split()
+)
+PRESCRIPTION_SEARCH_WEIGHTS = {"diagnosis": 2.0, "instructions": 1.0, "medications": 3.0}
+
+def search_stem(word: str) -> str:
+    # Crude suffix stripping so "fevers"/"fever" and "dosing"/"dose" meet; shared by indexing and highlighting
+    for suffix in ("ing", "ed", "es", "s"):
+        if word.endswith(suffix) and len(word) - len(suffix) >= 3:
+            return word[:-len(suffix)]
+    return word
+
+def search_terms(text: str) -> List[str]:
+    return [search_stem(word) for word in SEARCH_TOKEN_RE.findall(text.lower())
+            if len(word) > 1 and word not in SEARCH_STOPWORDS]
+
+def medication_names(prescription: dict) -> str:
+    return " ".join(str(m.get("name", "")) for m in prescription.get("medications", []) if isinstance(m, dict))
+
+def prescription_search_fields(prescription: dict) -> Dict[str, str]:
+    return {
+        "diagnosis": prescription.get("diagnosis", ""),
+        "instructions": prescription.get("instructions", ""),
+        "medications": medication_names(prescription)
+    }
+
+def highlight(field: str, text: str, terms: Set[str]) -> Optional[dict]:
+    # Snippet around the first hit; matches are [start, end) offsets into the snippet
+    hits = [(m.start(), m.end()) for m in SEARCH_TOKEN_RE.finditer(text) if search_stem(m.group().lower()) in terms]
+    if not hits:
+        return None
+    start = max(0, hits[0][0] - SEARCH_SNIPPET_LENGTH // 4)
+    end = min(len(text), start + SEARCH_SNIPPET_LENGTH)
+    return {
+        "field": field,
+        "snippet": text[start:end],
+        "offset": start,
+        "matches": [[s - start, e - start] for s, e in hits if e <= end]
+    }
+
+class SearchIndex:
+    # Postings are partitioned by who may see a document ("patient:<id>", "doctor:<id>"), so a query
+    # only walks the caller's own history. Messages and prescription text never change after insert,
+    # so the index is append-only.
+    def __init__(self):
+        self.partitions: Dict[str, Dict[str, Dict[str, float]]] = {}  # scope -> term -> doc key -> weight
+        self.doc_freq: Dict[str, int] = {}
+        self.keys: Set[str] = set()
+        self.ready = False
+
+    def add(self, key: str, scopes: List[str], fields: List[tuple]):
+        if key in self.keys:
+            return
+        self.keys.add(key)
+        weights: Dict[str, float] = {}
+        for text, weight in fields:
+            for term in search_terms(text):
+                weights[term] = weights.get(term, 0.0) + weight
+        for term, weight in weights.items():
+            self.doc_freq[term] = self.doc_freq.get(term, 0) + 1
+            for scope in scopes:
+                self.partitions.setdefault(scope, {}).setdefault(term, {})[key] = weight
+
+    def add_message(self, chat: dict, message: dict):
+        self.add(f"message:{message['id']}", [f"patient:{chat['patient_id']}", f"doctor:{chat['doctor_id']}"],
+                 [(message["content"], 1.0)])
+
+    def add_prescription(self, prescription: dict):
+        fields = prescription_search_fields(prescription)
+        self.add(f"prescription:{prescription['id']}",
+                 [f"patient:{prescription['patient_id']}", f"doctor:{prescription['doctor_id']}"],
+                 [(fields[name], weight) for name, weight in PRESCRIPTION_SEARCH_WEIGHTS.items()])
+
+    def search(self, scope: str, terms: List[str], kinds: Set[str], limit: int) -> List[tuple]:
+        partition = self.partitions.get(scope, {})
+        total = len(self.keys)
+        scores: Dict[str, float] = {}
+        for term in set(terms):
+            postings = partition.get(term)
+            if not postings:
+                continue
+            idf = math.log(1 + total / self.doc_freq[term])
+            for key, weight in postings.items():
+                # Saturating term frequency (BM25-style, no length normalisation)
+                scores[key] = scores.get(key, 0.0) + idf * weight / (weight + 1.2)
+        ranked = ((score, key) for key, score in scores.items() if key.split(":", 1)[0] in kinds)
+        return [(score, *key.split(":", 1)) for score, key in heapq.nlargest(limit, ranked)]
+
+    async def rebuild(self):
+        async for chat in db.chats.find({}, {"_id": 0, "id": 1, "patient_id": 1, "doctor_id": 1}):
+            async for message in db.messages.find({"chat_id": chat["id"]}, {"_id": 0, "id": 1, "content": 1}):
+                self.add_message(chat, message)
+        fields = {"_id": 0, "id": 1, "patient_id": 1, "doctor_id": 1, "diagnosis": 1, "instructions": 1, "medications": 1}
+        async for prescription in db.prescriptions.find({}, fields):
+            self.add_prescription(prescription)
+        self.ready = True
+        logger.info(f"Search index built: {len(self.keys)} documents, {len(self.doc_freq)} terms")
+
+search_index = SearchIndex() if SEARCH_BACKEND == "memory" else None
+
+async def mongo_text_search(user: AuthClaims, query: str, kinds: Set[str], limit: int) -> List[tuple]:
+    owner = {f"{user.role}_id": user.id}
+    ranked = []
+    try:
+        if "message" in kinds:
+            chats = await db.chats.find(owner, {"_id": 0, "id": 1}).to_list(None)
+            if chats:
+                cursor = db.messages.find(
+                    {"$text": {"$search": query}, "chat_id": {"$in": [c["id"] for c in chats]}},
+                    {**MESSAGE_FIELDS, "score": {"$meta": "textScore"}}
+                ).sort([("score", {"$meta": "textScore"})]).limit(limit).max_time_ms(SEARCH_TIMEOUT_MS)
+                ranked.extend([(doc.pop("score"), "message", doc) async for doc in cursor])
+        if "prescription" in kinds:
+            cursor = db.prescriptions.find(
+                {"$text": {"$search": query}, **owner},
+                {**PRESCRIPTION_FIELDS, "score": {"$meta": "textScore"}}
+            ).sort([("score", {"$meta": "textScore"})]).limit(limit).max_time_ms(SEARCH_TIMEOUT_MS)
+            ranked.extend([(doc.pop("score"), "prescription", doc) async for doc in cursor])
+    except ExecutionTimeout:
+        raise HTTPException(status_code=503, detail="Search took too long, try a more specific query")
+    ranked.sort(key=lambda hit: hit[0], reverse=True)
+    return ranked[:limit]
+
+async def memory_search(user: AuthClaims, query: str, kinds: Set[str], limit: int) -> List[tuple]:
+    if not search_index.ready:
+        raise HTTPException(status_code=503, detail="Search index is still building", headers={"Retry-After": "5"})
+    hits = search_index.search(f"{user.role}:{user.id}", search_terms(query), kinds, limit)
+    collections = {"message": (db.messages, MESSAGE_FIELDS), "prescription": (db.prescriptions, PRESCRIPTION_FIELDS)}
+    docs = {}
+    for kind, (collection, fields) in collections.items():
+        ids = [doc_id for _, hit_kind, doc_id in hits if hit_kind == kind]
+        if ids:
+            async for doc in collection.find({"id": {"$in": ids}}, fields):
+                docs[(kind, doc["id"])] = doc
+    return [(score, kind, docs[(kind, doc_id)]) for score, kind, doc_id in hits if (kind, doc_id) in docs]
+
+@api_router.get("/search")
+async def search(
+    q: str = Query(..., min_length=1, max_length=200),
+    kind: Optional[Literal["message", "prescription"]] = None,
+    offset: int = Query(0, ge=0),
+    limit: int = Query(SEARCH_PAGE_DEFAULT, ge=1, le=SEARCH_PAGE_MAX),
+    current_user: AuthClaims = Depends(get_token_user)
+):
+    if current_user.role not in ("patient", "doctor"):
+        raise HTTPException(status_code=403, detail="Search covers patient and doctor records")
+    if offset + limit > SEARCH_MAX_RESULTS:
+        raise HTTPException(status_code=400, detail=f"Only the top {SEARCH_MAX_RESULTS} results can be paged")
+    terms = set(search_terms(q))
+    if not terms:
+        return FastJSONResponse({"results": [], "next_offset": None})
+
+    kinds = {kind} if kind else {"message", "prescription"}
+    # One extra hit tells us whether another page exists
+    backend = memory_search if search_index is not None else mongo_text_search
+    ranked = await backend(current_user, q, kinds, offset + limit + 1)
+
+    results = []
+    for score, hit_kind, doc in ranked[offset:offset + limit]:
+        fields = {"content": doc["content"]} if hit_kind == "message" else prescription_search_fields(doc)
+        highlights = [h for h in (highlight(name, text, terms) for name, text in fields.items()) if h]
+        results.append({"kind": hit_kind, "score": round(score, 4), "document": doc, "highlights": highlights})
+    return FastJSONResponse({
+        "results": results,
+        "next_offset": offset + limit if len(ranked) > offset + limit else None
+    })
+
+# Patient export
+# GET /patients/{id}/export streams the record as NDJSON: a patient line, then chats, messages (chat
+# by chat) and prescriptions, each read in keyset order from a cursor pulled EXPORT_BATCH_SIZE
+# documents at a time, so memory stays flat however long the history is. Every batch is followed
+# by {"type": "checkpoint", "cursor": ...}; after a dropped connection, passing the last checkpoint
+# received as ?cursor= resumes right after it. A complete export ends with {"type": "end"}.
+EXPORT_BATCH_SIZE = int(os.environ.get("EXPORT_BATCH_SIZE", "500"))
+EXPORT_SECTIONS = ("chats", "messages", "prescriptions")
+
+def encode_export_cursor(section: str, after: Optional[str] = None, chat_id: Optional[str] = None) -> str:
+    raw = json.dumps({"section": section, "after": after, "chat_id": chat_id}, separators=(",", ":"))
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+def decode_export_cursor(cursor: str) -> dict:
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        position = json.loads(base64.urlsafe_b64decode(padded.encode()))
+    except (ValueError, UnicodeDecodeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    if not isinstance(position, dict) or position.get("section") not in EXPORT_SECTIONS:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    if position.get("after"):
+        decode_cursor(position["after"])  # reject a malformed keyset position before streaming starts
+    return position
+
+def export_line(record_type: str, data) -> bytes:
+    return encode_json({"type": record_type, "data": data}) + b"\n"
+
+def export_checkpoint(cursor: str) -> bytes:
+    return encode_json({"type": "checkpoint", "cursor": cursor}) + b"\n"
+
+async def export_batches(collection, query: dict, sort: list, fields: dict):
+    batch = []
+    async for doc in collection.find(query, fields).sort(sort).batch_size(EXPORT_BATCH_SIZE):
+        batch.append(doc)
+        if len(batch) >= EXPORT_BATCH_SIZE:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+async def export_patient_record(patient: dict, scope: dict, position: Optional[dict]):
+    patient_id = patient["id"]
+    if position is None:
+        yield export_line("patient", patient)
+        position = {"section": "chats"}
+    section = position["section"]
+    by_created = [("created_at", 1), ("id", 1)]
+
+    if section == "chats":
+        query = {"patient_id": patient_id, **scope}
+        if position.get("after"):
+            query = keyset_filter(query, position["after"], "$gt", "created_at", "id")
+        async for batch in export_batches(db.chats, query, by_created, CHAT_FIELDS):
+            last = batch[-1]
+            yield b"".join(export_line("chat", chat) for chat in batch) + \
+                export_checkpoint(encode_export_cursor("chats", encode_cursor(last["created_at"], last["id"])))
+        section, position = "messages", {}
+
+    if section == "messages":
+        # Chats are walked in id order so a checkpoint only has to remember (chat_id, message keyset)
+        chat_query = {"patient_id": patient_id, **scope}
+        resume_chat = position.get("chat_id")
+        if resume_chat:
+            chat_query["id"] = {"$gte": resume_chat}
+        async for chat in db.chats.find(chat_query, {"id": 1, "_id": 0}).sort("id", 1):
+            chat_id = chat["id"]
+            if chat_id == resume_chat and position.get("after"):
+                query = message_keyset_filter(chat_id, position["after"], "$gt")
+            else:
+                query = {"chat_id": chat_id}
+            async for batch in export_batches(db.messages, query, [("timestamp", 1), ("id", 1)], MESSAGE_FIELDS):
+                yield b"".join(export_line("message", message) for message in batch) + \
+                    export_checkpoint(encode_export_cursor("messages", encode_message_cursor(batch[-1]), chat_id))
+        section, position = "prescriptions", {}
+
+    query = {"patient_id": patient_id, **scope}
+    if position.get("after"):
+        query = keyset_filter(query, position["after"], "$gt", "created_at", "id")
+    async for batch in export_batches(db.prescriptions, query, by_created, PRESCRIPTION_FIELDS):
+        last = batch[-1]
+        yield b"".join(export_line("prescription", prescription) for prescription in batch) + \
+            export_checkpoint(encode_export_cursor("prescriptions", encode_cursor(last["created_at"], last["id"])))
+    yield encode_json({"type": "end"}) + b"\n"
+
+@api_router.get("/patients/{patient_id}/export")
+async def export_patient(
+    patient_id: str,
+    cursor: Optional[str] = None,
+    current_user: AuthClaims = Depends(get_token_user)
+):
+    # Patients export their whole record; doctors get the part they are a party to
+    if current_user.role == "patient" and current_user.id == patient_id:
+        scope = {}
+    elif current_user.role == "doctor":
+        scope = {"doctor_id": current_user.id}
+    else:
+        raise HTTPException(status_code=403, detail="Not authorized to export this record")
+
+    # Validate everything before the 200 goes out; errors after that can only end the stream
+    position = decode_export_cursor(cursor) if cursor else None
+    if current_user.role == "doctor":
+        # A chat or a prescription is what makes a doctor a party to the record
+        link = {"patient_id": patient_id, "doctor_id": current_user.id}
+        chat, prescription = await asyncio.gather(
+            db.chats.find_one(link, EXISTS_FIELDS),
+            db.prescriptions.find_one(link, EXISTS_FIELDS)
+        )
+        if chat is None and prescription is None:
+            raise HTTPException(status_code=403, detail="Not authorized to export this record")
+    patient = await db.users.find_one({"id": patient_id, "role": "patient"}, USER_PROFILE_FIELDS)
+    if not patient:
+        raise HTTPException(status_code=404, detail="Patient not found")
+    patient.pop("token_version", None)
+
+    return StreamingResponse(
+        export_patient_record(patient, scope, position),
+        media_type="application/x-ndjson",
+        headers={"Content-Disposition": f'attachment; filename="patient-{patient_id}.ndjson"'}
+    )
+
+# Delta sync
+# GET /sync returns the caller's chats, messages and prescriptions written since the previous call.
+# The token holds one (time, id) keyset position per collection, so it only moves forward. Each
+# call reads up to SYNC_PAGE_SIZE rows per collection, no newer than SYNC_LAG_SECONDS ago, so a
+# write still in flight is picked up next time instead of being skipped; rows at the edge may come
+# twice, so clients upsert by id. has_more means call again straight away. No token means a full
+# sync from the beginning. Records the caller should drop (closed chats, prescriptions another
+# pharmacy took) come back as tombstones.
+SYNC_PAGE_SIZE = 200
+SYNC_PAGE_MAX = 1000
+SYNC_LAG_SECONDS = float(os.environ.get("SYNC_LAG_SECONDS", "1.0"))
+SYNC_COLLECTIONS = {
+    "chats": ("updated_at", CHAT_FIELDS),
+    "messages": ("timestamp", MESSAGE_FIELDS),  # messages are never modified after insert
+    "prescriptions": ("updated_at", PRESCRIPTION_FIELDS)
+}
+
+def encode_sync_token(positions: Dict[str, str]) -> str:
+    return base64.urlsafe_b64encode(json.dumps(positions, separators=(",", ":")).encode()).decode().rstrip("=")
+
+def decode_sync_token(token: str) -> Dict[str, str]:
+    try:
+        padded = token + "=" * (-len(token) % 4)
+        positions = json.loads(base64.urlsafe_b64decode(padded.encode()))
+    except (ValueError, UnicodeDecodeError):
+        raise HTTPException(status_code=400, detail="Invalid sync token")
+    if not isinstance(positions, dict) or not set(positions) <= set(SYNC_COLLECTIONS):
+        raise HTTPException(status_code=400, detail="Invalid sync token")
+    for cursor in positions.values():
+        decode_cursor(cursor)
+    return positions
+
+async def sync_scopes(user: AuthClaims) -> Dict[str, Optional[dict]]:
+    # Base filter per collection; None means the caller has nothing there
+    if user.role in ("patient", "doctor"):
+        owner = {f"{user.role}_id": user.id}
+        chats = await db.chats.find(owner, {"_id": 0, "id": 1}).to_list(None)
+        return {
+            "chats": owner,
+            "messages": {"chat_id": {"$in": [chat["id"] for chat in chats]}} if chats else None,
+            "prescriptions": owner
+        }
+    if user.role == "pharmacy":
+        # Every prescription change is read so the ones claimed elsewhere can be tombstoned
+        return {"chats": None, "messages": None, "prescriptions": {}}
+    raise HTTPException(status_code=403, detail="Not authorized")
+
+def sync_tombstone(collection: str, doc: dict, user: AuthClaims) -> bool:
+    if collection == "chats":
+        return doc.get("status", "active") != "active"
+    if collection == "prescriptions" and user.role == "pharmacy":
+        return doc["status"] != "pending" and doc.get("pharmacy_id") != user.id
+    return False
+
+@api_router.get("/sync")
+async def sync(
+    since: Optional[str] = None,
+    limit: int = Query(SYNC_PAGE_SIZE, ge=1, le=SYNC_PAGE_MAX),
+    current_user: AuthClaims = Depends(get_token_user)
+):
+    positions = decode_sync_token(since) if since else {}
+    scopes = await sync_scopes(current_user)
+    horizon = datetime.utcnow() - timedelta(seconds=SYNC_LAG_SECONDS)
+
+    response: Dict[str, Any] = {"tombstones": []}
+    has_more = False
+    for collection, (time_field, fields) in SYNC_COLLECTIONS.items():
+        response[collection] = []
+        base = scopes[collection]
+        if base is None:
+            continue
+        query = {**base, time_field: {"$lte": horizon}}
+        if collection in positions:
+            query = keyset_filter(query, positions[collection], "$gt", time_field, "id")
+        docs = await db[collection].find(query, fields).sort(
+            [(time_field, 1), ("id", 1)]
+        ).limit(limit + 1).to_list(limit + 1)
+
+        if len(docs) > limit:
+            has_more = True
+            docs = docs[:limit]
+            positions[collection] = encode_cursor(docs[-1][time_field], docs[-1]["id"])
+        else:
+            # Caught up to the horizon; the next call starts there
+            positions[collection] = encode_cursor(horizon, "")
+        for doc in docs:
+            if sync_tombstone(collection, doc, current_user):
+                response["tombstones"].append({"kind": collection[:-1], "id": doc["id"]})
+            else:
+                response[collection].append(doc)
+
+    response["next_token"] = encode_sync_token(positions)
+    response["has_more"] = has_more
+    return FastJSONResponse(response)
+
+async def backfill_updated_at():
+    # One-off migration: chats and prescriptions written before updated_at existed. Chats have no
+    # index on updated_at alone, so a marker document stops this from scanning them on every boot.
+    if await db.migrations.find_one({"_id": "backfill_updated_at"}) is not None:
+        return
+    for collection, time_fields in (("chats", ("last_message_time", "created_at")), ("prescriptions", ("dispensed_at", "claimed_at", "created_at"))):
+        operations = []
+        async for doc in db[collection].find({"updated_at": None}, {"_id": 0, "id": 1, **{f: 1 for f in time_fields}}):
+            updated_at = next((doc[f] for f in time_fields if doc.get(f)), datetime.utcnow())
+            operations.append(UpdateOne({"id": doc["id"]}, {"$set": {"updated_at": updated_at}}))
+            if len(operations) >= 500:
+                await db[collection].bulk_write(operations, ordered=False)
+                operations = []
+        if operations:
+            await db[collection].bulk_write(operations, ordered=False)
+    await db.migrations.insert_one({"_id": "backfill_updated_at", "applied_at": datetime.utcnow()})
+
+# Pharmacy work queue
+# Pharmacies claim a pending prescription with an atomic find_one_and_update, which leases it to them
+# for PRESCRIPTION_LEASE_SECONDS. Only the lease holder can dispense a claimed prescription, so two
+# pharmacies can never dispense the same one. A claim also takes over a lease that has lapsed, so
+# expiry is enforced at claim time; release_expired_leases(), which runs every
+# PRESCRIPTION_LEASE_SWEEP_SECONDS, puts lapsed ones back in the pending queue listing.
+PRESCRIPTION_LEASE_SECONDS = int(os.environ.get("PRESCRIPTION_LEASE_SECONDS", "300"))
+PRESCRIPTION_LEASE_SWEEP_SECONDS = int(os.environ.get("PRESCRIPTION_LEASE_SWEEP_SECONDS", "30"))
+PRESCRIPTION_QUEUE_STATUSES = ("pending", "claimed", "dispensed")
+
+def require_pharmacy(user: AuthClaims):
+    if user.role != "pharmacy":
+        raise HTTPException(status_code=403, detail="Only pharmacy can manage the dispense queue")
+
+def claim_update(pharmacy_id: str) -> dict:
+    now = datetime.utcnow()
+    return {
+        "$set": {
+            "status": "claimed",
+            "pharmacy_id": pharmacy_id,
+            "claimed_at": now,
+            "lease_expires_at": now + timedelta(seconds=PRESCRIPTION_LEASE_SECONDS),
+            "updated_at": now
+        }
+    }
+
+def claimable(now: datetime) -> list:
+    # $or branches: waiting in the queue, or held on a lease that lapsed before the sweep got to it
+    return [{"status": "pending"}, {"status": "claimed", "lease_expires_at": {"$lt": now}}]
+
+async def release_expired_leases() -> int:
+    now = datetime.utcnow()
+    result = await db.prescriptions.update_many(
+        {"status": "claimed", "lease_expires_at": {"$lt": now}},
+        {"$set": {"status": "pending", "pharmacy_id": None, "claimed_at": None, "lease_expires_at": None, "updated_at": now}}
+    )
+    if result.modified_count:
+        logger.info(f"Released {result.modified_count} expired prescription leases")
+    return result.modified_count
+
+async def lease_sweeper():
+    while True:
+        await asyncio.sleep(PRESCRIPTION_LEASE_SWEEP_SECONDS)
+        try:
+            await release_expired_leases()
+        except Exception as e:
+            logger.error(f"Prescription lease sweep failed: {e}")
+
+@api_router.get("/prescriptions/queue")
+async def get_prescription_queue(
+    status: str = "pending",
+    after: Optional[str] = None,
+    limit: int = Query(QUEUE_PAGE_DEFAULT, ge=1, le=QUEUE_PAGE_MAX),
+    current_user: AuthClaims = Depends(get_token_user)
+):
+    # Oldest first. `pending` is the shared queue; `claimed`/`dispensed` are this pharmacy's own.
+    require_pharmacy(current_user)
+    if status not in PRESCRIPTION_QUEUE_STATUSES:
+        raise HTTPException(status_code=400, detail=f"status must be one of {', '.join(PRESCRIPTION_QUEUE_STATUSES)}")
+
+    query = {"status": status}
+    if status != "pending":
+        query["pharmacy_id"] = current_user.id
+    if after:
+        query = keyset_filter(query, after, "$gt", "created_at", "id")
+
+    prescriptions = await db.prescriptions.find(query, PRESCRIPTION_FIELDS).sort(
+        [("created_at", 1), ("id", 1)]
+    ).limit(limit + 1).to_list(limit + 1)
+    has_more = len(prescriptions) > limit
+    prescriptions = prescriptions[:limit]
+
+    return FastJSONResponse({
+        "prescriptions": prescriptions,
+        "next_cursor": encode_cursor(prescriptions[-1]["created_at"], prescriptions[-1]["id"]) if has_more else None
+    })
+
+@api_router.post("/prescriptions/claim")
+async def claim_next_prescription(current_user: AuthClaims = Depends(get_token_user)):
+    require_pharmacy(current_user)
+    prescription = await db.prescriptions.find_one_and_update(
+        {"$or": claimable(datetime.utcnow())},
+        claim_update(current_user.id),
+        sort=[("created_at", 1), ("id", 1)],
+        projection=PRESCRIPTION_FIELDS,
+        return_document=ReturnDocument.AFTER
+    )
+    if prescription is None:
+        raise HTTPException(status_code=404, detail="No pending prescriptions")
+    return Prescription(**prescription)
+
+@api_router.post("/prescriptions/{prescription_id}/claim")
+async def claim_prescription(prescription_id: str, current_user: AuthClaims = Depends(get_token_user)):
+    require_pharmacy(current_user)
+    # Claiming again while holding the lease renews it
+    prescription = await db.prescriptions.find_one_and_update(
+        {"id": prescription_id, "$or": [*claimable(datetime.utcnow()), {"status": "claimed", "pharmacy_id": current_user.id}]},
+        claim_update(current_user.id),
+        projection=PRESCRIPTION_FIELDS,
+        return_document=ReturnDocument.AFTER
+    )
+    if prescription is None:
+        await raise_not_dispensable(prescription_id)
+    return Prescription(**prescription)
+
+@api_router.post("/prescriptions/{prescription_id}/release")
+async def release_prescription(prescription_id: str, current_user: AuthClaims = Depends(get_token_user)):
+    require_pharmacy(current_user)
+    result = await db.prescriptions.update_one(
+        {"id": prescription_id, "status": "claimed", "pharmacy_id": current_user.id},
+        {"$set": {"status": "pending", "pharmacy_id": None, "claimed_at": None, "lease_expires_at": None,
+                  "updated_at": datetime.utcnow()}}
+    )
+    if result.modified_count == 0:
+        await raise_not_dispensable(prescription_id)
+    return {"message": "Prescription released"}
+
+async def raise_not_dispensable(prescription_id: str):
+    if await db.prescriptions.find_one({"id": prescription_id}, EXISTS_FIELDS) is None:
+        raise HTTPException(status_code=404, detail="Prescription not found")
+    raise HTTPException(status_code=409, detail="Prescription is claimed by another pharmacy or already dispensed")
 
 @api_router.patch("/prescriptions/{prescription_id}/dispense")
-async def dispense_prescription(prescription_id: str, current_user: User = Depends(get_current_user)):
+async def dispense_prescription(prescription_id: str, current_user: AuthClaims = Depends(get_token_user)):
     if current_user.role != "pharmacy":
         raise HTTPException(status_code=403, detail="Only pharmacy can dispense prescriptions")
     
+    # Pending prescriptions can still be dispensed in one step; claimed ones only by the lease holder
+    now = datetime.utcnow()
     result = await db.prescriptions.update_one(
-        {"id": prescription_id},
+        {
+            "id": prescription_id,
+            "$or": [
+                {"status": "pending"},
+                {"status": "claimed", "pharmacy_id": current_user.id, "lease_expires_at": {"$gt": now}}
+            ]
+        },
         {
             "$set": {
                 "status": "dispensed",
                 "pharmacy_id": current_user.id,
-                "dispensed_at": datetime.utcnow()
+                "dispensed_at": now,
+                "lease_expires_at": None,
+                "updated_at": now
             }
         }
     )
     
     if result.modified_count == 0:
-        raise HTTPException(status_code=404, detail="Prescription not found")
+        await raise_not_dispensable(prescription_id)
     
     return {"message": "Prescription dispensed successfully"}
 
+# Appointment scheduling
+# Bookings are aligned to a SLOT_MINUTES grid. Double-booking is prevented by the database: every
+# booking inserts one appointment_slots document per grid slot it covers, and a unique index on
+# (doctor_id, slot_start) rejects the loser of any race, whichever worker it runs on.
+# DoctorSchedule is the in-process interval index used for O(log n) conflict checks and free-slot
+# search; it mirrors the (doctor_id, appointment_date) index and is reloaded after SCHEDULE_CACHE_SECONDS.
+SLOT_MINUTES = int(os.environ.get("APPOINTMENT_SLOT_MINUTES", "15"))
+MAX_APPOINTMENT_MINUTES = 240
+CLINIC_OPEN_HOUR = int(os.environ.get("CLINIC_OPEN_HOUR", "9"))  # UTC
+CLINIC_CLOSE_HOUR = int(os.environ.get("CLINIC_CLOSE_HOUR", "17"))  # UTC
+FREE_SLOT_HORIZON_DAYS = 30
+SCHEDULE_CACHE_SECONDS = float(os.environ.get("SCHEDULE_CACHE_SECONDS", "30"))
+
+def to_naive_utc(value: datetime) -> datetime:
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value
+
+def align_to_slot(value: datetime) -> datetime:
+    # Round up to the next grid boundary
+    floored = value.replace(second=0, microsecond=0, minute=value.minute - value.minute % SLOT_MINUTES)
+    return floored if floored == value else floored + timedelta(minutes=SLOT_MINUTES)
+
+class DoctorSchedule:
+    # Non-overlapping [start, end) intervals kept sorted by start; since they never overlap the
+    # ends are sorted too, so both conflict checks and gap walks start with one bisect.
+    def __init__(self, appointments: List[dict]):
+        self.starts: List[datetime] = []
+        self.ends: List[datetime] = []
+        self.ids: List[str] = []
+        self.loaded_at = time.monotonic()
+        for appointment in sorted(appointments, key=lambda a: a["appointment_date"]):
+            self.add(appointment["id"], appointment["appointment_date"], appointment["duration_minutes"])
+
+    def conflicts(self, start: datetime, end: datetime) -> bool:
+        i = bisect_right(self.ends, start)  # first interval ending after start
+        return i < len(self.starts) and self.starts[i] < end
+
+    def add(self, appointment_id: str, start: datetime, duration_minutes: int):
+        i = bisect_left(self.starts, start)
+        self.starts.insert(i, start)
+        self.ends.insert(i, start + timedelta(minutes=duration_minutes))
+        self.ids.insert(i, appointment_id)
+
+    def remove(self, appointment_id: str, start: datetime):
+        i = bisect_left(self.starts, start)
+        while i < len(self.starts) and self.starts[i] == start:
+            if self.ids[i] == appointment_id:
+                del self.starts[i], self.ends[i], self.ids[i]
+                return
+            i += 1
+
+    def free_slots(self, after: datetime, count: int, duration_minutes: int) -> List[datetime]:
+        duration = timedelta(minutes=duration_minutes)
+        slots: List[datetime] = []
+        day = after.replace(hour=0, minute=0, second=0, microsecond=0)
+        for _ in range(FREE_SLOT_HORIZON_DAYS):
+            window_end = day.replace(hour=CLINIC_CLOSE_HOUR)
+            t = align_to_slot(max(after, day.replace(hour=CLINIC_OPEN_HOUR)))
+            i = bisect_right(self.ends, t)
+            while t + duration <= window_end:
+                if i < len(self.starts) and self.starts[i] < t + duration:
+                    t = align_to_slot(max(t, self.ends[i]))
+                    i += 1
+                    continue
+                slots.append(t)
+                if len(slots) == count:
+                    return slots
+                t += duration
+            day += timedelta(days=1)
+        return slots
+
+schedules: Dict[str, DoctorSchedule] = {}
+
+async def get_schedule(doctor_id: str) -> DoctorSchedule:
+    schedule = schedules.get(doctor_id)
+    if schedule is None or time.monotonic() - schedule.loaded_at > SCHEDULE_CACHE_SECONDS:
+        horizon_start = datetime.utcnow() - timedelta(minutes=MAX_APPOINTMENT_MINUTES)
+        appointments = await db.appointments.find(
+            {"doctor_id": doctor_id, "status": "scheduled", "appointment_date": {"$gte": horizon_start}},
+            {"_id": 0, "id": 1, "appointment_date": 1, "duration_minutes": 1}
+        ).to_list(None)
+        schedule = DoctorSchedule(appointments)
+        schedules[doctor_id] = schedule
+    return schedule
+
+def slot_starts(start: datetime, duration_minutes: int) -> List[datetime]:
+    return [start + timedelta(minutes=offset) for offset in range(0, duration_minutes, SLOT_MINUTES)]
+
+@api_router.post("/appointments")
+async def create_appointment(booking: AppointmentCreate, current_user: AuthClaims = Depends(get_token_user)):
+    if current_user.role != "patient":
+        raise HTTPException(status_code=403, detail="Only patients can book appointments")
+    
+    start = to_naive_utc(booking.appointment_date)
+    duration = booking.duration_minutes
+    if duration <= 0 or duration > MAX_APPOINTMENT_MINUTES or duration % SLOT_MINUTES:
+        raise HTTPException(status_code=400, detail=f"Duration must be a multiple of {SLOT_MINUTES} minutes, up to {MAX_APPOINTMENT_MINUTES}")
+    if align_to_slot(start) != start:
+        raise HTTPException(status_code=400, detail=f"Appointments start on {SLOT_MINUTES}-minute boundaries")
+    if start <= datetime.utcnow():
+        raise HTTPException(status_code=400, detail="Appointment must be in the future")
+    end = start + timedelta(minutes=duration)
+    if start.hour < CLINIC_OPEN_HOUR or end > start.replace(hour=CLINIC_CLOSE_HOUR, minute=0):
+        raise HTTPException(status_code=400, detail="Appointment is outside clinic hours")
+    
+    doctor = await db.users.find_one({"id": booking.doctor_id, "role": "doctor"}, NAME_FIELDS)
+    if not doctor:
+        raise HTTPException(status_code=404, detail="Doctor not found")
+    
+    schedule = await get_schedule(booking.doctor_id)
+    if schedule.conflicts(start, end):
+        raise HTTPException(status_code=409, detail="Time slot is not available")
+    
+    appointment = Appointment(
+        patient_id=current_user.id,
+        doctor_id=booking.doctor_id,
+        patient_name=current_user.full_name,
+        doctor_name=doctor["full_name"],
+        appointment_date=start,
+        duration_minutes=duration,
+        notes=booking.notes
+    )
+    
+    try:
+        await db.appointment_slots.insert_many([
+            {"doctor_id": booking.doctor_id, "slot_start": slot, "appointment_id": appointment.id}
+            for slot in slot_starts(start, duration)
+        ])
+    except BulkWriteError:
+        # Lost a race (possibly against another worker): undo the partial claim, resync the cache
+        await db.appointment_slots.delete_many({"appointment_id": appointment.id})
+        schedules.pop(booking.doctor_id, None)
+        raise HTTPException(status_code=409, detail="Time slot is not available")
+    
+    try:
+        await db.appointments.insert_one(appointment.dict())
+    except Exception:
+        # Slot rows without their appointment would block these times for good
+        await db.appointment_slots.delete_many({"appointment_id": appointment.id})
+        raise
+    schedule.add(appointment.id, start, duration)
+    return appointment
+
+@api_router.get("/appointments")
+async def get_appointments(
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    limit: int = Query(APPOINTMENT_PAGE_DEFAULT, ge=1, le=APPOINTMENT_PAGE_MAX),
+    current_user: AuthClaims = Depends(get_token_user)
+):
+    if current_user.role == "patient":
+        query = {"patient_id": current_user.id}
+    elif current_user.role == "doctor":
+        query = {"doctor_id": current_user.id}
+    else:
+        raise HTTPException(status_code=403, detail="Not authorized")
+    
+    date_range = {"$gte": to_naive_utc(start) if start else datetime.utcnow()}
+    if end:
+        date_range["$lt"] = to_naive_utc(end)
+    query["appointment_date"] = date_range
+    
+    appointments = await db.appointments.find(query, APPOINTMENT_FIELDS).sort("appointment_date", 1).to_list(limit)
+    return FastJSONResponse(appointments)
+
+@api_router.patch("/appointments/{appointment_id}/cancel")
+async def cancel_appointment(appointment_id: str, current_user: AuthClaims = Depends(get_token_user)):
+    appointment = await db.appointments.find_one_and_update(
+        {
+            "id": appointment_id,
+            "status": "scheduled",
+            "$or": [{"patient_id": current_user.id}, {"doctor_id": current_user.id}]
+        },
+        {"$set": {"status": "cancelled"}},
+        projection={"doctor_id": 1, "appointment_date": 1},
+        return_document=ReturnDocument.AFTER
+    )
+    if appointment is None:
+        raise HTTPException(status_code=404, detail="Appointment not found")
+    
+    await db.appointment_slots.delete_many({"appointment_id": appointment_id})
+    schedule = schedules.get(appointment["doctor_id"])
+    if schedule is not None:
+        schedule.remove(appointment_id, appointment["appointment_date"])
+    return {"message": "Appointment cancelled"}
+
+@api_router.get("/users/doctors/{doctor_id}/free-slots")
+async def get_free_slots(
+    doctor_id: str,
+    after: Optional[datetime] = None,
+    count: int = Query(10, ge=1, le=100),
+    duration_minutes: int = Query(30, ge=SLOT_MINUTES, le=MAX_APPOINTMENT_MINUTES),
+    current_user: AuthClaims = Depends(get_token_user)
+):
+    if duration_minutes % SLOT_MINUTES:
+        raise HTTPException(status_code=400, detail=f"Duration must be a multiple of {SLOT_MINUTES} minutes")
+    if await db.users.find_one({"id": doctor_id, "role": "doctor"}, EXISTS_FIELDS) is None:
+        raise HTTPException(status_code=404, detail="Doctor not found")
+    
+    now = datetime.utcnow()
+    after = max(to_naive_utc(after), now) if after else now
+    schedule = await get_schedule(doctor_id)
+    return {"doctor_id": doctor_id, "slots": schedule.free_slots(after, count, duration_minutes)}
+
+# Change feed
+# Real-time delivery follows what lands in the database, not the request that wrote it, so batch
+# imports, admin tools and other workers reach connected clients too. Every worker tails messages
+# and prescriptions and delivers to the sockets it holds itself (deliver_local, not the broker).
+# Replica sets and sharded clusters use a change stream; standalone and mock deployments poll the
+# (timestamp, id) and (updated_at, id) indexes. The position (resume token or poll cursors) is
+# saved in change_feed_state after each dispatched batch, so a restarted worker resumes where it
+# stopped. Workers sharing CHANGE_FEED_ID share one saved position.
+# Messages written through the API are also published directly, so chat latency never waits on a
+# poll; undelivered_frame() drops whichever copy reaches a worker second.
+CHANGE_FEED = os.environ.get("CHANGE_FEED", "auto")  # auto, change_stream, poll, off
+CHANGE_FEED_ID = os.environ.get("CHANGE_FEED_ID", socket.gethostname())
+CHANGE_FEED_BATCH_SIZE = int(os.environ.get("CHANGE_FEED_BATCH_SIZE", "100"))
+CHANGE_FEED_POLL_SECONDS = float(os.environ.get("CHANGE_FEED_POLL_SECONDS", "1.0"))
+# Polls only read rows at least this old, so a write that was still in flight is not skipped
+CHANGE_FEED_POLL_LAG_SECONDS = float(os.environ.get("CHANGE_FEED_POLL_LAG_SECONDS", "1.0"))
+CHANGE_FEED_COLLECTIONS = {
+    "messages": ("timestamp", MESSAGE_FIELDS),
+    "prescriptions": ("updated_at", PRESCRIPTION_FIELDS)
+}
+CHANGE_STREAM_HISTORY_LOST = 286
+
+class ChangeFeed:
+    def __init__(self, mode: str):
+        if mode not in ("auto", "change_stream", "poll", "off"):
+            raise RuntimeError(f"Unknown change feed mode: {mode}")
+        self.mode = mode
+        self.enabled = mode != "off"
+        self.handlers: Dict[str, list] = {}  # collection -> async handler(events)
+
+    def subscribe(self, collection: str, handler):
+        self.handlers.setdefault(collection, []).append(handler)
+
+    async def dispatch(self, events: List[dict]):
+        # Events are {"collection", "operation": insert|update, "document"}; handlers get one list per collection
+        by_collection: Dict[str, List[dict]] = {}
+        for event in events:
+            by_collection.setdefault(event["collection"], []).append(event)
+        now = datetime.utcnow()
+        for collection, batch in by_collection.items():
+            CHANGE_FEED_EVENTS.inc(collection, amount=len(batch))
+            time_field = CHANGE_FEED_COLLECTIONS[collection][0]
+            written_at = batch[-1]["document"].get(time_field)
+            if written_at is not None:
+                CHANGE_FEED_LAG_SECONDS.observe((now - written_at).total_seconds(), collection)
+            for handler in self.handlers.get(collection, ()):
+                try:
+                    await handler(batch)
+                except Exception:
+                    logger.exception(f"Change feed handler {handler.__name__} failed")
+
+    async def load_state(self) -> dict:
+        return await db.change_feed_state.find_one({"_id": CHANGE_FEED_ID}) or {}
+
+    async def save_state(self, **fields):
+        await db.change_feed_state.update_one(
+            {"_id": CHANGE_FEED_ID}, {"$set": {**fields, "updated_at": datetime.utcnow()}}, upsert=True
+        )
+
+    async def supports_change_streams(self) -> bool:
+        try:
+            reply = await db.command("hello")
+        except (PyMongoError, NotImplementedError):
+            return False
+        return bool(reply.get("setName")) or reply.get("msg") == "isdbgrid"
+
+    async def run(self):
+        mode = self.mode
+        if mode == "auto":
+            mode = "change_stream" if await self.supports_change_streams() else "poll"
+        logger.info(f"Change feed running in {mode} mode")
+        while True:
+            try:
+                await (self.tail() if mode == "change_stream" else self.poll())
+            except PyMongoError as e:
+                logger.error(f"Change feed interrupted, resuming from the saved position: {e}")
+                await asyncio.sleep(CHANGE_FEED_POLL_SECONDS)
+
+    async def tail(self):
+        token = (await self.load_state()).get("resume_token")
+        pipeline = [{"$match": {
+            "ns.coll": {"$in": list(CHANGE_FEED_COLLECTIONS)},
+            "operationType": {"$in": ["insert", "update", "replace"]}
+        }}]
+        try:
+            async with db.watch(
+                pipeline,
+                full_document="updateLookup",
+                resume_after=token,
+                batch_size=CHANGE_FEED_BATCH_SIZE,
+                max_await_time_ms=int(CHANGE_FEED_POLL_SECONDS * 1000)
+            ) as stream:
+                while True:
+                    # try_next waits up to max_await_time_ms for the first change, then drains what is buffered
+                    events = []
+                    while len(events) < CHANGE_FEED_BATCH_SIZE:
+                        change = await stream.try_next()
+                        if change is None:
+                            break
+                        collection = change["ns"]["coll"]
+                        document = change.get("fullDocument")
+                        if document is None:  # deleted before the lookup ran
+                            continue
+                        fields = CHANGE_FEED_COLLECTIONS[collection][1]
+                        events.append({
+                            "collection": collection,
+                            "operation": "insert" if change["operationType"] == "insert" else "update",
+                            "document": {k: v for k, v in document.items() if fields.get(k)}
+                        })
+                    if events:
+                        await self.dispatch(events)
+                        token = stream.resume_token
+                        await self.save_state(resume_token=token)
+        except OperationFailure as e:
+            if e.code != CHANGE_STREAM_HISTORY_LOST:
+                raise
+            logger.warning("Saved resume token has left the oplog; the change feed restarts from now")
+            await self.save_state(resume_token=None)
+
+    async def poll(self):
+        cursors = (await self.load_state()).get("poll_cursors") or {}
+        start = encode_cursor(datetime.utcnow() - timedelta(seconds=CHANGE_FEED_POLL_LAG_SECONDS), "")
+        for collection in CHANGE_FEED_COLLECTIONS:
+            cursors.setdefault(collection, start)
+        while True:
+            horizon = datetime.utcnow() - timedelta(seconds=CHANGE_FEED_POLL_LAG_SECONDS)
+            backlog = False
+            for collection, (time_field, fields) in CHANGE_FEED_COLLECTIONS.items():
+                query = keyset_filter({time_field: {"$lte": horizon}}, cursors[collection], "$gt", time_field, "id")
+                documents = await db[collection].find(query, fields).sort(
+                    [(time_field, 1), ("id", 1)]
+                ).limit(CHANGE_FEED_BATCH_SIZE).to_list(CHANGE_FEED_BATCH_SIZE)
+                if not documents:
+                    continue
+                await self.dispatch([{
+                    "collection": collection,
+                    # Polling can't see the operation; a prescription never written since creation is new
+                    "operation": "insert" if document.get("created_at", document.get(time_field)) == document[time_field] else "update",
+                    "document": document
+                } for document in documents])
+                last = documents[-1]
+                cursors[collection] = encode_cursor(last[time_field], last["id"])
+                await self.save_state(poll_cursors=cursors)
+                backlog = backlog or len(documents) == CHANGE_FEED_BATCH_SIZE
+            if not backlog:
+                await asyncio.sleep(CHANGE_FEED_POLL_SECONDS)
+
+change_feed = ChangeFeed(CHANGE_FEED)
+
+# Message ids this worker has already delivered, from either path. The TTL only needs to cover the
+# gap between a direct publish and the feed catching up to the same write.
+delivered_messages = TTLCache(max_size=10000, ttl_seconds=300)
+
+def undelivered_frame(frame: dict) -> Optional[dict]:
+    # Strips messages already delivered from new_message/new_messages frames; None if nothing is left
+    if frame.get("type") == "new_message":
+        messages = [frame["message"]]
+    elif frame.get("type") == "new_messages":
+        messages = frame["messages"]
+    else:
+        return frame
+    fresh = [message for message in messages if delivered_messages.get(message["id"]) is None]
+    for message in fresh:
+        delivered_messages.set(message["id"], True)
+    if len(fresh) == len(messages):
+        return frame
+    if not fresh:
+        return None
+    return {"type": "new_message", "message": fresh[0]} if len(fresh) == 1 else {"type": "new_messages", "messages": fresh}
+
+async def participant_chats(chat_ids) -> Dict[str, dict]:
+    cursor = db.chats.find({"id": {"$in": list(chat_ids)}}, {"_id": 0, "id": 1, "patient_id": 1, "doctor_id": 1})
+    return {chat["id"]: chat async for chat in cursor}
+
+async def deliver_message_changes(events: List[dict]):
+    # One frame per recipient per batch: new_message for a single message, new_messages for a burst
+    if not manager.user_connections:
+        return
+    messages = [event["document"] for event in events if event["operation"] == "insert"]
+    chats = await participant_chats({message["chat_id"] for message in messages})
+    outgoing: Dict[str, List[dict]] = {}
+    for message in messages:
+        chat = chats.get(message["chat_id"])
+        if chat is not None:
+            outgoing.setdefault(other_participant(chat, message["sender_id"]), []).append(message)
+    for user_id, batch in outgoing.items():
+        if len(batch) == 1:
+            await manager.deliver_local(user_id, {"type": "new_message", "message": batch[0]})
+        else:
+            await manager.deliver_local(user_id, {"type": "new_messages", "messages": batch})
+
+# Prescription lifecycle events go to the patient, the prescribing doctor and every pharmacy
+# connection subscribed to PRESCRIPTION_QUEUE_TOPIC. A recipient gets one frame per feed batch:
+# the typed event for a single change, prescription_events wrapping them for a burst.
+PRESCRIPTION_QUEUE_TOPIC = "prescription_queue"
+
+def prescription_event(event: dict) -> dict:
+    prescription = event["document"]
+    if event["operation"] == "insert":
+        name = "created"
+    elif prescription["status"] == "pending":
+        name = "released"  # lease expired or the pharmacy gave it back
+    else:
+        name = prescription["status"]  # claimed, dispensed, collected
+    return {"type": f"prescription_{name}", "prescription": prescription}
+
+def coalesce_events(events: List[dict]) -> dict:
+    return events[0] if len(events) == 1 else {"type": "prescription_events", "events": events}
+
+async def deliver_prescription_changes(events: List[dict]):
+    if not manager.user_connections:
+        return
+    frames = [prescription_event(event) for event in events]
+    outgoing: Dict[str, List[dict]] = {}
+    for frame in frames:
+        prescription = frame["prescription"]
+        for user_id in (prescription["patient_id"], prescription["doctor_id"]):
+            outgoing.setdefault(user_id, []).append(frame)
+    for user_id, batch in outgoing.items():
+        await manager.deliver_local(user_id, coalesce_events(batch))
+    manager.deliver_topic(PRESCRIPTION_QUEUE_TOPIC, coalesce_events(frames))
+
+async def index_message_changes(events: List[dict]):
+    messages = [event["document"] for event in events if event["operation"] == "insert"]
+    chats = await participant_chats({message["chat_id"] for message in messages})
+    for message in messages:
+        if message["chat_id"] in chats:
+            search_index.add_message(chats[message["chat_id"]], message)
+
+async def index_prescription_changes(events: List[dict]):
+    for event in events:
+        if event["operation"] == "insert":
+            search_index.add_prescription(event["document"])
+
+change_feed.subscribe("messages", deliver_message_changes)
+change_feed.subscribe("prescriptions", deliver_prescription_changes)
+if search_index is not None:
+    # Keeps the in-process search index current with writes made by other workers
+    change_feed.subscribe("messages", index_message_changes)
+    change_feed.subscribe("prescriptions", index_prescription_changes)
+
+# WebSocket protocol
+# Clients connect to /ws/{user_id}?token=<access token>; the token is checked once at connect time.
+# Inbound frames are JSON objects discriminated by "type". Replies to a frame echo its request_id.
+class WSSendMessage(BaseModel):
+    type: Literal["send_message"]
+    chat_id: str
+    content: str
+    message_type: str = "text"
+    request_id: Optional[str] = None
+
+class WSTyping(BaseModel):
+    type: Literal["typing"]
+    chat_id: str
+
+class WSAck(BaseModel):
+    type: Literal["ack"]
+    chat_id: str
+    message_id: str
+
+class WSSubscribe(BaseModel):
+    type: Literal["subscribe", "unsubscribe"]
+    topic: Literal["prescription_queue"]
+    request_id: Optional[str] = None
+
+ws_frame_adapter = TypeAdapter(Annotated[Union[WSSendMessage, WSTyping, WSAck, WSSubscribe], Field(discriminator="type")])
+
+class WebSocketSession:
+    def __init__(self, user: AuthClaims, connection_id: str):
+        self.user = user
+        self.connection_id = connection_id
+        self.chats: Dict[str, dict] = {}  # chat participants never change, so membership is checked once
+
+    async def chat(self, chat_id: str) -> dict:
+        if chat_id not in self.chats:
+            self.chats[chat_id] = await get_participant_chat(chat_id, self.user)
+        return self.chats[chat_id]
+
+    def reply(self, message: dict):
+        manager.send_to_connection(self.connection_id, message)
+
+    async def throttle(self, method: str, route: str):
+        # Frames that write draw from the same per-user bucket as the REST endpoint they mirror
+        if rate_limiter is None:
+            return
+        name, limit, window = route_budget(method, route)
+        allowed, tokens = await rate_limiter.take(f"{name}|user:{self.user.id}", limit, window)
+        if not allowed:
+            RATE_LIMITED.inc(name)
+            raise HTTPException(status_code=429, detail="Too many requests",
+                                headers={"Retry-After": str(math.ceil((1 - tokens) * window / limit))})
+
+    def subscription(self, frame: WSSubscribe):
+        # The prescription queue is the shared pending pool, so only pharmacies may follow it
+        if self.user.role != "pharmacy":
+            raise HTTPException(status_code=403, detail="Only pharmacies can subscribe to the prescription queue")
+        if frame.type == "subscribe":
+            manager.subscribe(self.connection_id, frame.topic)
+        else:
+            manager.unsubscribe(self.connection_id, frame.topic)
+
+    async def handle(self, text: str):
+        try:
+            frame = ws_frame_adapter.validate_json(text)
+        except ValidationError as e:
+            self.reply({"type": "error", "detail": e.errors(include_url=False, include_context=False)})
+            return
+
+        request_id = getattr(frame, "request_id", None)
+        try:
+            if isinstance(frame, WSSubscribe):
+                self.subscription(frame)
+                self.reply({"type": f"{frame.type}d", "request_id": request_id, "topic": frame.topic})
+                return
+            chat = await self.chat(frame.chat_id)
+            if isinstance(frame, WSSendMessage):
+                await self.throttle("POST", "/api/chats/{chat_id}/messages")
+                message = await post_message(chat, self.user, frame.content, frame.message_type)
+                self.reply({"type": "message_sent", "request_id": request_id, "message": message.dict()})
+            elif isinstance(frame, WSTyping):
+                await manager.send_personal_message({
+                    "type": "typing",
+                    "chat_id": frame.chat_id,
+                    "user_id": self.user.id
+                }, other_participant(chat, self.user.id))
+            elif isinstance(frame, WSAck):
+                await mark_chat_read(self.user.id, frame.chat_id)
+                await manager.send_personal_message({
+                    "type": "ack",
+                    "chat_id": frame.chat_id,
+                    "message_id": frame.message_id,
+                    "user_id": self.user.id
+                }, other_participant(chat, self.user.id))
+        except HTTPException as e:
+            error = {"type": "error", "request_id": request_id, "status": e.status_code, "detail": e.detail}
+            if e.headers and "Retry-After" in e.headers:
+                error["retry_after"] = int(e.headers["Retry-After"])
+            self.reply(error)
+        except Exception:
+            # A failed frame (e.g. MongoDB unavailable) is answered, not allowed to end the socket
+            logger.exception(f"WebSocket {frame.type} frame failed")
+            self.reply({"type": "error", "request_id": request_id, "status": 500, "detail": "Internal server error"})
+
 # WebSocket endpoint
 @app.websocket("/ws/{user_id}")
-async def websocket_endpoint(websocket: WebSocket, user_id: str):
+async def websocket_endpoint(websocket: WebSocket, user_id: str, token: Optional[str] = None):
+    try:
+        if token is None:
+            raise HTTPException(status_code=401, detail="Invalid authentication credentials")
+        user = await resolve_claims(token)
+        if user.id != user_id:
+            raise HTTPException(status_code=401, detail="Invalid authentication credentials")
+    except HTTPException:
+        await websocket.close(code=1008)
+        return
+
     connection_id = await manager.connect(websocket, user_id)
+    session = WebSocketSession(user, connection_id)
     try:
         while True:
-            data = await websocket.receive_text()
-            # Handle incoming WebSocket messages if needed
+            await session.handle(await websocket.receive_text())
     except WebSocketDisconnect:
+        pass
+    finally:
         manager.disconnect(connection_id, user_id)
 
+async def close_duplicate_active_chats():
+    # One-off migration: before chats_active_pair_unique existed, concurrent create_chat calls could
+    # open several active chats for one patient/doctor pair, and the index cannot be built over them.
+    # The most recently active chat of each pair stays open; the others are closed, which keeps their
+    # history and tombstones them in /sync. Runs until the index exists.
+    if "chats_active_pair_unique" in await db.chats.index_information():
+        return
+    duplicates = db.chats.aggregate([
+        {"$match": {"status": "active"}},
+        {"$sort": {"last_message_time": -1, "created_at": -1, "id": -1}},
+        {"$group": {"_id": {"patient_id": "$patient_id", "doctor_id": "$doctor_id"}, "ids": {"$push": "$id"}, "count": {"$sum": 1}}},
+        {"$match": {"count": {"$gt": 1}}}
+    ])
+    closed = [chat_id async for pair in duplicates for chat_id in pair["ids"][1:]]
+    if not closed:
+        return
+    now = datetime.utcnow()
+    await db.chats.update_many({"id": {"$in": closed}}, {"$set": {"status": "closed", "updated_at": now}})
+    await db.inbox.update_many({"chat_id": {"$in": closed}}, {"$set": {"status": "closed"}})
+    logger.warning(f"Closed {len(closed)} duplicate active chats before building chats_active_pair_unique")
+
+async def backfill_inbox():
+    # One-off migration for databases that predate the inbox projection
+    if await db.inbox.estimated_document_count() > 0:
+        return
+    batch = []
+    async for chat in db.chats.find({}, CHAT_FIELDS):
+        batch.append(chat)
+        if len(batch) >= 500:
+            await create_inbox_entries(batch)
+            batch = []
+    await create_inbox_entries(batch)
+
+# Metrics endpoint
+def collect_runtime_gauges():
+    for name, value in manager.stats().items():
+        WS_STATS.set(name, value=value)
+    for name, value in user_cache.stats().items():
+        USER_CACHE_STATS.set(name, value=value)
+    PASSWORD_HASH_PENDING.set(value=password_hasher.pending)
+    for name, value in mongo_pool.stats().items():
+        MONGO_POOL_STATS.set(name, value=value)
+    if isinstance(rate_limiter, MemoryBucketStore):
+        RATE_LIMIT_BUCKETS.set(value=len(rate_limiter.buckets))
+
+WS_STATS = metrics.gauge("websocket_manager", "WebSocket connection manager state", ("stat",))
+USER_CACHE_STATS = metrics.gauge("user_cache", "Authenticated user cache state", ("stat",))
+PASSWORD_HASH_PENDING = metrics.gauge("password_hash_pending", "bcrypt jobs queued or running")
+MONGO_POOL_STATS = metrics.gauge("mongo_pool", "MongoDB connection pool state", ("stat",))
+RATE_LIMIT_BUCKETS = metrics.gauge("rate_limit_buckets", "Token buckets held in this worker")
+metrics.collectors.append(collect_runtime_gauges)
+
+@app.get("/metrics", include_in_schema=False)
+async def get_metrics():
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+# Health
+HEALTH_PING_TIMEOUT_SECONDS = 2.0
+
+@app.get("/health/ready", include_in_schema=False)
+async def readiness():
+    # 503 takes the worker out of the load balancer while MongoDB is unreachable or its pool is
+    # close to exhausted, rather than letting requests queue for waitQueueTimeoutMS
+    pool = mongo_pool.stats()
+    try:
+        await asyncio.wait_for(db.command("ping"), timeout=HEALTH_PING_TIMEOUT_SECONDS)
+        mongo_ok = True
+    except (asyncio.TimeoutError, PyMongoError):
+        mongo_ok = False
+    ready = mongo_ok and pool["saturation"] < MONGO_READY_MAX_SATURATION
+    return FastJSONResponse(
+        {"status": "ready" if ready else "unavailable", "mongo": mongo_ok, "pool": pool},
+        status_code=200 if ready else 503
+    )
+
 # Include the router in the main app
 app.include_router(api_router)
 
+# Inside CORS so 429 responses still carry the CORS headers browsers need to read them
+app.add_middleware(RateLimitMiddleware)
 app.add_middleware(
     CORSMiddleware,
     allow_credentials=True,
@@ -428,6 +3260,7 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+app.add_middleware(MetricsMiddleware)
 
 # Configure logging
 logging.basicConfig(
@@ -436,6 +3269,28 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-@app.on_event("shutdown")
-async def shutdown_db_client():
+background_tasks: List[asyncio.Task] = []
+
+async def startup():
+    await open_database()
+    await manager.start()
+    background_tasks.append(asyncio.create_task(lease_sweeper()))
+    if search_index is not None:
+        background_tasks.append(asyncio.create_task(search_index.rebuild()))
+    if change_feed.enabled:
+        background_tasks.append(asyncio.create_task(change_feed.run()))
+    await close_duplicate_active_chats()
+    await ensure_indexes(db)
+    await backfill_inbox()
+    await backfill_updated_at()
+    if os.environ.get("INDEX_SELF_CHECK", "false").lower() == "true":
+        failures = await check_query_plans(db)
+        if failures:
+            raise RuntimeError(f"Query shapes falling back to COLLSCAN: {failures}")
+
+async def shutdown():
+    await manager.stop()
+    for task in background_tasks:
+        task.cancel()
+    password_hasher.shutdown()
     client.close()
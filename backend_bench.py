@@ -0,0 +1,230 @@
+import argparse
+import asyncio
+import json
+import math
+import os
+import subprocess
+import sys
+import time
+import uuid
+from datetime import datetime
+
+# Concurrent load test for the backend. Boots server:app in-process and drives the real user flows
+# (register/login, chat create, message send/read, prescribe, claim/dispense, WebSocket fan-out)
+# from many simulated patient/doctor/pharmacy groups at once.
+#
+#   python backend_bench.py                                  # mongomock-motor stand-in
+#   python backend_bench.py --mongo-url mongodb://localhost:27017 --groups 50 --messages 40
+#   python backend_bench.py --output run.json --compare previous.json
+#
+# Requires httpx, plus mongomock-motor when no --mongo-url is given.
+BACKEND_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "backend")
+sys.path.insert(0, BACKEND_DIR)
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Concurrent benchmark for the MedAssist backend")
+    parser.add_argument("--mongo-url", help="Run against this mongod instead of mongomock-motor")
+    parser.add_argument("--db-name", default=f"bench_{uuid.uuid4().hex[:8]}")
+    parser.add_argument("--groups", type=int, default=10, help="Concurrent patient/doctor pairs")
+    parser.add_argument("--messages", type=int, default=20, help="Messages each participant sends")
+    parser.add_argument("--prescriptions", type=int, default=3, help="Prescriptions per pair")
+    parser.add_argument("--pharmacies", type=int, default=3)
+    parser.add_argument("--output", help="Write the JSON report here instead of stdout")
+    parser.add_argument("--compare", help="Previous JSON report to diff p95 latencies against")
+    return parser.parse_args()
+
+def boot_server(args):
+    os.environ["MONGO_URL"] = args.mongo_url or "mongodb://localhost:27017"
+    os.environ["DB_NAME"] = args.db_name
+    # Every simulated client shares one IP, which the register/login budgets would throttle
+    os.environ.setdefault("RATE_LIMIT_BACKEND", "off")
+    import server
+
+    if not args.mongo_url:
+        from mongomock_motor import AsyncMongoMockClient
+        from tests.mongomock_compat import keep_id_in_find_and_modify
+        keep_id_in_find_and_modify()
+        server.create_mongo_client = AsyncMongoMockClient
+    return server
+
+class Recorder:
+    def __init__(self):
+        self.samples = {}  # endpoint -> [latency seconds]
+        self.errors = {}   # endpoint -> count
+
+    def record(self, endpoint: str, seconds: float, ok: bool):
+        self.samples.setdefault(endpoint, []).append(seconds)
+        if not ok:
+            self.errors[endpoint] = self.errors.get(endpoint, 0) + 1
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    # Nearest-rank percentile
+    return sorted_values[max(0, math.ceil(fraction * len(sorted_values)) - 1)]
+
+class BenchWebSocket:
+    # Stands in for a client socket so fan-out is measured end to end inside the server process
+    def __init__(self, recorder: Recorder, pending: dict):
+        self.recorder = recorder
+        self.pending = pending
+
+    async def accept(self):
+        pass
+
+    async def send_text(self, text: str):
+        frame = json.loads(text)
+        if frame.get("type") == "new_message":
+            messages = [frame["message"]]
+        elif frame.get("type") == "new_messages":
+            messages = frame["messages"]
+        else:
+            return
+        for message in messages:
+            sent_at = self.pending.pop(message["content"], None)
+            if sent_at is not None:
+                self.recorder.record("WS fan-out new_message", time.perf_counter() - sent_at, True)
+
+    async def close(self, code: int = 1000):
+        pass
+
+async def call(http, recorder, endpoint, method, url, expect=(200,), **kwargs):
+    started = time.perf_counter()
+    response = await http.request(method, url, **kwargs)
+    recorder.record(endpoint, time.perf_counter() - started, response.status_code in expect)
+    return response
+
+async def register(http, recorder, role, **extra):
+    body = {
+        "email": f"{role}_{uuid.uuid4().hex}@bench.local",
+        "password": "bench-password",
+        "full_name": f"Bench {role.title()}",
+        "role": role,
+        **extra
+    }
+    response = await call(http, recorder, "POST /api/auth/register", "POST", "/api/auth/register", json=body)
+    data = response.json()
+    await call(http, recorder, "POST /api/auth/login", "POST", "/api/auth/login",
+               json={"email": body["email"], "password": body["password"]})
+    return data["user"]["id"], {"Authorization": f"Bearer {data['access_token']}"}
+
+async def run_group(server, http, recorder, args, pharmacies):
+    pending = {}
+    patient_id, patient = await register(http, recorder, "patient")
+    doctor_id, doctor = await register(http, recorder, "doctor", specialization="Cardiology")
+    await server.manager.connect(BenchWebSocket(recorder, pending), doctor_id)
+    await server.manager.connect(BenchWebSocket(recorder, pending), patient_id)
+
+    await call(http, recorder, "GET /api/users/doctors", "GET", "/api/users/doctors", headers=patient)
+    response = await call(http, recorder, "POST /api/chats", "POST", "/api/chats",
+                          params={"doctor_id": doctor_id}, headers=patient)
+    chat_id = response.json()["id"]
+
+    for i in range(args.messages):
+        for sender in (patient, doctor):
+            content = f"bench {uuid.uuid4().hex} #{i}"
+            pending[content] = time.perf_counter()
+            await call(http, recorder, "POST /api/chats/{chat_id}/messages", "POST",
+                       f"/api/chats/{chat_id}/messages", params={"content": content}, headers=sender)
+        await call(http, recorder, "GET /api/chats/{chat_id}/messages", "GET",
+                   f"/api/chats/{chat_id}/messages", headers=patient)
+        await call(http, recorder, "GET /api/inbox", "GET", "/api/inbox", headers=doctor)
+
+    for _ in range(args.prescriptions):
+        await call(http, recorder, "POST /api/prescriptions", "POST", "/api/prescriptions",
+                   params={"patient_id": patient_id, "diagnosis": "Hypertension", "instructions": "Once daily"},
+                   json=[{"name": "Amlodipine", "dosage": "5mg"}], headers=doctor)
+    await call(http, recorder, "GET /api/prescriptions", "GET", "/api/prescriptions", headers=patient)
+
+    for i in range(args.prescriptions):
+        pharmacy = pharmacies[i % len(pharmacies)]
+        response = await call(http, recorder, "POST /api/prescriptions/claim", "POST",
+                              "/api/prescriptions/claim", expect=(200, 404), headers=pharmacy)
+        if response.status_code == 200:
+            await call(http, recorder, "PATCH /api/prescriptions/{prescription_id}/dispense", "PATCH",
+                       f"/api/prescriptions/{response.json()['id']}/dispense", headers=pharmacy)
+
+def build_report(recorder, args, wall_seconds, mongo_mode):
+    endpoints = {}
+    for endpoint, samples in sorted(recorder.samples.items()):
+        ordered = sorted(samples)
+        endpoints[endpoint] = {
+            "count": len(ordered),
+            "errors": recorder.errors.get(endpoint, 0),
+            "p50_ms": round(percentile(ordered, 0.50) * 1000, 3),
+            "p95_ms": round(percentile(ordered, 0.95) * 1000, 3),
+            "p99_ms": round(percentile(ordered, 0.99) * 1000, 3),
+            "max_ms": round(ordered[-1] * 1000, 3),
+            "requests_per_second": round(len(ordered) / wall_seconds, 2)
+        }
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        commit = None
+    total = sum(e["count"] for name, e in endpoints.items() if not name.startswith("WS "))
+    return {
+        "recorded_at": datetime.utcnow().isoformat(),
+        "commit": commit,
+        "mongo": mongo_mode,
+        "params": {k: v for k, v in vars(args).items() if k not in ("output", "compare")},
+        "wall_seconds": round(wall_seconds, 3),
+        "total_requests": total,
+        "requests_per_second": round(total / wall_seconds, 2),
+        "endpoints": endpoints
+    }
+
+def print_summary(report, previous=None):
+    out = sys.stderr
+    print(f"{report['total_requests']} requests in {report['wall_seconds']}s "
+          f"({report['requests_per_second']} req/s, mongo={report['mongo']})", file=out)
+    print(f"{'endpoint':<56}{'count':>7}{'err':>5}{'p50':>9}{'p95':>9}{'p99':>9}{'req/s':>9}", file=out)
+    for name, e in report["endpoints"].items():
+        line = f"{name:<56}{e['count']:>7}{e['errors']:>5}{e['p50_ms']:>9.2f}{e['p95_ms']:>9.2f}{e['p99_ms']:>9.2f}{e['requests_per_second']:>9.1f}"
+        before = (previous or {}).get("endpoints", {}).get(name)
+        if before and before["p95_ms"]:
+            line += f"   p95 {(e['p95_ms'] - before['p95_ms']) / before['p95_ms'] * 100:+.1f}%"
+        print(line, file=out)
+
+async def main():
+    args = parse_args()
+    try:
+        import httpx
+    except ImportError:
+        sys.exit("backend_bench.py needs httpx: pip install httpx")
+    server = boot_server(args)
+    recorder = Recorder()
+
+    lifespan = server.app.router.lifespan_context(server.app)
+    await lifespan.__aenter__()
+    try:
+        transport = httpx.ASGITransport(app=server.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench") as http:
+            started = time.perf_counter()
+            pharmacies = [(await register(http, recorder, "pharmacy", license_number=f"PH{i}"))[1]
+                          for i in range(args.pharmacies)]
+            await asyncio.gather(*(run_group(server, http, recorder, args, pharmacies) for _ in range(args.groups)))
+            # Let the change feed pick up the last writes and the writer tasks flush their frames
+            feed_delay = server.CHANGE_FEED_POLL_SECONDS + server.CHANGE_FEED_POLL_LAG_SECONDS if server.change_feed.enabled else 0
+            await asyncio.sleep(0.1 + feed_delay)
+            wall_seconds = time.perf_counter() - started
+    finally:
+        if args.mongo_url:
+            await server.client.drop_database(args.db_name)
+        await lifespan.__aexit__(None, None, None)
+
+    report = build_report(recorder, args, wall_seconds, "mongod" if args.mongo_url else "mongomock")
+    previous = None
+    if args.compare:
+        with open(args.compare) as f:
+            previous = json.load(f)
+    print_summary(report, previous)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+if __name__ == "__main__":
+    asyncio.run(main())
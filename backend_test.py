@@ -353,7 +353,7 @@ def test_message_retrieval():
     response = requests.get(f"{API_URL}/chats/{chat_id}/messages", headers=headers)
     
     if response.status_code == 200:
-        data = response.json()
+        data = response.json()["messages"]
         if len(data) >= 2:  # Should have at least the two messages we sent
             patient_msg = next((msg for msg in data if msg["sender_id"] == user_ids["patient"]), None)
             doctor_msg = next((msg for msg in data if msg["sender_id"] == user_ids["doctor"]), None)
@@ -584,10 +584,10 @@ def test_database_operations():
     # Test if data is persisted correctly
     # 1. Check if users are stored
     headers = {"Authorization": f"Bearer {tokens['doctor']}"}
-    response = requests.get(f"{API_URL}/users/doctors", headers=headers)
+    response = requests.get(f"{API_URL}/users/doctors", params={"q": test_doctor["full_name"], "limit": 200}, headers=headers)
     
     if response.status_code == 200:
-        data = response.json()
+        data = response.json()["doctors"]
         if any(doc["id"] == user_ids["doctor"] for doc in data):
             details.append("User data persistence verified")
         else:
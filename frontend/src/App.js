@@ -19,6 +19,35 @@ const AuthProvider = ({ children }) => {
     }
   }, [token]);
 
+  // Access tokens are short-lived: on a 401, exchange the refresh token once and retry
+  useEffect(() => {
+    const interceptor = axios.interceptors.response.use(null, async (error) => {
+      const original = error.config;
+      const refreshToken = localStorage.getItem('refresh_token');
+      if (error.response?.status !== 401 || !refreshToken || original._retried || original.url === `${API}/auth/refresh`) {
+        return Promise.reject(error);
+      }
+      original._retried = true;
+      try {
+        const response = await axios.post(`${API}/auth/refresh`, { refresh_token: refreshToken });
+        storeTokens(response.data);
+        original.headers['Authorization'] = `Bearer ${response.data.access_token}`;
+        return axios(original);
+      } catch (refreshError) {
+        logout();
+        return Promise.reject(error);
+      }
+    });
+    return () => axios.interceptors.response.eject(interceptor);
+  }, []);
+
+  const storeTokens = ({ access_token, refresh_token }) => {
+    setToken(access_token);
+    localStorage.setItem('token', access_token);
+    localStorage.setItem('refresh_token', refresh_token);
+    axios.defaults.headers.common['Authorization'] = `Bearer ${access_token}`;
+  };
+
   const fetchUserProfile = async () => {
     try {
       const response = await axios.get(`${API}/users/me`);
@@ -32,12 +61,8 @@ const AuthProvider = ({ children }) => {
   const login = async (email, password) => {
     try {
       const response = await axios.post(`${API}/auth/login`, { email, password });
-      const { access_token, user: userData } = response.data;
-      
-      setToken(access_token);
-      setUser(userData);
-      localStorage.setItem('token', access_token);
-      axios.defaults.headers.common['Authorization'] = `Bearer ${access_token}`;
+      storeTokens(response.data);
+      setUser(response.data.user);
       
       return { success: true };
     } catch (error) {
@@ -48,12 +73,8 @@ const AuthProvider = ({ children }) => {
   const register = async (userData) => {
     try {
       const response = await axios.post(`${API}/auth/register`, userData);
-      const { access_token, user: newUser } = response.data;
-      
-      setToken(access_token);
-      setUser(newUser);
-      localStorage.setItem('token', access_token);
-      axios.defaults.headers.common['Authorization'] = `Bearer ${access_token}`;
+      storeTokens(response.data);
+      setUser(response.data.user);
       
       return { success: true };
     } catch (error) {
@@ -65,6 +86,7 @@ const AuthProvider = ({ children }) => {
     setUser(null);
     setToken(null);
     localStorage.removeItem('token');
+    localStorage.removeItem('refresh_token');
     delete axios.defaults.headers.common['Authorization'];
   };
 
@@ -549,6 +571,7 @@ const PatientDashboard = () => {
   const [prescriptions, setPrescriptions] = useState([]);
   const [selectedChat, setSelectedChat] = useState(null);
   const [messages, setMessages] = useState([]);
+  const [earlierCursor, setEarlierCursor] = useState(null);
   const [newMessage, setNewMessage] = useState('');
   const [activeTab, setActiveTab] = useState('dashboard');
 
@@ -566,8 +589,16 @@ const PatientDashboard = () => {
 
   const fetchDoctors = async () => {
     try {
-      const response = await axios.get(`${API}/users/doctors`);
-      setDoctors(response.data);
+      // The directory is paged; follow next_cursor until the last page
+      let doctors = [];
+      let cursor = null;
+      do {
+        const query = cursor ? `?after=${encodeURIComponent(cursor)}` : '';
+        const response = await axios.get(`${API}/users/doctors${query}`);
+        doctors = doctors.concat(response.data.doctors);
+        cursor = response.data.next_cursor;
+      } while (cursor);
+      setDoctors(doctors);
     } catch (error) {
       console.error('Failed to fetch doctors:', error);
     }
@@ -591,15 +622,38 @@ const PatientDashboard = () => {
     }
   };
 
-  const fetchMessages = async (chatId) => {
+  const fetchMessages = async (chatId, keepEarlier = false) => {
     try {
       const response = await axios.get(`${API}/chats/${chatId}/messages`);
-      setMessages(response.data);
+      const page = response.data.messages;
+      if (keepEarlier) {
+        // Refreshing the newest page keeps anything already loaded with "Load earlier"
+        const pageIds = new Set(page.map((message) => message.id));
+        setMessages((current) => [
+          ...current.filter((message) => !pageIds.has(message.id) && (!page.length || message.timestamp <= page[0].timestamp)),
+          ...page
+        ]);
+      } else {
+        setMessages(page);
+        setEarlierCursor(response.data.next_cursor);
+      }
     } catch (error) {
       console.error('Failed to fetch messages:', error);
     }
   };
 
+  const loadEarlierMessages = async () => {
+    if (!selectedChat || !earlierCursor) return;
+
+    try {
+      const response = await axios.get(`${API}/chats/${selectedChat.id}/messages?before=${encodeURIComponent(earlierCursor)}`);
+      setMessages((current) => [...response.data.messages, ...current]);
+      setEarlierCursor(response.data.next_cursor);
+    } catch (error) {
+      console.error('Failed to load earlier messages:', error);
+    }
+  };
+
   const startChat = async (doctorId) => {
     try {
       const response = await axios.post(`${API}/chats?doctor_id=${doctorId}`);
@@ -617,7 +671,7 @@ const PatientDashboard = () => {
     try {
       await axios.post(`${API}/chats/${selectedChat.id}/messages?content=${encodeURIComponent(newMessage)}`);
       setNewMessage('');
-      fetchMessages(selectedChat.id);
+      fetchMessages(selectedChat.id, true);
     } catch (error) {
       console.error('Failed to send message:', error);
     }
@@ -801,6 +855,16 @@ const PatientDashboard = () => {
                       </h3>
                     </div>
                     <div className="flex-1 overflow-y-auto p-4 space-y-3">
+                      {earlierCursor && (
+                        <div className="text-center">
+                          <button
+                            onClick={loadEarlierMessages}
+                            className="text-sm text-blue-600 hover:text-blue-800"
+                          >
+                            Load earlier messages
+                          </button>
+                        </div>
+                      )}
                       {messages.map((message) => (
                         <div
                           key={message.id}
@@ -911,6 +975,7 @@ const DoctorDashboard = () => {
   const [prescriptions, setPrescriptions] = useState([]);
   const [selectedChat, setSelectedChat] = useState(null);
   const [messages, setMessages] = useState([]);
+  const [earlierCursor, setEarlierCursor] = useState(null);
   const [newMessage, setNewMessage] = useState('');
   const [activeTab, setActiveTab] = useState('dashboard');
   const [showPrescriptionForm, setShowPrescriptionForm] = useState(false);
@@ -949,22 +1014,45 @@ const DoctorDashboard = () => {
     }
   };
 
-  const fetchMessages = async (chatId) => {
+  const fetchMessages = async (chatId, keepEarlier = false) => {
     try {
       const response = await axios.get(`${API}/chats/${chatId}/messages`);
-      setMessages(response.data);
+      const page = response.data.messages;
+      if (keepEarlier) {
+        // Refreshing the newest page keeps anything already loaded with "Load earlier"
+        const pageIds = new Set(page.map((message) => message.id));
+        setMessages((current) => [
+          ...current.filter((message) => !pageIds.has(message.id) && (!page.length || message.timestamp <= page[0].timestamp)),
+          ...page
+        ]);
+      } else {
+        setMessages(page);
+        setEarlierCursor(response.data.next_cursor);
+      }
     } catch (error) {
       console.error('Failed to fetch messages:', error);
     }
   };
 
+  const loadEarlierMessages = async () => {
+    if (!selectedChat || !earlierCursor) return;
+
+    try {
+      const response = await axios.get(`${API}/chats/${selectedChat.id}/messages?before=${encodeURIComponent(earlierCursor)}`);
+      setMessages((current) => [...response.data.messages, ...current]);
+      setEarlierCursor(response.data.next_cursor);
+    } catch (error) {
+      console.error('Failed to load earlier messages:', error);
+    }
+  };
+
   const sendMessage = async () => {
     if (!newMessage.trim() || !selectedChat) return;
 
     try {
       await axios.post(`${API}/chats/${selectedChat.id}/messages?content=${encodeURIComponent(newMessage)}`);
       setNewMessage('');
-      fetchMessages(selectedChat.id);
+      fetchMessages(selectedChat.id, true);
     } catch (error) {
       console.error('Failed to send message:', error);
     }
@@ -1145,6 +1233,16 @@ const DoctorDashboard = () => {
                       </button>
                     </div>
                     <div className="flex-1 overflow-y-auto p-4 space-y-3">
+                      {earlierCursor && (
+                        <div className="text-center">
+                          <button
+                            onClick={loadEarlierMessages}
+                            className="text-sm text-blue-600 hover:text-blue-800"
+                          >
+                            Load earlier messages
+                          </button>
+                        </div>
+                      )}
                       {messages.map((message) => (
                         <div
                           key={message.id}
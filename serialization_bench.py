@@ -0,0 +1,85 @@
+import os
+import sys
+import time
+import uuid
+import json
+import statistics
+from datetime import datetime, timedelta
+
+# Compares the current chat history response path against the fast serialization layer
+# on a 1000-message history. Usage: python serialization_bench.py [messages] [rounds]
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "backend"))
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+os.environ.setdefault("DB_NAME", "bench")
+
+from fastapi.encoders import jsonable_encoder
+from starlette.responses import JSONResponse
+import server
+
+MESSAGES = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+ROUNDS = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+
+def make_history(count):
+    # Shaped like documents read back from db.messages (including _id)
+    chat_id = str(uuid.uuid4())
+    start = datetime.utcnow()
+    return [
+        {
+            "_id": uuid.uuid4().hex[:24],
+            "id": str(uuid.uuid4()),
+            "chat_id": chat_id,
+            "sender_id": str(uuid.uuid4()),
+            "sender_name": "Dr. Test Doctor",
+            "sender_role": "doctor",
+            "content": f"Message {i}: please take the medication twice a day after meals.",
+            "timestamp": start + timedelta(milliseconds=i),
+            "message_type": "text"
+        }
+        for i in range(count)
+    ]
+
+def current_response(docs):
+    messages = [server.Message(**msg) for msg in docs]
+    return JSONResponse(jsonable_encoder({"messages": messages, "next_cursor": None})).body
+
+def projected(docs):
+    # What the fast path actually reads: the find() projection drops _id and unlisted fields
+    return [{k: v for k, v in doc.items() if k in server.MESSAGE_FIELDS and server.MESSAGE_FIELDS[k]} for doc in docs]
+
+def fast_response(docs):
+    return server.FastJSONResponse({"messages": docs, "next_cursor": None}).body
+
+def current_ws_payloads(docs):
+    return [json.dumps({"type": "new_message", "message": server.Message(**msg).dict()}, default=str) for msg in docs]
+
+def fast_ws_payloads(docs):
+    return [server.encode_json({"type": "new_message", "message": msg}).decode() for msg in docs]
+
+def measure(func, docs):
+    func(docs)  # warm-up
+    samples = []
+    for _ in range(ROUNDS):
+        started = time.perf_counter()
+        func(docs)
+        samples.append((time.perf_counter() - started) * 1000)
+    return statistics.median(samples), min(samples)
+
+def main():
+    docs = make_history(MESSAGES)
+    lean_docs = projected(docs)
+    assert json.loads(current_response(docs)) == json.loads(fast_response(lean_docs)), "response bodies differ"
+
+    print(f"{MESSAGES} messages, {ROUNDS} rounds, orjson={'yes' if server.orjson else 'no'}")
+    for name, current, fast in [
+        ("HTTP history response", current_response, fast_response),
+        ("WebSocket payloads", current_ws_payloads, fast_ws_payloads),
+    ]:
+        current_median, current_min = measure(current, docs)
+        fast_median, fast_min = measure(fast, lean_docs)
+        print(f"{name}:")
+        print(f"  current: median {current_median:.2f} ms, min {current_min:.2f} ms")
+        print(f"  fast:    median {fast_median:.2f} ms, min {fast_min:.2f} ms")
+        print(f"  speedup: {current_median / fast_median:.1f}x")
+
+if __name__ == "__main__":
+    main()
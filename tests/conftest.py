@@ -0,0 +1,69 @@
+import os
+import sys
+import uuid
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "backend"))
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+os.environ.setdefault("DB_NAME", "medassist_test")
+# Every test client shares one address; tests that exercise limiting install their own store
+os.environ.setdefault("RATE_LIMIT_BACKEND", "off")
+
+import httpx  # noqa: E402
+from fastapi.testclient import TestClient  # noqa: E402
+from mongomock_motor import AsyncMongoMockClient  # noqa: E402
+
+import server  # noqa: E402
+from tests.mongomock_compat import keep_id_in_find_and_modify  # noqa: E402
+
+keep_id_in_find_and_modify()
+
+# Minimum bcrypt cost: registrations dominate test time otherwise
+server.pwd_context.update(bcrypt__rounds=4)
+
+@pytest.fixture
+def anyio_backend():
+    return "asyncio"
+
+@pytest.fixture
+def fresh_app(monkeypatch):
+    # A fresh mongomock database and empty process caches per test, served through the real lifespan
+    monkeypatch.setattr(server, "create_mongo_client", AsyncMongoMockClient)
+    # shutdown() stops the hashing pool for good, so each lifespan gets its own
+    monkeypatch.setattr(server, "password_hasher", server.PasswordHasher(workers=2, max_pending=64, retry_after_seconds=1))
+    for cache in (server.user_cache, server.token_versions, server.idempotency_cache, server.delivered_messages):
+        cache.clear()
+    server.doctor_directory.invalidate()
+    server.schedules.clear()
+    return server.app
+
+@pytest.fixture
+async def api(fresh_app):
+    async with fresh_app.router.lifespan_context(fresh_app):
+        transport = httpx.ASGITransport(app=fresh_app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+            yield client
+
+@pytest.fixture
+def client(fresh_app):
+    # Synchronous client, for WebSocket tests
+    with TestClient(fresh_app) as client:
+        yield client
+
+@pytest.fixture
+def register(api):
+    async def register(role: str, **extra):
+        body = {
+            "email": f"{role}_{uuid.uuid4().hex}@test.local",
+            "password": "test-password",
+            "full_name": f"Test {role.title()} {uuid.uuid4().hex[:6]}",
+            "role": role,
+            **extra
+        }
+        response = await api.post("/api/auth/register", json=body)
+        assert response.status_code == 200, response.text
+        data = response.json()
+        return data["user"]["id"], {"Authorization": f"Bearer {data['access_token']}"}
+    return register
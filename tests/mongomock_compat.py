@@ -0,0 +1,24 @@
+# Fixes for the mongomock stand-in, shared by the test suite and backend_bench.py
+from mongomock.collection import Collection
+
+def keep_id_in_find_and_modify():
+    # mongomock's find_one_and_update re-targets the update by the _id of the document it found. When
+    # the projection leaves _id out, as every production projection does, it falls back to the raw
+    # filter: the update hits the first match in insertion order (ignoring sort), and
+    # ReturnDocument.AFTER re-reads with a filter the updated document may no longer match.
+    # MongoDB has neither problem, so always fetch _id and drop it again when it was not asked for.
+    original = Collection._find_and_modify
+    if getattr(original, "keeps_id", False):
+        return
+
+    def find_and_modify(self, query, projection=None, *args, **kwargs):
+        hide_id = isinstance(projection, dict) and not projection.get("_id", 1)
+        if hide_id:
+            projection = {**projection, "_id": 1}
+        result = original(self, query, projection, *args, **kwargs)
+        if hide_id and result is not None:
+            result.pop("_id", None)
+        return result
+
+    find_and_modify.keeps_id = True
+    Collection._find_and_modify = find_and_modify
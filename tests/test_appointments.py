@@ -0,0 +1,130 @@
+from datetime import datetime, timedelta
+
+import pytest
+from pymongo.errors import AutoReconnect
+
+import server
+from server import DoctorSchedule, align_to_slot
+
+DAY = datetime(2030, 1, 7)
+
+def at(hour: int, minute: int = 0) -> datetime:
+    return DAY.replace(hour=hour, minute=minute)
+
+def schedule(*intervals) -> DoctorSchedule:
+    return DoctorSchedule([
+        {"id": f"a{i}", "appointment_date": start, "duration_minutes": minutes}
+        for i, (start, minutes) in enumerate(intervals)
+    ])
+
+def test_align_to_slot_rounds_up_to_the_grid():
+    assert align_to_slot(at(10)) == at(10)
+    assert align_to_slot(at(10, 1)) == at(10, 15)
+    assert align_to_slot(at(10, 14).replace(second=59, microsecond=500000)) == at(10, 15)
+    assert align_to_slot(at(10, 45).replace(microsecond=1)) == at(11)
+    assert align_to_slot(at(23, 50)) == DAY + timedelta(days=1)
+
+@pytest.mark.parametrize("start, end, expected", [
+    (at(9, 30), at(10), False),      # ends where the first booking starts
+    (at(10, 30), at(11), False),     # fills the gap exactly
+    (at(12), at(12, 30), False),     # starts where the last booking ends
+    (at(9, 45), at(10, 15), True),   # overlaps the start
+    (at(10, 15), at(10, 45), True),  # overlaps the end
+    (at(11, 15), at(11, 30), True),  # inside a booking
+    (at(9), at(13), True),           # covers everything
+])
+def test_conflicts(start, end, expected):
+    booked = schedule((at(10), 30), (at(11), 60))
+    assert booked.conflicts(start, end) is expected
+
+def test_add_and_remove_keep_intervals_sorted():
+    booked = schedule((at(11), 30))
+    booked.add("early", at(9), 15)
+    booked.add("late", at(15), 60)
+    assert booked.starts == [at(9), at(11), at(15)]
+    assert booked.ends == [at(9, 15), at(11, 30), at(16)]
+
+    booked.remove("early", at(9))
+    booked.remove("missing", at(15))
+    assert booked.ids == ["a0", "late"]
+    assert not booked.conflicts(at(9), at(9, 15))
+
+def test_free_slots_skip_bookings():
+    booked = schedule((at(9), 30), (at(10), 60))
+    assert booked.free_slots(at(8), 3, 30) == [at(9, 30), at(11), at(11, 30)]
+
+def test_free_slots_roll_over_to_the_next_day():
+    slots = schedule().free_slots(at(16, 40), 2, 30)
+    assert slots == [at(9) + timedelta(days=1), at(9, 30) + timedelta(days=1)]
+
+def test_free_slots_never_conflict():
+    booked = schedule((at(9, 15), 45), (at(10, 30), 15), (at(13), 120), (at(16, 45), 15))
+    slots = booked.free_slots(at(8), 12, 30)
+    assert len(slots) == 12
+    for slot in slots:
+        assert align_to_slot(slot) == slot
+        assert not booked.conflicts(slot, slot + timedelta(minutes=30))
+        assert slot.hour >= server.CLINIC_OPEN_HOUR and \
+            slot + timedelta(minutes=30) <= slot.replace(hour=server.CLINIC_CLOSE_HOUR, minute=0)
+
+def booking_time(hour: int, minute: int = 0) -> datetime:
+    return (datetime.utcnow() + timedelta(days=2)).replace(hour=hour, minute=minute, second=0, microsecond=0)
+
+async def book(api, headers, doctor_id, start: datetime, minutes: int = 30):
+    return await api.post("/api/appointments", headers=headers, json={
+        "doctor_id": doctor_id, "appointment_date": start.isoformat(), "duration_minutes": minutes
+    })
+
+@pytest.mark.anyio
+@pytest.mark.parametrize("start, minutes", [
+    ((10, 5), 30),   # off the slot grid
+    ((10, 0), 20),   # not a whole number of slots
+    ((10, 0), 0),
+    ((8, 45), 30),   # before opening
+    ((16, 45), 30),  # runs past closing
+])
+async def test_booking_rejects_times_off_the_grid(api, register, start, minutes):
+    doctor_id, _ = await register("doctor")
+    _, patient = await register("patient")
+    response = await book(api, patient, doctor_id, booking_time(*start), minutes)
+    assert response.status_code == 400
+    assert await server.db.appointment_slots.count_documents({}) == 0
+
+@pytest.mark.anyio
+async def test_booking_conflicts_are_rejected(api, register):
+    doctor_id, _ = await register("doctor")
+    _, patient = await register("patient")
+    assert (await book(api, patient, doctor_id, booking_time(10), 60)).status_code == 200
+    assert (await book(api, patient, doctor_id, booking_time(10, 45), 30)).status_code == 409
+    assert (await book(api, patient, doctor_id, booking_time(11), 30)).status_code == 200
+
+@pytest.mark.anyio
+async def test_slot_index_rejects_a_booking_the_cache_missed(api, register):
+    # Another worker booked 10:15 after this worker loaded the schedule; the unique slot index
+    # must reject the overlap and the partial claim must be rolled back
+    doctor_id, _ = await register("doctor")
+    _, patient = await register("patient")
+    await server.get_schedule(doctor_id)
+    await server.db.appointment_slots.insert_one(
+        {"doctor_id": doctor_id, "slot_start": booking_time(10, 15), "appointment_id": "elsewhere"}
+    )
+
+    response = await book(api, patient, doctor_id, booking_time(10), 30)
+    assert response.status_code == 409
+    assert await server.db.appointment_slots.count_documents({"appointment_id": {"$ne": "elsewhere"}}) == 0
+    assert await server.db.appointments.count_documents({}) == 0
+
+@pytest.mark.anyio
+async def test_failed_appointment_insert_frees_its_slots(api, register, monkeypatch):
+    doctor_id, _ = await register("doctor")
+    _, patient = await register("patient")
+
+    async def unavailable(*args, **kwargs):
+        raise AutoReconnect("connection reset")
+
+    with monkeypatch.context() as patched:
+        patched.setattr(type(server.db.appointments), "insert_one", unavailable)
+        with pytest.raises(AutoReconnect):
+            await book(api, patient, doctor_id, booking_time(10), 30)
+    assert await server.db.appointment_slots.count_documents({}) == 0
+    assert (await book(api, patient, doctor_id, booking_time(10), 30)).status_code == 200
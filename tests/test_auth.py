@@ -0,0 +1,79 @@
+import asyncio
+import uuid
+
+import pytest
+
+import server
+
+pytestmark = pytest.mark.anyio
+
+async def test_concurrent_registrations_with_one_email(api):
+    body = {"email": "twin@test.local", "password": "test-password", "full_name": "Twin", "role": "patient"}
+    responses = await asyncio.gather(*(api.post("/api/auth/register", json=body) for _ in range(3)))
+    assert sorted(response.status_code for response in responses) == [200, 400, 400]
+    assert all(response.json()["detail"] == "Email already registered"
+               for response in responses if response.status_code == 400)
+    assert await server.db.users.count_documents({"email": "twin@test.local"}) == 1
+
+async def sign_up(api, role: str = "patient") -> dict:
+    response = await api.post("/api/auth/register", json={
+        "email": f"{role}_{uuid.uuid4().hex}@test.local", "password": "test-password",
+        "full_name": "Test User", "role": role
+    })
+    assert response.status_code == 200
+    return response.json()
+
+def bearer(tokens: dict) -> dict:
+    return {"Authorization": f"Bearer {tokens['access_token']}"}
+
+async def accepted(api, token: str) -> tuple:
+    # (claims-only endpoint, DB-backed endpoint)
+    headers = {"Authorization": f"Bearer {token}"}
+    return (await api.get("/api/chats", headers=headers)).status_code, \
+        (await api.get("/api/users/me", headers=headers)).status_code
+
+async def refresh(api, token: str):
+    return await api.post("/api/auth/refresh", json={"refresh_token": token})
+
+async def test_refresh_issues_a_working_pair(api):
+    tokens = await sign_up(api)
+    rotated = await refresh(api, tokens["refresh_token"])
+    assert rotated.status_code == 200
+    rotated = rotated.json()
+    assert rotated["token_type"] == "bearer" and rotated["expires_in"] == server.ACCESS_TOKEN_MINUTES * 60
+    assert await accepted(api, rotated["access_token"]) == (200, 200)
+    assert (await refresh(api, rotated["refresh_token"])).status_code == 200
+
+async def test_token_types_are_not_interchangeable(api):
+    tokens = await sign_up(api)
+    assert await accepted(api, tokens["refresh_token"]) == (401, 401)
+    assert (await refresh(api, tokens["access_token"])).status_code == 401
+    assert (await refresh(api, "not-a-token")).status_code == 401
+
+async def test_revoke_rejects_every_earlier_token(api):
+    tokens = await sign_up(api)
+    bystander = await sign_up(api)
+    revoked = await api.post("/api/auth/revoke", headers=bearer(tokens))
+    assert revoked.status_code == 200
+    fresh = revoked.json()
+
+    assert await accepted(api, tokens["access_token"]) == (401, 401)
+    assert (await refresh(api, tokens["refresh_token"])).status_code == 401
+    assert await accepted(api, fresh["access_token"]) == (200, 200)
+    assert (await refresh(api, fresh["refresh_token"])).status_code == 200
+    # Only the caller's sessions are signed out
+    assert await accepted(api, bystander["access_token"]) == (200, 200)
+    assert (await refresh(api, bystander["refresh_token"])).status_code == 200
+
+async def test_revocation_seen_by_another_worker(api):
+    tokens = await sign_up(api)
+    fresh = (await api.post("/api/auth/revoke", headers=bearer(tokens))).json()
+    # Another worker has neither the revocation nor the profile cached
+    server.token_versions.clear()
+    server.user_cache.clear()
+
+    assert (await refresh(api, tokens["refresh_token"])).status_code == 401
+    assert (await api.get("/api/users/me", headers=bearer(tokens))).status_code == 401
+    # A refresh there records the current version, after which old access tokens fail on the fast path too
+    assert (await refresh(api, fresh["refresh_token"])).status_code == 200
+    assert await accepted(api, tokens["access_token"]) == (401, 401)
@@ -0,0 +1,70 @@
+import pytest
+
+import server
+
+pytestmark = pytest.mark.anyio
+
+@pytest.fixture
+async def chat(api, register):
+    doctor_id, doctor = await register("doctor")
+    _, patient = await register("patient")
+    chat = (await api.post("/api/chats", params={"doctor_id": doctor_id}, headers=patient)).json()
+    return chat, patient, doctor
+
+def batch(*items) -> dict:
+    return {"messages": [{"idempotency_key": key, "content": content} for key, content in items]}
+
+async def send(api, chat: dict, headers: dict, body: dict) -> list:
+    response = await api.post(f"/api/chats/{chat['id']}/messages:batch", json=body, headers=headers)
+    assert response.status_code == 200, response.text
+    return response.json()["results"]
+
+async def unread_count(chat: dict, user_id: str) -> int:
+    entry = await server.db.inbox.find_one({"chat_id": chat["id"], "user_id": user_id}, {"_id": 0, "unread_count": 1})
+    return entry["unread_count"]
+
+async def contents(chat: dict) -> list:
+    cursor = server.db.messages.find({"chat_id": chat["id"]}, {"_id": 0, "content": 1}).sort("timestamp", 1)
+    return [doc["content"] async for doc in cursor]
+
+async def test_repeated_key_within_a_batch_is_written_once(api, chat):
+    chat, patient, _ = chat
+    results = await send(api, chat, patient, batch(("k1", "first"), ("k2", "second"), ("k1", "first again")))
+    assert [result["status"] for result in results] == ["created", "created", "duplicate"]
+    assert results[2]["message_id"] == results[0]["message_id"]
+    assert await contents(chat) == ["first", "second"]
+    assert await unread_count(chat, chat["doctor_id"]) == 2
+
+async def test_replaying_a_batch_writes_nothing(api, chat):
+    chat, patient, doctor = chat
+    body = batch(("k1", "first"), ("k2", "second"))
+    first = await send(api, chat, patient, body)
+    replay = await send(api, chat, patient, body)
+    assert [result["status"] for result in replay] == ["duplicate", "duplicate"]
+    assert [result["message_id"] for result in replay] == [result["message_id"] for result in first]
+    assert await contents(chat) == ["first", "second"]
+    assert await unread_count(chat, chat["doctor_id"]) == 2
+
+    # Keys belong to their sender: the doctor reusing k1 sends a new message
+    assert [result["status"] for result in await send(api, chat, doctor, batch(("k1", "reply")))] == ["created"]
+
+async def test_lost_insert_race_reports_the_winner(api, chat, monkeypatch):
+    # A concurrent retry stores k2 after this request looked for existing keys but before it inserts
+    chat, patient, _ = chat
+    collection = type(server.db.messages)
+    insert_many = collection.insert_many
+    winner = {**server.Message(chat_id=chat["id"], sender_id=chat["patient_id"], sender_name="Test",
+                               sender_role="patient", content="second").dict(), "idempotency_key": "k2"}
+
+    async def racing_insert_many(self, documents, *args, **kwargs):
+        monkeypatch.setattr(collection, "insert_many", insert_many)
+        await self.insert_one(dict(winner))
+        return await insert_many(self, documents, *args, **kwargs)
+
+    monkeypatch.setattr(collection, "insert_many", racing_insert_many)
+    results = await send(api, chat, patient, batch(("k1", "first"), ("k2", "second"), ("k3", "third")))
+    assert [result["status"] for result in results] == ["created", "duplicate", "created"]
+    assert results[1]["message_id"] == winner["id"]
+    assert "message" in results[0] and "message" not in results[1]
+    assert sorted(await contents(chat)) == ["first", "second", "third"]
+    assert await server.db.messages.count_documents({"chat_id": chat["id"], "idempotency_key": "k2"}) == 1
@@ -0,0 +1,67 @@
+import asyncio
+import json
+import socket
+
+import pytest
+
+from server import PubSubBroker, UnixSocketBroker
+
+pytestmark = pytest.mark.anyio
+
+@pytest.fixture
+async def brokers(tmp_path):
+    # Two workers sharing one broker directory
+    received = {"a": [], "b": []}
+    workers = {name: UnixSocketBroker(str(tmp_path)) for name in received}
+    for name, broker in workers.items():
+        async def deliver(user_id, message, name=name):
+            received[name].append((user_id, message))
+        await broker.start(deliver)
+    yield workers, received
+    for broker in workers.values():
+        await broker.stop()
+
+async def settle():
+    for _ in range(20):
+        await asyncio.sleep(0.01)
+
+async def test_messages_reach_every_worker(brokers):
+    workers, received = brokers
+    await workers["a"].publish("u1", {"type": "new_message", "n": 1})
+    await settle()
+    assert received == {"a": [("u1", {"type": "new_message", "n": 1})], "b": [("u1", {"type": "new_message", "n": 1})]}
+
+async def test_large_messages_are_not_truncated(brokers):
+    workers, received = brokers
+    message = {"type": "new_messages", "content": "x" * 70_000}
+    await workers["a"].publish("u1", message)
+    await settle()
+    assert received["b"] == [("u1", message)]
+
+async def test_oversized_messages_stay_local_instead_of_failing(brokers):
+    workers, received = brokers
+    message = {"type": "new_messages", "content": "x" * (workers["a"].max_datagram + 1)}
+    await workers["a"].publish("u1", message)
+    await settle()
+    assert received == {"a": [("u1", message)], "b": []}
+
+async def test_bad_datagrams_are_dropped_without_stopping_the_reader(brokers, caplog):
+    workers, received = brokers
+    target = str(workers["b"].path)
+    workers["b"].max_datagram = 1024
+    with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as peer:
+        peer.sendto(b"not json", target)
+        peer.sendto(json.dumps({"message": {}}).encode(), target)
+        peer.sendto(json.dumps({"user_id": "u1", "message": "x" * 2048}).encode(), target)
+        peer.sendto(json.dumps({"user_id": "u1", "message": {"ok": True}}).encode(), target)
+    await settle()
+    assert received["b"] == [("u1", {"ok": True})]
+    assert sum("dropping message" in record.getMessage() for record in caplog.records) == 3
+
+def test_half_implemented_broker_fails_at_construction():
+    class StartOnly(PubSubBroker):
+        async def start(self, deliver):
+            self.deliver = deliver
+
+    with pytest.raises(TypeError, match="publish"):
+        StartOnly()
@@ -0,0 +1,92 @@
+import asyncio
+from datetime import datetime
+
+import pytest
+from mongomock_motor import AsyncMongoMockClient
+
+import server
+
+pytestmark = pytest.mark.anyio
+
+async def test_duplicate_active_chats_are_closed(monkeypatch):
+    # A database written before chats_active_pair_unique existed. The index build itself is left to
+    # ensure_indexes: mongomock ignores partialFilterExpression when building over existing documents.
+    legacy = AsyncMongoMockClient()["medassist_legacy"]
+    monkeypatch.setattr(server, "db", legacy)
+
+    def chat(chat_id, patient_id, last_message_time=None, status="active"):
+        return {"id": chat_id, "patient_id": patient_id, "doctor_id": "d", "patient_name": "P", "doctor_name": "D",
+                "status": status, "created_at": datetime(2030, 1, 1), "last_message_time": last_message_time}
+    await legacy.chats.insert_many([
+        chat("older", "p1", datetime(2030, 1, 2)),
+        chat("newest", "p1", datetime(2030, 1, 3)),
+        chat("silent", "p1"),
+        chat("closed", "p1", status="closed"),
+        chat("single", "p2"),
+    ])
+    await server.backfill_inbox()
+
+    await server.close_duplicate_active_chats()
+    statuses = {doc["id"]: doc["status"] async for doc in legacy.chats.find({}, {"_id": 0, "id": 1, "status": 1})}
+    assert statuses == {"older": "closed", "newest": "active", "silent": "closed", "closed": "closed", "single": "active"}
+    inbox = await legacy.inbox.find({"chat_id": {"$in": ["older", "silent"]}}, {"_id": 0, "status": 1}).to_list(None)
+    assert len(inbox) == 4 and all(entry["status"] == "closed" for entry in inbox)
+    assert await legacy.chats.count_documents({"status": "active", "updated_at": {"$ne": None}}) == 0
+
+    # Nothing to do once the index exists
+    await legacy.chats.update_one({"id": "older"}, {"$set": {"status": "active"}})
+    await legacy.chats.create_index([("patient_id", 1), ("doctor_id", 1)], name="chats_active_pair_unique")
+    await server.close_duplicate_active_chats()
+    assert await legacy.chats.count_documents({"status": "active"}) == 3
+
+async def test_concurrent_chat_creation_returns_one_chat(api, register):
+    doctor_id, _ = await register("doctor")
+    _, patient = await register("patient")
+    responses = await asyncio.gather(*(
+        api.post("/api/chats", params={"doctor_id": doctor_id}, headers=patient) for _ in range(5)
+    ))
+    assert len({response.json()["id"] for response in responses}) == 1
+    assert await server.db.chats.count_documents({}) == 1
+    assert await server.db.inbox.count_documents({}) == 2
+
+async def test_idempotency_key_replays_the_first_response(api, register):
+    doctor_id, _ = await register("doctor")
+    _, patient = await register("patient")
+    chat = (await api.post("/api/chats", params={"doctor_id": doctor_id}, headers=patient)).json()
+    url = f"/api/chats/{chat['id']}/messages"
+    headers = {**patient, "Idempotency-Key": "send-1"}
+
+    first = await api.post(url, params={"content": "hello"}, headers=headers)
+    server.idempotency_cache.clear()  # the retry lands on another worker
+    retry = await api.post(url, params={"content": "hello"}, headers=headers)
+    assert first.status_code == retry.status_code == 200
+    assert retry.json() == first.json()
+    assert retry.headers["Idempotent-Replayed"] == "true"
+    assert await server.db.messages.count_documents({}) == 1
+
+    reused = await api.post(url, params={"content": "something else"}, headers=headers)
+    assert reused.status_code == 422
+
+async def test_failed_request_releases_its_idempotency_key(api, register):
+    doctor_id, _ = await register("doctor")
+    _, patient = await register("patient")
+    headers = {**patient, "Idempotency-Key": "open-1"}
+    assert (await api.post("/api/chats", params={"doctor_id": "missing"}, headers=headers)).status_code == 404
+    assert await server.db.idempotency_keys.count_documents({}) == 0
+
+@pytest.mark.parametrize("other_worker", [False, True])
+async def test_idempotency_key_reused_on_another_chat_is_rejected(api, register, other_worker):
+    _, patient = await register("patient")
+    chats = []
+    for _ in range(2):
+        doctor_id, _ = await register("doctor")
+        chats.append((await api.post("/api/chats", params={"doctor_id": doctor_id}, headers=patient)).json())
+    headers = {**patient, "Idempotency-Key": "send-1"}
+
+    first = await api.post(f"/api/chats/{chats[0]['id']}/messages", params={"content": "hi"}, headers=headers)
+    assert first.status_code == 200
+    if other_worker:
+        server.idempotency_cache.clear()
+    reused = await api.post(f"/api/chats/{chats[1]['id']}/messages", params={"content": "hi"}, headers=headers)
+    assert reused.status_code == 422
+    assert await server.db.messages.count_documents({"chat_id": chats[1]["id"]}) == 0
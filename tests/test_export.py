@@ -0,0 +1,46 @@
+import json
+
+import pytest
+
+pytestmark = pytest.mark.anyio
+
+def records(response) -> list:
+    return [json.loads(line) for line in response.text.splitlines()]
+
+async def test_doctor_without_a_link_cannot_export(api, register):
+    patient_id, _ = await register("patient")
+    _, stranger = await register("doctor")
+    response = await api.get(f"/api/patients/{patient_id}/export", headers=stranger)
+    assert response.status_code == 403
+    assert "email" not in response.text
+
+async def test_doctor_exports_only_their_part(api, register):
+    patient_id, patient = await register("patient")
+    doctor_id, doctor = await register("doctor")
+    other_id, other = await register("doctor")
+    await api.post("/api/chats", params={"doctor_id": doctor_id}, headers=patient)
+    await api.post("/api/chats", params={"doctor_id": other_id}, headers=patient)
+
+    response = await api.get(f"/api/patients/{patient_id}/export", headers=doctor)
+    assert response.status_code == 200
+    lines = records(response)
+    assert lines[0]["type"] == "patient" and lines[0]["data"]["id"] == patient_id
+    assert [line["data"]["doctor_id"] for line in lines if line["type"] == "chat"] == [doctor_id]
+    assert lines[-1] == {"type": "end"}
+
+async def test_prescription_links_a_doctor(api, register):
+    patient_id, _ = await register("patient")
+    _, doctor = await register("doctor")
+    response = await api.post("/api/prescriptions", headers=doctor, json=[{"name": "Amoxicillin"}], params={
+        "patient_id": patient_id, "diagnosis": "Otitis", "instructions": "Twice daily"
+    })
+    assert response.status_code == 200
+    response = await api.get(f"/api/patients/{patient_id}/export", headers=doctor)
+    assert response.status_code == 200
+    assert [line["data"]["diagnosis"] for line in records(response) if line["type"] == "prescription"] == ["Otitis"]
+
+async def test_patients_export_only_themselves(api, register):
+    patient_id, patient = await register("patient")
+    other_id, _ = await register("patient")
+    assert (await api.get(f"/api/patients/{patient_id}/export", headers=patient)).status_code == 200
+    assert (await api.get(f"/api/patients/{other_id}/export", headers=patient)).status_code == 403
@@ -0,0 +1,35 @@
+import pytest
+from mongomock_motor import AsyncMongoMockClient
+
+import server
+
+pytestmark = pytest.mark.anyio
+
+@pytest.fixture
+def database():
+    return AsyncMongoMockClient()["medassist_index_test"]
+
+async def test_every_query_shape_is_indexed(database):
+    await server.ensure_indexes(database)
+    assert await server.check_query_plans(database) == []
+
+async def test_a_missing_index_is_reported(database, monkeypatch):
+    shape = {"collection": "messages", "filter": {"sender_id": "x"}}
+    monkeypatch.setattr(server, "QUERY_SHAPES", server.QUERY_SHAPES + [shape])
+    await server.ensure_indexes(database)
+    assert await server.check_query_plans(database) == ["messages {'sender_id': 'x'}"]
+
+async def test_or_needs_an_index_per_branch(database, monkeypatch):
+    shapes = [
+        {"collection": "prescriptions", "filter": {"$or": [{"status": "pending"}, {"pharmacy_id": "x"}]}},
+        {"collection": "prescriptions", "filter": {"$or": [{"status": "pending"}, {"diagnosis": "x"}]}},
+    ]
+    monkeypatch.setattr(server, "QUERY_SHAPES", shapes)
+    await server.ensure_indexes(database)
+    assert await server.check_query_plans(database) == [f"prescriptions {shapes[1]['filter']}"]
+
+async def test_unique_index_failure_stops_startup(database):
+    slot = {"doctor_id": "d", "slot_start": "2030-01-07T10:00:00", "appointment_id": "a"}
+    await database.appointment_slots.insert_many([dict(slot), dict(slot)])
+    with pytest.raises(RuntimeError, match="appointment_slots_doctor_slot_unique"):
+        await server.ensure_indexes(database)
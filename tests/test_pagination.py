@@ -0,0 +1,105 @@
+import base64
+import json
+import uuid
+from datetime import datetime
+
+import pytest
+from fastapi import HTTPException
+
+import server
+from server import DoctorSnapshot, decode_cursor, encode_cursor
+
+def test_cursor_round_trip():
+    timestamp = datetime(2030, 1, 7, 10, 30, 15, 123000)
+    cursor = encode_cursor(timestamp, "id|with|pipes")
+    assert "=" not in cursor
+    assert decode_cursor(cursor) == (timestamp, "id|with|pipes")
+
+@pytest.mark.parametrize("cursor", ["", "not base64!", "bm8tc2VwYXJhdG9y", "bm90LWEtZGF0ZXxpZA"])
+def test_malformed_cursor_is_a_400(cursor):
+    with pytest.raises(HTTPException) as raised:
+        decode_cursor(cursor)
+    assert raised.value.status_code == 400
+
+def opaque(position) -> str:
+    return base64.urlsafe_b64encode(json.dumps(position).encode()).decode().rstrip("=")
+
+@pytest.mark.parametrize("position", [1, None, ["x"], {"at": "x"}])
+def test_sync_token_positions_must_be_cursors(position):
+    with pytest.raises(HTTPException) as raised:
+        server.decode_sync_token(opaque({"chats": position}))
+    assert raised.value.status_code == 400
+
+@pytest.mark.parametrize("after", [5, ["x"], "bm8tc2VwYXJhdG9y"])
+def test_export_cursor_positions_must_be_cursors(after):
+    with pytest.raises(HTTPException) as raised:
+        server.decode_export_cursor(opaque({"section": "chats", "after": after}))
+    assert raised.value.status_code == 400
+
+@pytest.mark.anyio
+async def test_message_pages_walk_ties_without_gaps(api, register):
+    doctor_id, _ = await register("doctor")
+    _, patient = await register("patient")
+    chat = (await api.post("/api/chats", params={"doctor_id": doctor_id}, headers=patient)).json()
+
+    # Five messages share one timestamp; only the id breaks the tie
+    stamp = datetime(2030, 1, 7, 10, 0)
+    times = [datetime(2030, 1, 7, 9, 0)] + [stamp] * 5 + [datetime(2030, 1, 7, 11, 0)]
+    await server.db.messages.insert_many([
+        server.Message(chat_id=chat["id"], sender_id="s", sender_name="S", sender_role="patient",
+                       content=str(i), timestamp=t, id=str(uuid.uuid4())).dict()
+        for i, t in enumerate(times)
+    ])
+    expected = sorted(await server.db.messages.find({}, {"_id": 0}).to_list(None), key=lambda m: (m["timestamp"], m["id"]))
+
+    pages, cursor = [], None
+    while True:
+        params = {"limit": 2, **({"before": cursor} if cursor else {})}
+        body = (await api.get(f"/api/chats/{chat['id']}/messages", params=params, headers=patient)).json()
+        pages.insert(0, [m["id"] for m in body["messages"]])
+        cursor = body["next_cursor"]
+        if cursor is None:
+            break
+    assert [i for page in pages for i in page] == [m["id"] for m in expected]
+
+    # Walking forwards from the oldest page returns the rest in order
+    oldest = expected[0]
+    body = (await api.get(f"/api/chats/{chat['id']}/messages", headers=patient, params={
+        "after": server.encode_message_cursor(oldest), "limit": 10
+    })).json()
+    assert [m["id"] for m in body["messages"]] == [m["id"] for m in expected[1:]]
+    assert body["next_cursor"] is None
+
+def doctors(*specs) -> DoctorSnapshot:
+    return DoctorSnapshot([
+        {"id": f"d{i}", "full_name": name, "specialization": specialization}
+        for i, (name, specialization) in enumerate(specs)
+    ])
+
+def walk(snapshot: DoctorSnapshot, specialization=None, prefix=None, limit=2):
+    names, cursor = [], None
+    while True:
+        page, cursor = snapshot.search(specialization, prefix, cursor, limit)
+        names.extend(card["full_name"] for card in page)
+        if cursor is None:
+            return names
+
+def test_directory_pages_in_name_order():
+    snapshot = doctors(("carol", "Cardiology"), ("Alice", "Dermatology"), ("bob", "Cardiology"),
+                       ("Alice", "Cardiology"), ("dave", "Oncology"))
+    assert walk(snapshot) == ["Alice", "Alice", "bob", "carol", "dave"]
+    assert walk(snapshot, limit=5) == ["Alice", "Alice", "bob", "carol", "dave"]
+    assert walk(snapshot, limit=1) == ["Alice", "Alice", "bob", "carol", "dave"]
+
+def test_directory_filters_page_too():
+    snapshot = doctors(("Anna", "Cardiology"), ("Andrew", "Oncology"), ("Anton", "cardiology"),
+                       ("Bea", "Cardiology"), ("Anders", "Cardiology"))
+    assert walk(snapshot, specialization="CARDIOLOGY") == ["Anders", "Anna", "Anton", "Bea"]
+    assert walk(snapshot, prefix="an") == ["Anders", "Andrew", "Anna", "Anton"]
+    assert walk(snapshot, specialization="cardiology", prefix="ann") == ["Anna"]
+    assert walk(snapshot, specialization="Surgery") == []
+
+def test_directory_cursor_is_validated():
+    with pytest.raises(HTTPException) as raised:
+        doctors(("Anna", "Cardiology")).search(None, None, "garbage", 10)
+    assert raised.value.status_code == 400
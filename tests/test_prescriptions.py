@@ -0,0 +1,84 @@
+import asyncio
+from datetime import datetime, timedelta
+
+import pytest
+
+import server
+
+pytestmark = pytest.mark.anyio
+
+@pytest.fixture
+async def prescription_id(api, register) -> str:
+    patient_id, _ = await register("patient")
+    _, doctor = await register("doctor")
+    response = await api.post("/api/prescriptions", headers=doctor, json=[{"name": "Amoxicillin"}], params={
+        "patient_id": patient_id, "diagnosis": "Otitis", "instructions": "Twice daily"
+    })
+    assert response.status_code == 200
+    return response.json()["id"]
+
+@pytest.fixture
+async def pharmacies(register):
+    (_, first), (_, second) = await register("pharmacy"), await register("pharmacy")
+    return first, second
+
+async def claim_concurrently(api, url: str, pharmacies):
+    responses = await asyncio.gather(*(api.post(url, headers=headers) for headers in pharmacies))
+    winner, loser = sorted(zip(responses, pharmacies), key=lambda pair: pair[0].status_code)
+    return winner, loser
+
+async def test_one_of_two_concurrent_claims_wins(api, prescription_id, pharmacies):
+    (won, winner), (lost, loser) = await claim_concurrently(api, f"/api/prescriptions/{prescription_id}/claim", pharmacies)
+    assert (won.status_code, lost.status_code) == (200, 409)
+    assert won.json()["status"] == "claimed"
+
+    assert (await api.patch(f"/api/prescriptions/{prescription_id}/dispense", headers=loser)).status_code == 409
+    assert (await api.patch(f"/api/prescriptions/{prescription_id}/dispense", headers=winner)).status_code == 200
+    assert (await api.patch(f"/api/prescriptions/{prescription_id}/dispense", headers=winner)).status_code == 409
+
+async def test_claim_next_hands_out_a_prescription_once(api, prescription_id, pharmacies):
+    (won, _), (lost, _) = await claim_concurrently(api, "/api/prescriptions/claim", pharmacies)
+    assert (won.status_code, lost.status_code) == (200, 404)
+    assert won.json()["id"] == prescription_id
+
+async def expire_lease(prescription_id: str):
+    await server.db.prescriptions.update_one(
+        {"id": prescription_id}, {"$set": {"lease_expires_at": datetime.utcnow() - timedelta(seconds=1)}}
+    )
+
+@pytest.mark.parametrize("url", ["/api/prescriptions/{id}/claim", "/api/prescriptions/claim"])
+async def test_lapsed_lease_can_be_claimed_before_the_sweep(api, prescription_id, pharmacies, url):
+    first, second = pharmacies
+    assert (await api.post(f"/api/prescriptions/{prescription_id}/claim", headers=first)).status_code == 200
+    assert (await api.post(url.format(id=prescription_id), headers=second)).status_code in (404, 409)
+    await expire_lease(prescription_id)
+
+    claimed = await api.post(url.format(id=prescription_id), headers=second)
+    assert claimed.status_code == 200 and claimed.json()["id"] == prescription_id
+    assert (await api.patch(f"/api/prescriptions/{prescription_id}/dispense", headers=first)).status_code == 409
+    assert (await api.patch(f"/api/prescriptions/{prescription_id}/dispense", headers=second)).status_code == 200
+
+async def test_expired_lease_is_released_to_the_queue(api, prescription_id, pharmacies):
+    first, second = pharmacies
+    assert (await api.post(f"/api/prescriptions/{prescription_id}/claim", headers=first)).status_code == 200
+    await expire_lease(prescription_id)
+    # The lapsed holder can no longer dispense
+    assert (await api.patch(f"/api/prescriptions/{prescription_id}/dispense", headers=first)).status_code == 409
+
+    assert await server.release_expired_leases() == 1
+    assert await server.release_expired_leases() == 0
+    queue = (await api.get("/api/prescriptions/queue", headers=second)).json()["prescriptions"]
+    assert [prescription["id"] for prescription in queue] == [prescription_id]
+    assert (await api.post(f"/api/prescriptions/{prescription_id}/claim", headers=second)).status_code == 200
+    assert (await api.patch(f"/api/prescriptions/{prescription_id}/dispense", headers=second)).status_code == 200
+
+async def test_released_prescription_can_be_claimed_again(api, prescription_id, pharmacies):
+    first, second = pharmacies
+    assert (await api.post(f"/api/prescriptions/{prescription_id}/claim", headers=first)).status_code == 200
+    assert (await api.post(f"/api/prescriptions/{prescription_id}/release", headers=second)).status_code == 409
+    assert (await api.post(f"/api/prescriptions/{prescription_id}/release", headers=first)).status_code == 200
+
+    claimed = await api.post(f"/api/prescriptions/{prescription_id}/claim", headers=second)
+    assert claimed.status_code == 200 and claimed.json()["status"] == "claimed"
+    assert (await api.post(f"/api/prescriptions/{prescription_id}/release", headers=first)).status_code == 409
+    assert (await api.get("/api/prescriptions/queue", headers=first)).json()["prescriptions"] == []
@@ -0,0 +1,146 @@
+import json
+import shlex
+import tomllib
+from pathlib import Path
+from types import SimpleNamespace
+
+import httpx
+import pytest
+from uvicorn.middleware.proxy_headers import ProxyHeadersMiddleware
+
+import server
+from server import MemoryBucketStore
+
+pytestmark = pytest.mark.anyio
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(server, "time", SimpleNamespace(monotonic=lambda: now[0], perf_counter=lambda: now[0]))
+    return now
+
+async def test_bucket_allows_a_burst_then_refills(clock):
+    store = MemoryBucketStore()
+    assert [(await store.take("k", 3, 60))[0] for _ in range(4)] == [True, True, True, False]
+
+    clock[0] += 10  # half a token back at 3 per minute
+    allowed, tokens = await store.take("k", 3, 60)
+    assert not allowed and tokens == pytest.approx(0.5)
+
+    clock[0] += 10
+    allowed, tokens = await store.take("k", 3, 60)
+    assert allowed and tokens == pytest.approx(0.0)
+
+async def test_bucket_never_refills_past_its_limit(clock):
+    store = MemoryBucketStore()
+    await store.take("k", 5, 60)
+    clock[0] += 3600
+    allowed, tokens = await store.take("k", 5, 60)
+    assert allowed and tokens == pytest.approx(4.0)
+
+async def test_buckets_are_independent(clock):
+    store = MemoryBucketStore()
+    assert (await store.take("a", 1, 60))[0]
+    assert not (await store.take("a", 1, 60))[0]
+    assert (await store.take("b", 1, 60))[0]
+
+async def test_sweep_drops_refilled_buckets(clock):
+    store = MemoryBucketStore()
+    await store.take("short", 1, 10)
+    await store.take("long", 1, 600)
+    clock[0] += server.RATE_LIMIT_SWEEP_SECONDS
+    await store.take("fresh", 1, 10)
+    assert set(store.buckets) == {"long", "fresh"}
+
+async def test_middleware_answers_429_with_retry_after(api, monkeypatch):
+    monkeypatch.setattr(server, "rate_limiter", MemoryBucketStore())
+    limit, window = server.RATE_LIMIT_ROUTES[("POST", "/api/auth/login")]
+    body = {"email": "nobody@test.local", "password": "x"}
+    for remaining in range(limit - 1, -1, -1):
+        response = await api.post("/api/auth/login", json=body)
+        assert response.status_code == 401
+        assert response.headers["RateLimit-Remaining"] == str(remaining)
+
+    response = await api.post("/api/auth/login", json=body)
+    assert response.status_code == 429
+    assert 0 < int(response.headers["Retry-After"]) <= window / limit + 1
+    # Other budgets are untouched
+    assert (await api.get("/api/users/doctors")).status_code == 200
+
+async def test_forwarded_for_uses_the_hop_our_proxy_added(monkeypatch):
+    monkeypatch.setattr(server, "RATE_LIMIT_TRUST_PROXY", True)
+    scope = {"type": "http", "client": ("127.0.0.1", 5000),
+             "headers": [(b"x-forwarded-for", b"6.6.6.6, 203.0.113.7")]}
+    assert server.caller_identity(scope) == "ip:203.0.113.7"
+    monkeypatch.setattr(server, "RATE_LIMIT_TRUST_PROXY", False)
+    assert server.caller_identity(scope) == "ip:127.0.0.1"
+
+ROOT = Path(__file__).resolve().parent.parent
+
+def start_command(path: str) -> list:
+    text = (ROOT / path).read_text()
+    if path.endswith(".json"):
+        text = json.loads(text)["deploy"]["startCommand"]
+    elif path.endswith(".toml"):
+        text = tomllib.loads(text)["start"]["cmd"]
+    line = next(line for line in text.splitlines() if "uvicorn server:app" in line)
+    return shlex.split(line[line.index("uvicorn"):])
+
+def deployed_app(command: list, app):
+    # The wrapping uvicorn applies for this command line; proxy headers are on by default
+    if "--no-proxy-headers" in command:
+        return app
+    trusted = "127.0.0.1"
+    for i, arg in enumerate(command):
+        if arg == "--forwarded-allow-ips":
+            trusted = command[i + 1]
+        elif arg.startswith("--forwarded-allow-ips="):
+            trusted = arg.split("=", 1)[1]
+    return ProxyHeadersMiddleware(app, trusted_hosts=trusted)
+
+def env_example_trusts_proxy() -> bool:
+    return "RATE_LIMIT_TRUST_PROXY=true" in (ROOT / "backend" / ".env.example").read_text().splitlines()
+
+@pytest.mark.parametrize("path,proxy_address,trust_proxy", [
+    ("backend/Procfile", "10.0.0.2", env_example_trusts_proxy),
+    ("backend/railway.json", "10.0.0.2", env_example_trusts_proxy),
+    ("backend/nixpacks.toml", "10.0.0.2", env_example_trusts_proxy),
+    ("entrypoint.sh", "127.0.0.1", lambda: False),  # nginx in the same container
+])
+async def test_forged_forwarded_for_does_not_reset_the_login_budget(fresh_app, monkeypatch, path, proxy_address, trust_proxy):
+    monkeypatch.setattr(server, "rate_limiter", MemoryBucketStore())
+    monkeypatch.setattr(server, "RATE_LIMIT_TRUST_PROXY", trust_proxy())
+    limit, _ = server.RATE_LIMIT_ROUTES[("POST", "/api/auth/login")]
+    transport = httpx.ASGITransport(app=deployed_app(start_command(path), fresh_app), client=(proxy_address, 4000))
+    body = {"email": "nobody@test.local", "password": "x"}
+    async with fresh_app.router.lifespan_context(fresh_app):
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+            statuses = []
+            for i in range(limit + 1):
+                # The client rotates the header it sends; the proxy appends the address it saw
+                forwarded = f"198.51.100.{i}, 203.0.113.7"
+                response = await client.post("/api/auth/login", json=body, headers={"X-Forwarded-For": forwarded})
+                statuses.append(response.status_code)
+    assert statuses == [401] * limit + [429]
+
+async def test_websocket_sends_share_the_message_budget(api, register, monkeypatch):
+    monkeypatch.setattr(server, "rate_limiter", MemoryBucketStore())
+    doctor_id, _ = await register("doctor")
+    patient_id, patient = await register("patient")
+    chat = (await api.post("/api/chats", params={"doctor_id": doctor_id}, headers=patient)).json()
+    claims = server.AuthClaims(id=patient_id, role="patient", full_name="Test Patient")
+    session = server.WebSocketSession(claims, "connection")
+    replies = []
+    monkeypatch.setattr(session, "reply", replies.append)
+
+    limit, _ = server.RATE_LIMIT_ROUTES[("POST", "/api/chats/{chat_id}/messages")]
+    frame = json.dumps({"type": "send_message", "chat_id": chat["id"], "content": "hi"})
+    for _ in range(limit):
+        await session.handle(frame)
+    assert [reply["type"] for reply in replies] == ["message_sent"] * limit
+
+    await session.handle(frame)
+    assert replies[-1]["status"] == 429 and replies[-1]["retry_after"] >= 1
+    assert await server.db.messages.count_documents({}) == limit
+    response = await api.post(f"/api/chats/{chat['id']}/messages", params={"content": "hi"}, headers=patient)
+    assert response.status_code == 429
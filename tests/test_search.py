@@ -0,0 +1,95 @@
+import pytest
+
+import server
+
+pytestmark = pytest.mark.anyio
+
+@pytest.fixture(autouse=True)
+def memory_backend(monkeypatch):
+    # SEARCH_BACKEND=memory; mongomock has no $text. Set before the lifespan builds the index.
+    monkeypatch.setattr(server, "search_index", server.SearchIndex())
+
+async def search(api, headers: dict, q: str, **params) -> dict:
+    response = await api.get("/api/search", params={"q": q, **params}, headers=headers)
+    assert response.status_code == 200, response.text
+    return response.json()
+
+def hits(page: dict) -> list:
+    return [(result["kind"], result["document"]["id"]) for result in page["results"]]
+
+async def open_chat(api, patient: dict, doctor_id: str) -> str:
+    return (await api.post("/api/chats", params={"doctor_id": doctor_id}, headers=patient)).json()["id"]
+
+async def say(api, headers: dict, chat_id: str, content: str) -> str:
+    return (await api.post(f"/api/chats/{chat_id}/messages", params={"content": content}, headers=headers)).json()["id"]
+
+async def prescribe(api, doctor: dict, patient_id: str, diagnosis: str, *medications: str,
+                    instructions: str = "Twice daily") -> str:
+    response = await api.post("/api/prescriptions", headers=doctor, json=[{"name": name} for name in medications], params={
+        "patient_id": patient_id, "diagnosis": diagnosis, "instructions": instructions
+    })
+    return response.json()["id"]
+
+async def test_results_are_scoped_to_the_caller(api, register):
+    doctor_id, doctor = await register("doctor")
+    _, stranger = await register("doctor")
+    alice_id, alice = await register("patient")
+    bob_id, bob = await register("patient")
+    _, pharmacy = await register("pharmacy")
+
+    alice_chat, bob_chat = await open_chat(api, alice, doctor_id), await open_chat(api, bob, doctor_id)
+    alice_message = await say(api, alice, alice_chat, "My fever is back")
+    bob_message = await say(api, bob, bob_chat, "Still running a fever")
+    alice_prescription = await prescribe(api, doctor, alice_id, "Viral fever", "Paracetamol")
+    bob_prescription = await prescribe(api, doctor, bob_id, "Fever and cough", "Ibuprofen")
+
+    assert set(hits(await search(api, alice, "fever"))) == {("message", alice_message), ("prescription", alice_prescription)}
+    assert set(hits(await search(api, bob, "fevers"))) == {("message", bob_message), ("prescription", bob_prescription)}
+    assert hits(await search(api, alice, "ibuprofen cough")) == []
+    assert len(hits(await search(api, doctor, "fever"))) == 4
+    assert hits(await search(api, stranger, "fever")) == []
+    assert (await api.get("/api/search", params={"q": "fever"}, headers=pharmacy)).status_code == 403
+
+async def test_ranking_and_highlights(api, register):
+    doctor_id, doctor = await register("doctor")
+    patient_id, patient = await register("patient")
+    chat_id = await open_chat(api, patient, doctor_id)
+    mention = await say(api, patient, chat_id, "Can I take ibuprofen with food?")
+    both = await say(api, patient, chat_id, "The ibuprofen helps the migraine")
+    medication = await prescribe(api, doctor, patient_id, "Tension headache", "Ibuprofen")
+    await say(api, patient, chat_id, "Thanks doctor")
+
+    page = await search(api, patient, "ibuprofen migraine")
+    scores = [result["score"] for result in page["results"]]
+    assert scores == sorted(scores, reverse=True)
+    assert hits(page)[0] == ("message", both)  # matches both terms
+    assert set(hits(page)[1:]) == {("message", mention), ("prescription", medication)}
+    # A medication name weighs more than a passing mention
+    ranked = hits(await search(api, patient, "ibuprofen"))
+    assert ranked.index(("prescription", medication)) < ranked.index(("message", mention))
+
+    highlight = page["results"][0]["highlights"][0]
+    assert highlight["field"] == "content"
+    assert [highlight["snippet"][start:end] for start, end in highlight["matches"]] == ["ibuprofen", "migraine"]
+    assert hits(await search(api, patient, "ibuprofen", kind="prescription")) == [("prescription", medication)]
+    assert (await search(api, patient, "the and of"))["results"] == []
+
+async def test_pages_cover_every_hit_once(api, register):
+    doctor_id, _ = await register("doctor")
+    _, patient = await register("patient")
+    chat_id = await open_chat(api, patient, doctor_id)
+    sent = {await say(api, patient, chat_id, f"cough update {i}") for i in range(5)}
+
+    seen, offsets, offset = [], [], 0
+    while offset is not None:
+        page = await search(api, patient, "cough", limit=2, offset=offset)
+        assert len(page["results"]) <= 2
+        seen += [doc_id for _, doc_id in hits(page)]
+        offsets.append(offset)
+        offset = page["next_offset"]
+    assert offsets == [0, 2, 4]
+    assert sorted(seen) == sorted(sent)
+
+    response = await api.get("/api/search", params={"q": "cough", "offset": server.SEARCH_MAX_RESULTS, "limit": 1},
+                             headers=patient)
+    assert response.status_code == 400
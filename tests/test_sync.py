@@ -0,0 +1,82 @@
+import asyncio
+from datetime import datetime
+
+import pytest
+
+import server
+
+pytestmark = pytest.mark.anyio
+
+@pytest.fixture(autouse=True)
+def no_sync_lag(monkeypatch):
+    monkeypatch.setattr(server, "SYNC_LAG_SECONDS", 0.0)
+
+async def sync(api, headers: dict, token: str = None) -> dict:
+    # Writes made before this call are a few ms older than its horizon
+    await asyncio.sleep(0.01)
+    response = await api.get("/api/sync", params={"since": token} if token else {}, headers=headers)
+    assert response.status_code == 200, response.text
+    return response.json()
+
+def ids(records: list) -> list:
+    return [record["id"] for record in records]
+
+async def test_incremental_sync_returns_only_changes(api, register):
+    doctor_id, doctor = await register("doctor")
+    other_id, _ = await register("doctor")
+    patient_id, patient = await register("patient")
+    _, pharmacy = await register("pharmacy")
+    _, rival = await register("pharmacy")
+
+    chat = (await api.post("/api/chats", params={"doctor_id": doctor_id}, headers=patient)).json()
+    closing = (await api.post("/api/chats", params={"doctor_id": other_id}, headers=patient)).json()
+    hello = (await api.post(f"/api/chats/{chat['id']}/messages", params={"content": "hello"}, headers=patient)).json()
+    prescription = (await api.post("/api/prescriptions", headers=doctor, json=[{"name": "Amoxicillin"}], params={
+        "patient_id": patient_id, "diagnosis": "Otitis", "instructions": "Twice daily"
+    })).json()
+
+    full = await sync(api, patient)
+    assert sorted(ids(full["chats"])) == sorted([chat["id"], closing["id"]])
+    assert ids(full["messages"]) == [hello["id"]]
+    assert ids(full["prescriptions"]) == [prescription["id"]]
+    assert full["tombstones"] == [] and not full["has_more"]
+    rival_full = await sync(api, rival)
+    assert ids(rival_full["prescriptions"]) == [prescription["id"]]
+
+    # Nothing changed: nothing comes back
+    quiet = await sync(api, patient, full["next_token"])
+    assert quiet["chats"] == quiet["messages"] == quiet["prescriptions"] == quiet["tombstones"] == []
+
+    reply = (await api.post(f"/api/chats/{chat['id']}/messages", params={"content": "hi"}, headers=doctor)).json()
+    await server.db.chats.update_one({"id": closing["id"]}, {"$set": {"status": "closed", "updated_at": datetime.utcnow()}})
+    assert (await api.post(f"/api/prescriptions/{prescription['id']}/claim", headers=pharmacy)).status_code == 200
+
+    delta = await sync(api, patient, quiet["next_token"])
+    assert ids(delta["messages"]) == [reply["id"]]
+    assert ids(delta["chats"]) == [chat["id"]]  # its last message moved
+    assert delta["chats"][0]["last_message"] == "hi"
+    assert [(record["id"], record["status"]) for record in delta["prescriptions"]] == [(prescription["id"], "claimed")]
+    assert delta["tombstones"] == [{"kind": "chat", "id": closing["id"]}]
+
+    # The pharmacy that lost the prescription is told to drop it
+    rival_delta = await sync(api, rival, rival_full["next_token"])
+    assert rival_delta["prescriptions"] == []
+    assert rival_delta["tombstones"] == [{"kind": "prescription", "id": prescription["id"]}]
+
+async def test_sync_pages_until_has_more_is_false(api, register):
+    doctor_id, _ = await register("doctor")
+    _, patient = await register("patient")
+    chat = (await api.post("/api/chats", params={"doctor_id": doctor_id}, headers=patient)).json()
+    sent = [(await api.post(f"/api/chats/{chat['id']}/messages", params={"content": str(i)}, headers=patient)).json()
+            for i in range(5)]
+
+    await asyncio.sleep(0.01)
+    received, token = [], None
+    for _ in range(10):
+        response = await api.get("/api/sync", params={"limit": 2, **({"since": token} if token else {})}, headers=patient)
+        page = response.json()
+        received += ids(page["messages"])
+        token = page["next_token"]
+        if not page["has_more"]:
+            break
+    assert received == ids(sent)
@@ -0,0 +1,65 @@
+import json
+
+import pytest
+from pymongo.errors import AutoReconnect
+
+import server
+
+def register(client, role: str) -> dict:
+    response = client.post("/api/auth/register", json={
+        "email": f"{role}@ws.test", "password": "test-password", "full_name": f"WS {role.title()}", "role": role
+    })
+    assert response.status_code == 200, response.text
+    return response.json()
+
+@pytest.fixture
+def chat(client):
+    doctor, patient = register(client, "doctor"), register(client, "patient")
+    chat = client.post("/api/chats", params={"doctor_id": doctor["user"]["id"]},
+                       headers={"Authorization": f"Bearer {patient['access_token']}"}).json()
+    return patient, chat
+
+def test_failed_frame_is_answered_and_the_socket_stays_open(client, chat, monkeypatch):
+    patient, chat = chat
+
+    async def unavailable(*args, **kwargs):
+        raise AutoReconnect("connection reset")
+
+    monkeypatch.setattr(server, "post_message", unavailable)
+    user_id = patient["user"]["id"]
+    with client.websocket_connect(f"/ws/{user_id}?token={patient['access_token']}") as ws:
+        ws.send_text(json.dumps({"type": "send_message", "chat_id": chat["id"], "content": "hi", "request_id": "r1"}))
+        assert ws.receive_json() == {"type": "error", "request_id": "r1", "status": 500, "detail": "Internal server error"}
+        ws.send_text(json.dumps({"type": "typing", "chat_id": chat["id"]}))
+        ws.send_text("{}")
+        assert ws.receive_json()["type"] == "error"
+    assert user_id not in server.manager.user_connections
+
+def test_connection_is_released_when_the_endpoint_fails(client, chat, monkeypatch):
+    patient, _ = chat
+
+    async def crash(self, text):
+        raise RuntimeError("boom")
+
+    monkeypatch.setattr(server.WebSocketSession, "handle", crash)
+    before = len(server.manager.active_connections)
+    user_id = patient["user"]["id"]
+    with pytest.raises(RuntimeError):
+        with client.websocket_connect(f"/ws/{user_id}?token={patient['access_token']}") as ws:
+            ws.send_text("{}")
+            ws.receive_text()
+    assert len(server.manager.active_connections) == before
+    assert user_id not in server.manager.user_connections
+
+def test_direct_and_change_feed_copies_are_delivered_once(client, chat):
+    patient, chat = chat
+    doctor = client.post("/api/auth/login", json={"email": "doctor@ws.test", "password": "test-password"}).json()
+    headers = {"Authorization": f"Bearer {patient['access_token']}"}
+    with client.websocket_connect(f"/ws/{doctor['user']['id']}?token={doctor['access_token']}") as ws:
+        first = client.post(f"/api/chats/{chat['id']}/messages", params={"content": "first"}, headers=headers).json()
+        assert ws.receive_json() == {"type": "new_message", "message": first}
+
+        document = client.portal.call(server.db.messages.find_one, {"id": first["id"]}, server.MESSAGE_FIELDS)
+        client.portal.call(server.change_feed.dispatch, [{"collection": "messages", "operation": "insert", "document": document}])
+        second = client.post(f"/api/chats/{chat['id']}/messages", params={"content": "second"}, headers=headers).json()
+        assert ws.receive_json()["message"]["id"] == second["id"]